@@ -0,0 +1,148 @@
+"""Headless benchmark of TreeCache import, edit, eviction and export
+
+Run from the project root after `pip install . -r requirements-tests.txt`:
+
+    pytest benchmarks/bench_cache.py
+"""
+import random
+import typing as t
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from treeview.cache import CacheNode
+from treeview.cache import TreeCache
+from treeview.medium import CacheConfig
+from treeview.medium import DBNodeRow
+
+SIZES = [10000, 100000]
+ROUNDS = 3
+
+Setup = t.Tuple[t.Tuple[t.Any, ...], t.Dict[str, t.Any]]
+
+
+def shuffled_rows(size: int, seed: int = 0) -> t.List[DBNodeRow]:
+    """Random recursive tree with rows in random order"""
+    rnd = random.Random(seed)
+    rows = [DBNodeRow(1, None, 'Node1', False, False)]
+    for node_id in range(2, size + 1):
+        parent_id = rnd.randint(max(1, node_id - 50), node_id - 1)
+        rows.append(
+            DBNodeRow(node_id, parent_id, f'Node{node_id}', False, False)
+        )
+    rnd.shuffle(rows)
+    return rows
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def rows(request: pytest.FixtureRequest) -> t.List[DBNodeRow]:
+    return shuffled_rows(request.param)
+
+
+def imported(
+    rows: t.List[DBNodeRow],
+) -> t.Tuple[TreeCache, t.List[CacheNode]]:
+    """Cache holding all rows with every tenth node picked for changes"""
+    cache = TreeCache()
+    cache.import_nodes(rows)
+    return cache, [cache.get_node(row.id) for row in rows[:len(rows) // 10]]
+
+
+@pytest.mark.benchmark(group='cache-import')
+def test_import_one_by_one(
+    benchmark: BenchmarkFixture,
+    rows: t.List[DBNodeRow],
+):
+    def import_all(cache: TreeCache) -> None:
+        for row in rows:
+            cache.import_node(row)
+
+    benchmark.pedantic(
+        import_all, setup=lambda: ((TreeCache(),), {}), rounds=ROUNDS
+    )
+
+
+@pytest.mark.benchmark(group='cache-import')
+def test_import_batch(
+    benchmark: BenchmarkFixture,
+    rows: t.List[DBNodeRow],
+):
+    cache = benchmark.pedantic(
+        lambda cache: cache.import_nodes(rows) or cache,
+        setup=lambda: ((TreeCache(),), {}),
+        rounds=ROUNDS,
+    )
+    assert cache.node_count == len(rows)
+
+
+@pytest.mark.benchmark(group='cache-import')
+def test_import_bounded(
+    benchmark: BenchmarkFixture,
+    rows: t.List[DBNodeRow],
+):
+    max_nodes = len(rows) // 10
+
+    def import_all(cache: TreeCache) -> TreeCache:
+        for row in rows:
+            cache.import_node(row)
+        return cache
+
+    cache = benchmark.pedantic(
+        import_all,
+        setup=lambda: ((TreeCache(CacheConfig(max_nodes=max_nodes)),), {}),
+        rounds=ROUNDS,
+    )
+    assert cache.node_count <= max_nodes
+
+
+@pytest.mark.benchmark(group='cache-edit')
+def test_edit(
+    benchmark: BenchmarkFixture,
+    rows: t.List[DBNodeRow],
+):
+    def edit(cache: TreeCache, nodes: t.List[CacheNode]) -> None:
+        for node in nodes:
+            cache.edit_node(node, 'edited')
+
+    benchmark.pedantic(
+        edit, setup=lambda: (imported(rows), {}), rounds=ROUNDS
+    )
+
+
+@pytest.mark.benchmark(group='cache-edit')
+def test_add(
+    benchmark: BenchmarkFixture,
+    rows: t.List[DBNodeRow],
+):
+    def add(cache: TreeCache, nodes: t.List[CacheNode]) -> None:
+        for node in nodes:
+            cache.add_child_node(node, 'new')
+
+    benchmark.pedantic(
+        add, setup=lambda: (imported(rows), {}), rounds=ROUNDS
+    )
+
+
+@pytest.mark.benchmark(group='cache-export')
+def test_export(
+    benchmark: BenchmarkFixture,
+    rows: t.List[DBNodeRow],
+):
+    size = len(rows)
+
+    def changed() -> Setup:
+        cache, nodes = imported(rows)
+        for node in nodes:
+            cache.edit_node(node, 'edited')
+            cache.add_child_node(node, 'new')
+        return (cache,), {}
+
+    def export(cache: TreeCache) -> int:
+        exported = cache.export_changes(
+            set(), lambda count: list(range(size + 1, size + count + 1))
+        )
+        cache.commit_export(exported, set())
+        return len(exported.updates)
+
+    exported = benchmark.pedantic(export, setup=changed, rounds=ROUNDS)
+    assert exported == size // 10 * 2
@@ -0,0 +1,74 @@
+"""Compares tree construction of the old deque loop with build_hierarchy
+
+Run from the project root after `pip install . -r requirements-tests.txt`:
+
+    pytest benchmarks/bench_load_data.py
+"""
+import random
+import typing as t
+from collections import deque
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from treeview.hierarchy import build_hierarchy
+from treeview.medium import DBNodeRow
+
+SIZES = [10000, 100000, 1000000]
+# The quadratic legacy loop takes most of an hour on a million rows
+LEGACY_SIZES = [10000, 100000]
+
+
+def synthetic_rows(size: int, seed: int = 0) -> t.List[DBNodeRow]:
+    """Random recursive tree with rows in child-before-parent order"""
+    rnd = random.Random(seed)
+    rows = [DBNodeRow(1, None, 'Node1', False, False)]
+    for node_id in range(2, size + 1):
+        parent_id = rnd.randint(max(1, node_id - 50), node_id - 1)
+        rows.append(
+            DBNodeRow(node_id, parent_id, f'Node{node_id}', False, False)
+        )
+    rows.reverse()
+    return rows
+
+
+def legacy_load(rows: t.List[DBNodeRow]) -> int:
+    """The former DBTreeView.load_data loop with Qt items left out
+
+    Returns the number of re-queued rows.
+    """
+    placed = {}
+    requeued = 0
+    nodes = deque(rows)
+    while nodes:
+        node = nodes.popleft()
+        if node.parent_id is not None and node.parent_id not in placed:
+            nodes.append(node)
+            requeued += 1
+            continue
+        placed[node.id] = node
+    return requeued
+
+
+def linear_load(rows: t.List[DBNodeRow]) -> int:
+    placed = {}
+    hierarchy = build_hierarchy(rows)
+    for _, batch in hierarchy.batches:
+        for node in batch:
+            placed[node.id] = node
+    return len(hierarchy.orphans)
+
+
+@pytest.mark.parametrize('size', LEGACY_SIZES)
+@pytest.mark.benchmark(group='load-data')
+def test_legacy_load(benchmark: BenchmarkFixture, size: int):
+    rows = synthetic_rows(size)
+    benchmark.pedantic(legacy_load, (rows,), rounds=1)
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.benchmark(group='load-data')
+def test_linear_load(benchmark: BenchmarkFixture, size: int):
+    rows = synthetic_rows(size)
+    orphans = benchmark.pedantic(linear_load, (rows,), rounds=3)
+    assert orphans == 0
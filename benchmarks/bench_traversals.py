@@ -0,0 +1,97 @@
+"""Stress test of TreeCache traversals on a deep and on a wide tree
+
+Run from the project root after `pip install . -r requirements-tests.txt`:
+
+    pytest benchmarks/bench_traversals.py
+"""
+import typing as t
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from treeview.cache import TreeCache
+from treeview.medium import DBNodeRow
+
+# Number of unsaved nodes and children per node, None for a chain
+TREES = {
+    'deep': (100000, None),
+    'wide': (1000000, 100),
+}
+trees = pytest.mark.parametrize(
+    'size, fanout', list(TREES.values()), ids=list(TREES)
+)
+
+
+def build_cache(size: int, fanout: t.Optional[int]) -> TreeCache:
+    """Saved root with `size` unsaved descendants
+
+    Each node gets `fanout` children, `None` makes a single chain.
+    """
+    cache = TreeCache()
+    cache.import_node(DBNodeRow(1, None, 'Node1', False, False))
+    parents = [cache.get_node(1)]
+    created = 0
+    while created < size:
+        next_parents = []
+        for parent in parents:
+            for _ in range(fanout or 1):
+                if created == size:
+                    break
+                next_parents.append(
+                    cache.add_child_node(parent, f'new{created}')
+                )
+                created += 1
+        parents = next_parents
+    return cache
+
+
+def export(cache: TreeCache) -> int:
+    exported = cache.export_changes(
+        set(), lambda count: list(range(2, count + 2))
+    )
+    cache.commit_export(exported, set())
+    return len(exported.updates)
+
+
+@trees
+@pytest.mark.benchmark(group='traversal-build')
+def test_build(
+    benchmark: BenchmarkFixture,
+    size: int,
+    fanout: t.Optional[int],
+):
+    cache = benchmark.pedantic(build_cache, (size, fanout), rounds=1)
+    assert cache.unsaved_count == size
+
+
+@trees
+@pytest.mark.benchmark(group='traversal-export')
+def test_export(
+    benchmark: BenchmarkFixture,
+    size: int,
+    fanout: t.Optional[int],
+):
+    exported = benchmark.pedantic(
+        export, setup=lambda: ((build_cache(size, fanout),), {}), rounds=1
+    )
+    assert exported == size
+
+
+@trees
+@pytest.mark.benchmark(group='traversal-delete')
+def test_delete(
+    benchmark: BenchmarkFixture,
+    size: int,
+    fanout: t.Optional[int],
+):
+    def saved() -> t.Tuple[t.Tuple[TreeCache], t.Dict[str, t.Any]]:
+        cache = build_cache(size, fanout)
+        export(cache)
+        return (cache,), {}
+
+    cache = benchmark.pedantic(
+        lambda cache: cache.delete_node(cache.get_node(1)) or cache,
+        setup=saved,
+        rounds=1,
+    )
+    assert len(cache.pending_deleted) == size + 1
@@ -1,6 +1,9 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 CREATE TABLE IF NOT EXISTS nodes(
     id SERIAL PRIMARY KEY,
     parent_id INT,
     "value" TEXT,
     deleted BOOLEAN DEFAULT FALSE
 );
+CREATE INDEX IF NOT EXISTS ix_nodes_parent_id ON nodes (parent_id, id);
+CREATE INDEX IF NOT EXISTS ix_nodes_live_parent_id ON nodes (parent_id) WHERE NOT deleted;
@@ -0,0 +1,333 @@
+import typing as t
+
+import pytest
+
+from treeview.cache import CacheNode
+from treeview.cache import NULL_TEXT
+from treeview.cache import TreeCache
+from treeview.medium import CacheConfig
+from treeview.medium import CONFLICT_DELETED
+from treeview.medium import CONFLICT_MODIFIED
+from treeview.medium import CONFLICT_PARENT_DELETED
+from treeview.medium import DBNodeRow
+from treeview.medium import NodeConflict
+from treeview.medium import NodeUpdates
+
+
+def row(
+    node_id: int,
+    parent_id: t.Optional[int],
+    deleted: bool = False,
+    version: int = 0,
+) -> DBNodeRow:
+    return DBNodeRow(
+        node_id, parent_id, f'Node{node_id}', deleted, False, version
+    )
+
+
+# 1 -> 2 -> 3 -> 4, 1 -> 5
+TREE = [row(1, None), row(2, 1), row(3, 2), row(4, 3), row(5, 1)]
+
+
+def reserve_from(first_id: int) -> t.Callable[[int], t.List[int]]:
+    return lambda count: list(range(first_id, first_id + count))
+
+
+def values(nodes: t.Iterable[CacheNode]) -> t.List[t.Optional[str]]:
+    return [node.value for node in nodes]
+
+
+def export(
+    cache: TreeCache,
+    deleted_ids: t.AbstractSet[int] = frozenset(),
+) -> t.Tuple[t.List[NodeUpdates], t.List[str]]:
+    exported = cache.export_changes(set(deleted_ids), reserve_from(100))
+    stillborns = cache.commit_export(exported, set(deleted_ids))
+    return exported.updates, stillborns
+
+
+@pytest.fixture
+def cache() -> TreeCache:
+    cache = TreeCache()
+    cache.import_nodes(TREE)
+    return cache
+
+
+def test_import_builds_hierarchy_in_any_order():
+    cache = TreeCache()
+    cache.import_nodes(reversed(TREE))
+
+    assert values(cache.root.children) == ['Node1']
+    assert values(cache.get_node(1).children) == ['Node2', 'Node5']
+    assert values(cache.get_node(3).children) == ['Node4']
+    assert cache.node_count == len(TREE)
+
+
+def test_import_reparents_orphans():
+    cache = TreeCache()
+    cache.import_node(row(4, 3))
+    cache.import_node(row(3, 2))
+    assert values(cache.root.children) == ['Node3']
+
+    cache.import_node(row(2, 1))
+
+    assert values(cache.root.children) == ['Node2']
+    assert values(cache.get_node(2).children) == ['Node3']
+    assert cache.get_node(3).children == [cache.get_node(4)]
+
+
+def test_import_under_deleted_parent_is_deleted():
+    cache = TreeCache()
+    cache.import_node(row(3, 2))
+    cache.add_child_node(cache.get_node(3), 'new')
+
+    stillborns = cache.import_nodes([row(2, 1, deleted=True)])
+
+    assert stillborns == ['new']
+    assert cache.get_node(3).deleted
+    assert cache.unsaved_count == 0
+
+
+def test_context_nodes_are_promoted_on_fetch():
+    cache = TreeCache()
+    cache.import_nodes([row(3, 2)], context=[row(1, None), row(2, 1)])
+    assert cache.get_node(2).context
+    assert not cache.in_cache(2)
+
+    cache.import_node(row(2, 1))
+
+    assert not cache.get_node(2).context
+    assert cache.in_cache(2)
+
+
+def test_edit_keeps_stored_value(cache: TreeCache):
+    node = cache.get_node(2)
+    cache.edit_node(node, 'first')
+    cache.edit_node(node, 'second')
+
+    assert node.modified
+    assert node.backup_value == 'Node2'
+
+    cache.edit_node(node, 'Node2')
+
+    assert not node.modified
+    assert export(cache)[0] == []
+
+
+def test_add_gives_ids_parents_first(cache: TreeCache):
+    child = cache.add_child_node(cache.get_node(4), 'child')
+    grandchild = cache.add_child_node(child, 'grandchild')
+
+    updates, _ = export(cache)
+
+    assert updates == [
+        {'id': 100, 'parent_id': 4, 'value': 'child', 'version': None},
+        {
+            'id': 101, 'parent_id': 100, 'value': 'grandchild',
+            'version': None,
+        },
+    ]
+    assert (child.id, grandchild.parent_id) == (100, 100)
+    assert cache.get_node(101) is grandchild
+    assert cache.unsaved_count == 0
+
+
+def test_delete_marks_subtree_and_drops_unsaved(cache: TreeCache):
+    cache.edit_node(cache.get_node(3), 'edited')
+    cache.add_child_node(cache.get_node(4), 'new')
+
+    stillborns = cache.delete_node(cache.get_node(2))
+
+    assert stillborns == ['new']
+    assert all(cache.get_node(node_id).deleted for node_id in (2, 3, 4))
+    assert cache.get_node(3).value == 'Node3'
+    assert cache.deleted_subtree_roots == {2}
+    assert cache.pending_deleted == {2, 3, 4}
+    assert export(cache)[0] == []
+
+
+def test_delete_of_unsaved_node_removes_it(cache: TreeCache):
+    node = cache.add_child_node(cache.get_node(5), 'new')
+
+    cache.delete_node(node)
+
+    assert cache.get_node(5).children == []
+    assert cache.unsaved_count == 0
+
+
+def test_export_leaves_cache_untouched(cache: TreeCache):
+    cache.edit_node(cache.get_node(2), 'edited')
+    node = cache.add_child_node(cache.get_node(2), 'new')
+    cache.delete_node(cache.get_node(5))
+
+    exported = cache.export_changes(set(), reserve_from(100))
+
+    assert len(exported.updates) == 2
+    assert exported.new_ids == [100]
+    assert cache.get_node(2).modified
+    assert node.id is None
+    assert cache.unsaved_count == 1
+    assert cache.deleted_subtree_roots == {5}
+    assert cache.can_undo
+    # A failed apply is simply exported again
+    assert cache.export_changes(set(), reserve_from(100)) == exported
+
+
+def test_commit_export_marks_changes_saved(cache: TreeCache):
+    cache.edit_node(cache.get_node(2), 'edited')
+    cache.delete_node(cache.get_node(5))
+
+    export(cache)
+
+    assert not cache.get_node(2).modified
+    assert cache.deleted_subtree_roots == set()
+    assert cache.pending_deleted == frozenset()
+    assert not cache.can_undo
+
+
+def test_export_skips_orphans_deleted_in_database():
+    cache = TreeCache()
+    cache.import_nodes([row(3, 2), row(4, 3), row(7, 6)])
+    cache.edit_node(cache.get_node(4), 'edited')
+    cache.add_child_node(cache.get_node(4), 'doomed')
+    cache.edit_node(cache.get_node(7), 'kept')
+
+    updates, stillborns = export(cache, {2, 3, 4})
+
+    assert updates == [
+        {'id': 7, 'parent_id': 6, 'value': 'kept', 'version': 0},
+    ]
+    assert stillborns == ['doomed']
+    assert cache.get_node(4).deleted
+    assert cache.get_node(4).value == 'Node4'
+
+
+def test_export_of_top_level_node():
+    cache = TreeCache()
+    cache.import_nodes([row(2, None), row(3, 2)])
+    cache.edit_node(cache.get_node(2), 'edited')
+
+    updates, _ = export(cache)
+
+    assert updates == [
+        {'id': 2, 'parent_id': None, 'value': 'edited', 'version': 0},
+    ]
+
+
+def test_to_dict_rejects_nodes_without_id():
+    with pytest.raises(ValueError):
+        CacheNode(value='new').to_dict()
+
+
+def test_eviction_keeps_dirty_subtrees():
+    cache = TreeCache(CacheConfig(max_nodes=4))
+    cache.import_nodes(TREE[:4])
+    cache.edit_node(cache.get_node(4), 'edited')
+
+    cache.import_nodes([row(node_id, None) for node_id in range(10, 15)])
+
+    # Ancestors stay, so the edited node keeps its place
+    assert [cache.in_cache(node_id) for node_id in (1, 2, 3, 4)] == [
+        True, True, True, True
+    ]
+    assert cache.get_node(4).value == 'edited'
+    assert cache.node_count == 4
+
+
+def test_eviction_drops_least_recently_used():
+    cache = TreeCache(CacheConfig(max_nodes=2))
+    cache.import_node(row(10, None))
+    cache.import_node(row(11, None))
+    cache.touch(cache.get_node(10))
+
+    cache.import_node(row(12, None))
+
+    assert cache.in_cache(10)
+    assert not cache.in_cache(11)
+    assert cache.in_cache(12)
+
+
+def test_undo_redo_edit(cache: TreeCache):
+    node = cache.get_node(2)
+    cache.edit_node(node, 'edited')
+
+    assert cache.undo()
+    assert (node.value, node.modified) == ('Node2', False)
+    assert cache.redo()
+    assert (node.value, node.modified) == ('edited', True)
+
+
+def test_undo_redo_edit_of_unsaved_node(cache: TreeCache):
+    node = cache.add_child_node(cache.get_node(5), 'new')
+    cache.edit_node(node, 'edited')
+
+    assert cache.undo()
+    assert node.value == 'new'
+    assert cache.redo()
+    assert node.value == 'edited'
+
+
+def test_undo_redo_add(cache: TreeCache):
+    parent = cache.get_node(5)
+    node = cache.add_child_node(parent, 'new')
+
+    assert cache.undo()
+    assert parent.children == []
+    assert cache.unsaved_count == 0
+    assert cache.redo()
+    assert parent.children == [node]
+    assert cache.unsaved_count == 1
+
+
+def test_undo_delete_restores_subtree(cache: TreeCache):
+    cache.edit_node(cache.get_node(3), 'edited')
+    cache.add_child_node(cache.get_node(4), 'new')
+    cache.delete_node(cache.get_node(2))
+
+    assert cache.undo()
+
+    assert not any(cache.get_node(node_id).deleted for node_id in (2, 3, 4))
+    assert cache.get_node(3).value == 'edited'
+    assert values(cache.get_node(4).children) == ['new']
+    assert cache.deleted_subtree_roots == set()
+    assert cache.pending_deleted == frozenset()
+    assert cache.redo()
+    assert cache.get_node(2).deleted
+    assert cache.get_node(4).children == []
+
+
+def test_new_edit_drops_redo(cache: TreeCache):
+    cache.edit_node(cache.get_node(2), 'edited')
+    cache.undo()
+
+    cache.edit_node(cache.get_node(3), 'other')
+
+    assert not cache.can_redo
+    assert not cache.redo()
+
+
+def test_reconcile_applies_versions_and_conflicts(cache: TreeCache):
+    cache.edit_node(cache.get_node(2), 'mine')
+    cache.edit_node(cache.get_node(3), 'mine too')
+    new = cache.add_child_node(cache.get_node(5), 'new')
+    cache.edit_node(cache.get_node(4), 'gone')
+    export(cache)
+
+    rejected = cache.reconcile({2: 1}, [
+        NodeConflict(3, CONFLICT_MODIFIED, 'theirs', 4),
+        NodeConflict(4, CONFLICT_DELETED, 'Node4', 2),
+        NodeConflict(new.id, CONFLICT_PARENT_DELETED, None, None),
+    ])
+
+    assert rejected == ['new']
+    assert cache.get_node(2).version == 1
+    assert (cache.get_node(3).value, cache.get_node(3).version) == (
+        'theirs', 4
+    )
+    assert cache.get_node(4).deleted
+    assert cache.get_node(5).children == []
+    assert cache.pending_deleted == frozenset()
+
+
+def test_null_value_text():
+    assert CacheNode(1).text() == NULL_TEXT
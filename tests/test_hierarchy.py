@@ -0,0 +1,60 @@
+import typing as t
+
+from treeview.hierarchy import build_hierarchy
+from treeview.hierarchy import group_by_parent
+from treeview.hierarchy import NodeLike
+from treeview.hierarchy import synthetic_tree
+from treeview.medium import SeedRow
+
+
+def ids(nodes: t.Iterable[NodeLike]) -> t.List[int]:
+    return [node.id for node in nodes]
+
+
+def test_group_by_parent_keeps_input_order():
+    rows = [SeedRow(3, 1, 'c'), SeedRow(2, 1, 'b'), SeedRow(4, 2, 'd')]
+
+    children = group_by_parent(rows)
+
+    assert ids(children[1]) == [3, 2]
+    assert ids(children[2]) == [4]
+    assert 3 not in children
+
+
+def test_build_hierarchy_places_parents_first():
+    rows = [
+        SeedRow(4, 3, 'd'), SeedRow(3, 1, 'c'),
+        SeedRow(2, 1, 'b'), SeedRow(1, None, 'a'),
+    ]
+
+    hierarchy = build_hierarchy(rows)
+
+    assert [
+        (parent_id, ids(batch)) for parent_id, batch in hierarchy.batches
+    ] == [(None, [1]), (1, [3, 2]), (3, [4])]
+    assert hierarchy.orphans == []
+
+
+def test_build_hierarchy_returns_unreachable_nodes_as_orphans():
+    rows = [
+        SeedRow(1, None, 'a'), SeedRow(2, 1, 'b'),
+        SeedRow(5, 9, 'dangling'), SeedRow(6, 7, 'x'), SeedRow(7, 6, 'y'),
+    ]
+
+    hierarchy = build_hierarchy(rows)
+
+    assert ids(
+        node for _, batch in hierarchy.batches for node in batch
+    ) == [1, 2]
+    assert sorted(ids(hierarchy.orphans)) == [5, 6, 7]
+
+
+def test_synthetic_tree_shape():
+    rows = list(synthetic_tree(fan_out=3, depth=3))
+
+    assert len(rows) == 1 + 3 + 9
+    assert rows[0] == SeedRow(1, None, 'Node1')
+    assert [row.parent_id for row in rows[1:4]] == [1, 1, 1]
+    assert {row.parent_id for row in rows[4:]} == {2, 3, 4}
+    assert ids(rows) == list(range(1, 14))
+    assert build_hierarchy(rows).orphans == []
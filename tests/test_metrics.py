@@ -0,0 +1,130 @@
+import json
+import typing as t
+from pathlib import Path
+
+import pytest
+
+from treeview.medium import SpanStats
+from treeview.metrics import METRICS
+from treeview.metrics import Metrics
+from treeview.metrics import timed
+
+
+@pytest.fixture
+def metrics() -> Metrics:
+    metrics = Metrics()
+    metrics.enable()
+    metrics.record('db.get_nodes', 0.5, 3)
+    metrics.record('db.get_nodes', 0.25, 2)
+    metrics.record('app.apply', 1.0)
+    metrics.count('db.round_trips')
+    metrics.count('db.round_trips', 2)
+    return metrics
+
+
+@pytest.fixture
+def global_metrics() -> t.Iterator[Metrics]:
+    METRICS.reset()
+    METRICS.enable()
+    yield METRICS
+    METRICS.enabled = False
+    METRICS.reset()
+
+
+@timed('test.rows')
+def rows(count: int) -> t.List[int]:
+    return list(range(count))
+
+
+@timed('test.fail')
+def fail() -> None:
+    raise RuntimeError
+
+
+def test_record_sums_spans(metrics: Metrics):
+    assert metrics.spans == {
+        'db.get_nodes': SpanStats(2, 0.75, 0.5, 5),
+        'app.apply': SpanStats(1, 1.0, 1.0, 0),
+    }
+    assert metrics.counters == {'db.round_trips': 3}
+
+
+def test_timed_records_calls_and_rows(global_metrics: Metrics):
+    assert rows(3) == [0, 1, 2]
+    rows(4)
+
+    span = global_metrics.spans['test.rows']
+    assert (span.calls, span.rows) == (2, 7)
+    assert 0 <= span.max_seconds <= span.seconds
+
+
+def test_timed_skips_failed_calls(global_metrics: Metrics):
+    with pytest.raises(RuntimeError):
+        fail()
+
+    assert 'test.fail' not in global_metrics.spans
+
+
+def test_timed_records_nothing_when_disabled(global_metrics: Metrics):
+    global_metrics.enabled = False
+
+    rows(3)
+
+    assert global_metrics.spans == {}
+
+
+def test_to_json(metrics: Metrics):
+    assert json.loads(metrics.to_json()) == {
+        'spans': {
+            'app.apply': {
+                'calls': 1, 'seconds': 1.0, 'max_seconds': 1.0, 'rows': 0,
+            },
+            'db.get_nodes': {
+                'calls': 2, 'seconds': 0.75, 'max_seconds': 0.5, 'rows': 5,
+            },
+        },
+        'counters': {'db.round_trips': 3},
+    }
+
+
+def test_to_prometheus(metrics: Metrics):
+    assert metrics.to_prometheus().splitlines() == [
+        '# HELP treeview_span_calls_total Calls of the operation',
+        '# TYPE treeview_span_calls_total counter',
+        'treeview_span_calls_total{span="app.apply"} 1',
+        'treeview_span_calls_total{span="db.get_nodes"} 2',
+        '# HELP treeview_span_seconds_total Time spent in the operation',
+        '# TYPE treeview_span_seconds_total counter',
+        'treeview_span_seconds_total{span="app.apply"} 1.0',
+        'treeview_span_seconds_total{span="db.get_nodes"} 0.75',
+        '# HELP treeview_span_max_seconds Longest call of the operation',
+        '# TYPE treeview_span_max_seconds gauge',
+        'treeview_span_max_seconds{span="app.apply"} 1.0',
+        'treeview_span_max_seconds{span="db.get_nodes"} 0.5',
+        '# HELP treeview_span_rows_total Rows handled by the operation',
+        '# TYPE treeview_span_rows_total counter',
+        'treeview_span_rows_total{span="app.apply"} 0',
+        'treeview_span_rows_total{span="db.get_nodes"} 5',
+        '# HELP treeview_count_total Amounts counted by name',
+        '# TYPE treeview_count_total counter',
+        'treeview_count_total{name="db.round_trips"} 3',
+    ]
+    assert metrics.to_prometheus().endswith('3\n')
+
+
+@pytest.mark.parametrize('metric_format', ['json', 'prometheus'])
+def test_dump(metrics: Metrics, tmp_path: Path, metric_format: str):
+    path = tmp_path / 'metrics'
+
+    metrics.dump(str(path), metric_format)
+
+    expected = (
+        metrics.to_json() if metric_format == 'json'
+        else metrics.to_prometheus()
+    )
+    assert path.read_text() == expected
+
+
+def test_dump_rejects_unknown_format(metrics: Metrics, tmp_path: Path):
+    with pytest.raises(ValueError):
+        metrics.dump(str(tmp_path / 'metrics'), 'xml')
@@ -0,0 +1,118 @@
+import typing as t
+
+import pytest
+
+from treeview.cache import CacheNode
+from treeview.cache import TreeCache
+from treeview.db import like_pattern
+from treeview.medium import DBNodeRow
+from treeview.search import ValueIndex
+
+
+def row(node_id: int, parent_id: t.Optional[int], value: str) -> DBNodeRow:
+    return DBNodeRow(node_id, parent_id, value, False, False)
+
+
+TREE = [
+    row(1, None, 'Apple pie'), row(2, 1, 'Pineapple'),
+    row(3, 2, 'Grape'), row(4, 1, 'Straße'),
+]
+
+
+def ids(nodes: t.Iterable[CacheNode]) -> t.List[t.Optional[int]]:
+    return sorted(node.id for node in nodes)
+
+
+@pytest.fixture
+def index() -> ValueIndex:
+    return ValueIndex()
+
+
+@pytest.fixture
+def cache(index: ValueIndex) -> TreeCache:
+    cache = TreeCache(listener=index)
+    cache.import_nodes(TREE)
+    return cache
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('apple', [1, 2]),
+    ('APPLE', [1, 2]),
+    ('e p', [1]),
+    ('ap', [1, 2, 3]),
+    ('e', [1, 2, 3, 4]),
+    ('STRASSE', [4]),
+    ('plum', []),
+])
+def test_search_matches_substrings_in_any_case(
+    cache: TreeCache,
+    index: ValueIndex,
+    text: str,
+    expected: t.List[int],
+):
+    assert ids(index.search(text)) == expected
+
+
+def test_edit_reindexes_node(cache: TreeCache, index: ValueIndex):
+    cache.edit_node(cache.get_node(3), 'Plum')
+
+    assert ids(index.search('grape')) == []
+    assert ids(index.search('plum')) == [3]
+
+    cache.undo()
+
+    assert ids(index.search('grape')) == [3]
+    assert ids(index.search('plum')) == []
+
+
+def test_add_and_delete_update_index(cache: TreeCache, index: ValueIndex):
+    node = cache.add_child_node(cache.get_node(3), 'Plum')
+
+    assert index.search('plum') == {node}
+    assert len(index) == len(TREE) + 1
+
+    cache.delete_node(node)
+
+    assert index.search('plum') == set()
+    assert len(index) == len(TREE)
+
+
+def test_removed_subtree_leaves_index(cache: TreeCache, index: ValueIndex):
+    node = cache.add_child_node(cache.get_node(3), 'Plum')
+    cache.add_child_node(node, 'Plum jam')
+
+    cache.undo()
+    cache.undo()
+
+    assert index.search('plum') == set()
+
+    cache.redo()
+    cache.redo()
+
+    assert sorted(node.value for node in index.search('plum')) == [
+        'Plum', 'Plum jam'
+    ]
+
+
+def test_rebuild_indexes_restored_cache(cache: TreeCache):
+    index = ValueIndex()
+    index.rebuild(cache)
+
+    assert len(index) == len(TREE)
+    assert ids(index.search('apple')) == [1, 2]
+
+    index.rebuild(TreeCache())
+
+    assert len(index) == 0
+    assert index.search('apple') == set()
+
+
+@pytest.mark.parametrize('text, pattern', [
+    ('abc', '%abc%'),
+    ('50%', '%50\\%%'),
+    ('a_b', '%a\\_b%'),
+    ('c:\\dir', '%c:\\\\dir%'),
+    ('\\%_', '%\\\\\\%\\_%'),
+])
+def test_like_pattern_escapes_wildcards(text: str, pattern: str):
+    assert like_pattern(text) == pattern
@@ -0,0 +1,155 @@
+import typing as t
+from pathlib import Path
+
+import pytest
+
+from treeview.cache import CacheNode
+from treeview.cache import TreeCache
+from treeview.medium import DBNodeRow
+from treeview.snapshot import CacheSnapshot
+
+
+def row(node_id: int, parent_id: t.Optional[int]) -> DBNodeRow:
+    return DBNodeRow(node_id, parent_id, f'Node{node_id}', False, False)
+
+
+# 1 -> 2 -> 3 -> 4, 1 -> 5, 7 waiting for its parent 6
+TREE = [row(1, None), row(2, 1), row(3, 2), row(4, 3), row(5, 1), row(7, 6)]
+
+
+def values(nodes: t.Iterable[CacheNode]) -> t.List[t.Optional[str]]:
+    return [node.value for node in nodes]
+
+
+@pytest.fixture
+def path(tmp_path: Path) -> str:
+    return str(tmp_path / 'snapshot.db')
+
+
+@pytest.fixture
+def snapshot(path: str) -> t.Iterator[CacheSnapshot]:
+    snapshot = CacheSnapshot(path)
+    yield snapshot
+    snapshot.close()
+
+
+@pytest.fixture
+def cache(snapshot: CacheSnapshot) -> TreeCache:
+    cache = TreeCache()
+    cache.add_listener(snapshot)
+    cache.import_nodes(TREE)
+    return cache
+
+
+def restored(path: str) -> TreeCache:
+    snapshot = CacheSnapshot(path)
+    cache = TreeCache()
+    snapshot.restore(cache)
+    snapshot.close()
+    return cache
+
+
+def test_round_trip_keeps_hierarchy(
+    path: str,
+    snapshot: CacheSnapshot,
+    cache: TreeCache,
+):
+    snapshot.flush(cache)
+
+    copy = restored(path)
+
+    assert values(copy.root.children) == ['Node1', 'Node7']
+    assert values(copy.get_node(1).children) == ['Node2', 'Node5']
+    assert values(copy.get_node(3).children) == ['Node4']
+    assert copy.node_count == len(TREE)
+    # Orphans still wait for their parent
+    copy.import_node(row(6, 1))
+    assert values(copy.get_node(6).children) == ['Node7']
+
+
+def test_round_trip_keeps_unsaved_and_modified(
+    path: str,
+    snapshot: CacheSnapshot,
+    cache: TreeCache,
+):
+    cache.edit_node(cache.get_node(2), 'edited')
+    child = cache.add_child_node(cache.get_node(4), 'child')
+    cache.add_child_node(child, 'grandchild')
+    snapshot.flush(cache)
+
+    copy = restored(path)
+
+    node = copy.get_node(2)
+    assert (node.value, node.modified, node.backup_value) == (
+        'edited', True, 'Node2'
+    )
+    assert copy.unsaved_count == 2
+    assert values(copy.get_node(4).children) == ['child']
+    assert values(copy.get_node(4).children[0].children) == ['grandchild']
+    exported = copy.export_changes(set(), lambda count: [100, 101][:count])
+    assert [node['value'] for node in exported.updates] == [
+        'edited', 'child', 'grandchild'
+    ]
+
+
+def test_round_trip_keeps_deleted_subtree_roots(
+    path: str,
+    snapshot: CacheSnapshot,
+    cache: TreeCache,
+):
+    cache.edit_node(cache.get_node(3), 'edited')
+    cache.delete_node(cache.get_node(2))
+    snapshot.flush(cache)
+
+    copy = restored(path)
+
+    assert [copy.get_node(node_id).deleted for node_id in (1, 2, 3, 4)] == [
+        False, True, True, True
+    ]
+    assert copy.get_node(3).value == 'Node3'
+    assert copy.deleted_subtree_roots == {2}
+    assert copy.pending_deleted == {2, 3, 4}
+
+
+def test_round_trip_follows_saved_ids(
+    path: str,
+    snapshot: CacheSnapshot,
+    cache: TreeCache,
+):
+    child = cache.add_child_node(cache.get_node(5), 'child')
+    removed = cache.add_child_node(cache.get_node(5), 'removed')
+    snapshot.flush(cache)
+    cache.delete_node(removed)
+    cache.commit_export(
+        cache.export_changes(set(), lambda count: [100][:count]), set()
+    )
+    snapshot.flush(cache)
+
+    copy = restored(path)
+
+    assert child.id == 100
+    assert values(copy.get_node(5).children) == ['child']
+    assert copy.get_node(100).parent is copy.get_node(5)
+    assert copy.unsaved_count == 0
+
+
+def test_clear_empties_snapshot(
+    path: str,
+    snapshot: CacheSnapshot,
+    cache: TreeCache,
+):
+    snapshot.flush(cache)
+
+    snapshot.clear()
+
+    assert restored(path).node_count == 0
+    # Cache started anew after a reset is written from scratch
+    cache = TreeCache()
+    cache.add_listener(snapshot)
+    cache.import_nodes([row(10, None)])
+    cache.add_child_node(cache.get_node(10), 'new')
+    snapshot.flush(cache)
+    copy = restored(path)
+    assert values(copy.root.children) == ['Node10']
+    assert values(copy.get_node(10).children) == ['new']
+    assert copy.deleted_subtree_roots == set()
@@ -0,0 +1,226 @@
+import typing as t
+from pathlib import Path
+
+import pytest
+
+from treeview.db import DBConfig
+from treeview.medium import CONFLICT_DELETED
+from treeview.medium import CONFLICT_MODIFIED
+from treeview.medium import CONFLICT_PARENT_DELETED
+from treeview.medium import DBLineageRow
+from treeview.medium import DBNodeChange
+from treeview.medium import DBNodeRow
+from treeview.medium import NodeConflict
+from treeview.medium import NodeUpdates
+from treeview.medium import SeedRow
+from treeview.sqlite import SQLiteTreeDBClient
+
+# 1 -> 2 -> 4 -> 6, 1 -> 3 -> 5, 7
+TREE = [
+    SeedRow(1, None, 'Node1'), SeedRow(2, 1, 'Node2'),
+    SeedRow(3, 1, 'Node3'), SeedRow(4, 2, 'Node4'),
+    SeedRow(5, 3, 'Node5'), SeedRow(6, 4, 'Node6'),
+    SeedRow(7, None, 'Node7'),
+]
+
+
+def connect(
+    path: Path,
+    **options: t.Any,  # NOQA: ANN401
+) -> SQLiteTreeDBClient:
+    return SQLiteTreeDBClient(
+        DBConfig('', '', '', 0, '', url=f'sqlite:///{path}', **options)
+    )
+
+
+@pytest.fixture
+def db(tmp_path: Path) -> t.Iterator[SQLiteTreeDBClient]:
+    db = connect(tmp_path / 'tree.db')
+    db.seed(TREE)
+    yield db
+    db.close()
+
+
+def edit(
+    db: SQLiteTreeDBClient,
+    node_id: int,
+    value: str,
+    version: int = 0,
+) -> None:
+    node = db.get_node(node_id)
+    with db.apply_transaction() as tx:
+        tx.upsert([NodeUpdates(
+            id=node_id, parent_id=node.parent_id, value=value,
+            version=version,
+        )])
+
+
+def test_seed_replaces_nodes(db: SQLiteTreeDBClient):
+    db.seed([SeedRow(10, None, 'a'), SeedRow(11, 10, None)])
+
+    assert db.get_children(None) == [DBNodeRow(10, None, 'a', False, True)]
+    assert db.get_children(10) == [DBNodeRow(11, 10, None, False, False)]
+    assert db.get_node(1) is None
+
+
+def test_get_children_pages_by_id(db: SQLiteTreeDBClient):
+    assert [row.id for row in db.get_children(None)] == [1, 7]
+    assert [row.has_children for row in db.get_children(None)] == [
+        True, False
+    ]
+    assert [row.id for row in db.get_children(1, limit=1)] == [2]
+    assert [row.id for row in db.get_children(1, after_id=2)] == [3]
+
+
+def test_get_lineage_adds_ancestors(db: SQLiteTreeDBClient):
+    assert db.get_lineage([6, 2]) == [
+        DBLineageRow(1, None, 'Node1', False, False),
+        DBLineageRow(2, 1, 'Node2', False, True),
+        DBLineageRow(4, 2, 'Node4', False, False),
+        DBLineageRow(6, 4, 'Node6', False, True),
+    ]
+
+
+def test_apply_writes_changes_and_bumps_versions(db: SQLiteTreeDBClient):
+    with db.apply_transaction() as tx:
+        deleted_ids = tx.soft_delete_subtree([3])
+        new_ids = tx.reserve_ids(2)
+        result = tx.upsert([
+            NodeUpdates(id=2, parent_id=1, value='edited', version=0),
+            NodeUpdates(id=new_ids[0], parent_id=6, value='new', version=None),
+            NodeUpdates(
+                id=new_ids[1], parent_id=new_ids[0], value='newer',
+                version=None,
+            ),
+        ])
+
+    assert sorted(deleted_ids) == [3, 5]
+    assert new_ids == [8, 9]
+    assert result.versions == {2: 1, 8: 0, 9: 0}
+    assert result.conflicts == []
+    assert db.get_node(2).value == 'edited'
+    assert [row.id for row in db.get_children(8)] == [9]
+    assert db.get_node(5).deleted
+
+
+def test_apply_reports_conflicts(db: SQLiteTreeDBClient):
+    edit(db, 4, 'theirs')
+    db.soft_delete_subtree([3])
+
+    with db.apply_transaction() as tx:
+        result = tx.upsert([
+            NodeUpdates(id=2, parent_id=1, value='mine', version=0),
+            NodeUpdates(id=4, parent_id=2, value='mine', version=0),
+            NodeUpdates(id=5, parent_id=3, value='mine', version=0),
+            NodeUpdates(id=8, parent_id=5, value='new', version=None),
+            NodeUpdates(id=9, parent_id=8, value='newer', version=None),
+        ])
+
+    assert result.versions == {2: 1}
+    assert sorted(result.conflicts) == [
+        NodeConflict(4, CONFLICT_MODIFIED, 'theirs', 1),
+        NodeConflict(5, CONFLICT_DELETED, 'Node5', 1),
+        NodeConflict(8, CONFLICT_PARENT_DELETED, None, None),
+        NodeConflict(9, CONFLICT_PARENT_DELETED, None, None),
+    ]
+    assert db.get_node(4).value == 'theirs'
+    assert db.get_node(8) is None
+
+
+def test_failed_apply_is_rolled_back(db: SQLiteTreeDBClient):
+    with pytest.raises(RuntimeError):
+        with db.apply_transaction() as tx:
+            tx.soft_delete_subtree([2])
+            raise RuntimeError
+
+    assert not db.get_node(2).deleted
+
+
+def test_search_matches_substrings_in_any_case(db: SQLiteTreeDBClient):
+    edit(db, 5, 'Hello World')
+    db.soft_delete_subtree([4])
+
+    # Trigram index for three characters and more, LIKE below that
+    for text in ('o wor', 'LO W', 'hello world'):
+        assert db.search(text) == [
+            DBLineageRow(1, None, 'Node1', False, False),
+            DBLineageRow(3, 1, 'Node3', False, False),
+            DBLineageRow(5, 3, 'Hello World', False, True, 1),
+        ]
+    assert [row.id for row in db.search('W')] == [1, 3, 5]
+    assert [row.id for row in db.search('node6')] == []
+    assert [
+        row.id for row in db.search('node', limit=2) if row.requested
+    ] == [1, 2]
+
+
+def test_search_takes_wildcards_literally(db: SQLiteTreeDBClient):
+    edit(db, 6, '50%_off')
+
+    assert [row.id for row in db.search('%') if row.requested] == [6]
+    assert [row.id for row in db.search('0%_') if row.requested] == [6]
+    assert db.search('e_') == []
+
+
+def test_change_feed_reads_committed_changes(db: SQLiteTreeDBClient):
+    watermark = db.changes_watermark()
+    edit(db, 2, 'edited')
+    db.soft_delete_subtree([4])
+
+    feed = db.get_changes(watermark)
+
+    assert feed.changes[0] == DBNodeChange(2, 1, 'edited', False)
+    assert sorted(feed.changes[1:]) == [
+        DBNodeChange(4, 2, 'Node4', True),
+        DBNodeChange(6, 4, 'Node6', True),
+    ]
+    assert db.get_changes(feed.watermark).changes == []
+    assert db.get_changes(feed.watermark).watermark == feed.watermark
+
+
+def test_change_feed_is_pruned(tmp_path: Path):
+    db = connect(tmp_path / 'tree.db', change_retention=1e-9)
+    db.seed(TREE)
+    watermark = db.changes_watermark()
+    edit(db, 2, 'edited')
+    feed = db.get_changes(watermark)
+    edit(db, 3, 'edited')
+    db.get_changes(feed.watermark)
+
+    # Changes before the first read watermark are kept
+    assert db.prune_changes() == 1
+    assert db.get_changes(watermark).changes == [
+        DBNodeChange(3, 1, 'edited', False)
+    ]
+    db.close()
+
+
+def test_iter_nodes_streams_parents_first(db: SQLiteTreeDBClient):
+    rows = list(db.iter_nodes(batch_size=2))
+
+    assert [row.id for row in rows] == [1, 7, 2, 3, 4, 5, 6]
+    assert [row.depth for row in rows] == [0, 0, 1, 1, 2, 2, 3]
+
+
+def test_iter_nodes_skips_deleted_below_given_roots(db: SQLiteTreeDBClient):
+    db.soft_delete_subtree([4])
+
+    assert [row.id for row in db.iter_nodes([2, 3])] == [2, 3, 5]
+    assert [row.id for row in db.iter_nodes([4])] == [4]
+
+
+def test_in_subtree(db: SQLiteTreeDBClient):
+    assert db.in_subtree(6, 1)
+    assert db.in_subtree(6, 2)
+    assert db.in_subtree(2, 2)
+    assert not db.in_subtree(5, 2)
+    assert not db.in_subtree(1, 6)
+
+
+def test_subtree_size(db: SQLiteTreeDBClient):
+    db.soft_delete_subtree([4])
+
+    assert db.subtree_size(1) == 6
+    assert db.subtree_size(1, live_only=True) == 4
+    assert db.subtree_size(4, live_only=True) == 0
+    assert db.subtree_size(7) == 1
@@ -1,56 +1,125 @@
+import time
 import typing as t
+from contextlib import closing
+from functools import partial
+from itertools import islice
 
+from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QCloseEvent
+from PyQt5.QtGui import QKeySequence
 from PyQt5.QtWidgets import QGridLayout
 from PyQt5.QtWidgets import QHBoxLayout
 from PyQt5.QtWidgets import QInputDialog
+from PyQt5.QtWidgets import QLineEdit
 from PyQt5.QtWidgets import QMainWindow
 from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtWidgets import QVBoxLayout
 from PyQt5.QtWidgets import QWidget
 
+from treeview.backends import connect
+from treeview.cache import CacheNode
+from treeview.cache import StoredNode
 from treeview.db import DBConfig
-from treeview.db import DEFAULT_TREE
-from treeview.db import TreeDBClient
+from treeview.db import DEFAULT_STREAM_BATCH_SIZE
+from treeview.medium import CacheConfig
+from treeview.medium import ChangeFeed
+from treeview.medium import CONFLICT_DELETED
+from treeview.medium import CONFLICT_MODIFIED
+from treeview.medium import DBLineageRow
+from treeview.medium import ExportedCache
+from treeview.medium import NodeConflict
+from treeview.medium import NodeUpdates
+from treeview.medium import UpsertResult
+from treeview.metrics import METRICS
+from treeview.metrics import timed
 from treeview.ui.buttons import NarrowButton
 from treeview.ui.buttons import WideButton
 from treeview.ui.modal import DBNodeDeletionMBox
 from treeview.ui.modal import ResetAllMBox
 from treeview.ui.modal import UnsavedNodeDeletionMBox
+from treeview.ui.progress import TaskProgress
+from treeview.ui.stats import StatsDock
 from treeview.views.trees import CachedTreeView
 from treeview.views.trees import DBTreeView
+from treeview.worker import DBTask
+from treeview.worker import DBWorker
+
+APPLY_STEPS = 4
+# Typing pause after which the database is searched
+SEARCH_DELAY_MS = 300
+CONFLICT_MESSAGES = {
+    CONFLICT_MODIFIED: 'changed by someone else, reloaded',
+    CONFLICT_DELETED: 'deleted by someone else',
+}
 
 
 class TreeDBViewApp(QMainWindow):
 
-    def __init__(self, conf: DBConfig):
+    def __init__(self, conf: DBConfig, cache_conf: CacheConfig):
         super().__init__()
         self.setWindowTitle('TreeDB')
         self.resize(500, 500)
         central_wdg = QWidget()
         self.setCentralWidget(central_wdg)
-        self.layout = QGridLayout(central_wdg)
+        self.grid_layout = QGridLayout(central_wdg)
         self.db_deletion_mbox = DBNodeDeletionMBox(self)
         self.cache_deletion_mbox = UnsavedNodeDeletionMBox(self)
         self.reset_mbox = ResetAllMBox(self)
-        self.db = TreeDBClient(conf)
-        self.db.reset_table()
+        self.db = connect(conf)
+        self.worker = DBWorker(self)
+        self._fetching: t.Set[int] = set()
+        # Change feed position, None until the views are loaded
+        self._watermark: t.Optional[int] = None
+        self._poll_timer = QTimer(self)
+        self._poll_timer.setInterval(int(conf.poll_interval * 1000))
+        self._poll_timer.timeout.connect(self._poll_changes)
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(SEARCH_DELAY_MS)
+        self._search_timer.timeout.connect(self._search_db)
+        # Text the database tree shows matches of, None for the whole tree
+        self._db_search: t.Optional[str] = None
 
-        self.cache_tree = CachedTreeView(index=len(DEFAULT_TREE))
+        self.cache_conf = cache_conf
+        self.cache_tree = CachedTreeView(cache_conf)
         self.db_tree = DBTreeView()
-        self.db_tree.load_data(DEFAULT_TREE)
+        self.db_tree.fetch_failed.connect(self._task_failed)
 
-        self.layout.addWidget(self.cache_tree, 0, 0)
-        get_node_btn = WideButton('<<<', self.node_to_cache)
-        self.layout.addWidget(get_node_btn, 0, 1)
-        self.layout.addWidget(self.db_tree, 0, 2)
+        self.grid_layout.addWidget(self.cache_tree, 0, 0)
+        fetch_layout = QVBoxLayout()
+        fetch_layout.addStretch()
+        fetch_layout.addWidget(WideButton('<<<', self.node_to_cache))
+        fetch_layout.addWidget(WideButton('<<<+', self.subtree_to_cache))
+        fetch_layout.addStretch()
+        self.grid_layout.addLayout(fetch_layout, 0, 1)
+        self.grid_layout.addWidget(self.db_tree, 0, 2)
         self._construct_lower_layout()
+        self._construct_search()
+        self._construct_progress()
+        if METRICS.enabled:
+            self._construct_stats()
+        # Restored cache is kept, the database is not reset under it
+        if self.cache_tree.restore_snapshot():
+            self._submit_resume()
+        else:
+            self._submit_reset()
+        self._show_cache_footprint()
+        if conf.change_feed and conf.poll_interval > 0:
+            self._poll_timer.start()
 
     def _construct_lower_layout(self):
         btn_layout = QHBoxLayout()
         cache_buttons = (
             NarrowButton('+', self.add_child_node),
             NarrowButton('-', self.remove_node),
-            NarrowButton('a', self.edit_node)
+            NarrowButton('a', self.edit_node),
+            NarrowButton('<', self.undo),
+            NarrowButton('>', self.redo),
         )
+        # Shortcuts of disabled buttons do not fire during an apply
+        cache_buttons[3].setShortcut(QKeySequence.Undo)
+        cache_buttons[4].setShortcut(QKeySequence.Redo)
         ops_buttons = (
             WideButton('Apply', self.apply_changes),
             WideButton('Reset', self.reset_all)
@@ -60,13 +129,91 @@ class TreeDBViewApp(QMainWindow):
         btn_layout.addSpacing(10)
         for b in ops_buttons:
             btn_layout.addWidget(b)
-        self.layout.addLayout(btn_layout, 1, 0)
+        self.grid_layout.addLayout(btn_layout, 1, 0)
+        # Cache can not change while its export is in flight
+        self._apply_locked = (*cache_buttons, ops_buttons[0])
+
+    def _construct_search(self):
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText('Search values')
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self._search_changed)
+        self.grid_layout.addWidget(self.search_edit, 2, 0, 1, 3)
+
+    def _construct_progress(self):
+        progress = TaskProgress(self.worker.cancel_all)
+        self.worker.progress.connect(progress.show_progress)
+        self.worker.queue_changed.connect(progress.show_queue)
+        self.statusBar().addPermanentWidget(progress)
+
+    def _construct_stats(self):
+        stats_dock = StatsDock(METRICS, self)
+        self.addDockWidget(Qt.RightDockWidgetArea, stats_dock)
+        view_menu = self.menuBar().addMenu('View')
+        view_menu.addAction(stats_dock.toggleViewAction())
+
+    def _set_apply_locked(self, locked: bool) -> None:
+        for widget in self._apply_locked:
+            widget.setDisabled(locked)
+
+    def _task_failed(self, exc: Exception) -> None:
+        QMessageBox.critical(
+            self,
+            'Database error',
+            f'{type(exc).__name__}: {exc}'
+        )
+
+    def closeEvent(  # NOQA: N802
+        self,
+        event: t.Optional[QCloseEvent],
+    ) -> None:
+        self._poll_timer.stop()
+        self._search_timer.stop()
+        self.worker.cancel_all()
+        self.worker.wait()
+        self.cache_tree.close_snapshot()
+        self.db.close()
+        super().closeEvent(event)
+
+    def _show_cache_footprint(self) -> None:
+        max_nodes = self.cache_conf.max_nodes
+        max_bytes = self.cache_conf.max_bytes
+        nodes = f'{self.cache_tree.node_count}'
+        if max_nodes is not None:
+            nodes += f'/{max_nodes}'
+        size = f'{self.cache_tree.footprint_bytes / 1024:.1f}'
+        if max_bytes is not None:
+            size += f'/{max_bytes / 1024:.1f}'
+        touched = (
+            f'cache {self.cache_tree.take_touched_rows()}, '
+            f'db {self.db_tree.take_touched_rows()}'
+        )
+        pool = self.db.pool_stats()
+        status_bar = self.statusBar()
+        if status_bar is None:
+            return
+        status_bar.showMessage(
+            f'Cache: {nodes} nodes, {size} KiB | Rows touched: {touched}'
+            f' | Pool: {pool.checkouts} checkouts,'
+            f' {pool.wait_seconds * 1000:.0f} ms waited'
+        )
 
     def _input_value_modal(self) -> t.Tuple[str, bool]:
         value, ok = QInputDialog.getText(
             self, 'Set value', 'Enter node value:'
         )
-        return value, ok
+        return value, bool(ok)
+
+    def _forbid_context(self, node: CacheNode, action: str) -> bool:
+        if node.context:
+            QMessageBox.warning(
+                self,
+                'Forbidden operation',
+                ('Cache node is a read-only ancestor.\n'
+                 'Fetch it to the cache first.\n'
+                 f'Can not {action}.')
+            )
+        return node.context
 
     def _stillborns_message(
         self,
@@ -81,16 +228,109 @@ class TreeDBViewApp(QMainWindow):
             text
         )
 
+    def _selected_to_fetch(self) -> t.Set[int]:
+        return {
+            item.saved_id() for item in self.db_tree.get_selected_nodes()
+            if not self.cache_tree.in_cache(item.saved_id())
+        }.difference(self._fetching)
+
     def node_to_cache(self) -> None:
-        selected_item = self.db_tree.get_selected_node()
-        if selected_item is None:
+        node_ids = self._selected_to_fetch()
+        if not node_ids:
             return
-        node = self.db.get_node(selected_item.id)
-        if node is None:
+        self._fetching.update(node_ids)
+        task = self.worker.submit(
+            'Fetching',
+            partial(self._fetch_nodes, node_ids),
+            self._import_fetched,
+            self._task_failed,
+        )
+        task.signals.finished.connect(
+            lambda: self._fetching.difference_update(node_ids)
+        )
+
+    def _fetch_nodes(
+        self,
+        node_ids: t.Set[int],
+        task: DBTask
+    ) -> t.Tuple[t.List[StoredNode], t.List[StoredNode]]:
+        context: t.List[StoredNode] = []
+        if self.cache_conf.fetch_ancestors:
+            nodes: t.List[StoredNode] = []
+            for row in self.db.get_lineage(node_ids):
+                (nodes if row.requested else context).append(row)
+        else:
+            nodes = self.db.get_nodes(node_ids)
+        missing_ids = node_ids.difference(node.id for node in nodes)
+        if missing_ids:
             raise IndexError(
-                f'Node with id {selected_item.id} not found in db'
+                f'Nodes with ids {sorted(missing_ids)} not found in db'
+            )
+        task.check_cancelled()
+        return nodes, context
+
+    @timed('app.import_fetched')
+    def _import_fetched(
+        self,
+        result: t.Tuple[t.List[StoredNode], t.List[StoredNode]]
+    ) -> None:
+        self._fetched(self.cache_tree.import_nodes(*result))
+
+    def subtree_to_cache(self) -> None:
+        root_ids = self._selected_to_fetch()
+        if not root_ids:
+            return
+        self._fetching.update(root_ids)
+        task = self.worker.submit(
+            'Fetching subtrees',
+            partial(self._stream_subtrees, root_ids),
+            self._fetched,
+            self._task_failed,
+        )
+        task.signals.finished.connect(
+            lambda: self._fetching.difference_update(root_ids)
+        )
+
+    def _stream_subtrees(
+        self,
+        root_ids: t.Set[int],
+        task: DBTask,
+    ) -> t.List[str]:
+        """Imports selected nodes with their live descendants
+
+        Rows are streamed parents first and imported batch by batch on
+        the GUI thread, so no more than a batch is held here at a time.
+        Roots lying in the subtree of another one are streamed with it.
+        """
+        roots = [
+            root_id for root_id in root_ids
+            if not any(
+                other_id != root_id and self.db.in_subtree(root_id, other_id)
+                for other_id in root_ids
             )
-        stillborns = self.cache_tree.import_node(node)
+        ]
+        total = sum(
+            self.db.subtree_size(root_id, live_only=True)
+            for root_id in roots
+        )
+        done = 0
+        stillborns = []
+        with closing(self.db.iter_nodes(roots)) as rows:
+            while True:
+                batch = list(islice(rows, DEFAULT_STREAM_BATCH_SIZE))
+                if not batch:
+                    break
+                task.check_cancelled()
+                stillborns.extend(task.call_in_gui(
+                    self.cache_tree.import_nodes, batch, (), False
+                ))
+                done += len(batch)
+                # Deleted roots are streamed but not counted
+                task.report_progress(done, max(done, total))
+        return stillborns
+
+    def _fetched(self, stillborns: t.List[str]) -> None:
+        self._show_cache_footprint()
         if stillborns:
             self._stillborns_message(
                 'Following unsaved nodes were deleted\n'
@@ -112,15 +352,19 @@ class TreeDBViewApp(QMainWindow):
                  'Can not add child.')
             )
             return
+        if self._forbid_context(selected_item, 'add child'):
+            return
         value, ok = self._input_value_modal()
         if ok:
             self.cache_tree.add_child_node(selected_item, value)
-            self.cache_tree.expandAll()
+            self._show_cache_footprint()
 
     def remove_node(self) -> None:
         selected_item = self.cache_tree.get_selected_node()
         if selected_item is None or selected_item.deleted:
             return
+        if self._forbid_context(selected_item, 'delete it'):
+            return
         if selected_item.in_database():
             if self.db_deletion_mbox.enabled():
                 if self.db_deletion_mbox.exec() != QMessageBox.Yes:
@@ -130,6 +374,7 @@ class TreeDBViewApp(QMainWindow):
                 if self.cache_deletion_mbox.exec() != QMessageBox.Yes:
                     return
         stillborns = self.cache_tree.delete_node(selected_item)
+        self._show_cache_footprint()
         if stillborns:
             self._stillborns_message(
                 'Following unsaved nodes were deleted\n'
@@ -150,31 +395,221 @@ class TreeDBViewApp(QMainWindow):
                  'Can not set new value.')
             )
             return
+        if self._forbid_context(selected_item, 'set new value'):
+            return
         value, ok = self._input_value_modal()
         if ok and value:
-            selected_item.set_data(value)
+            self.cache_tree.edit_node(selected_item, value)
+            self._show_cache_footprint()
+
+    def undo(self) -> None:
+        if self.cache_tree.undo():
+            self._show_cache_footprint()
+
+    def redo(self) -> None:
+        if self.cache_tree.redo():
+            self._show_cache_footprint()
 
     def apply_changes(self) -> None:
-        deleted_ids = self.db_tree.delete_subtrees(
-            self.cache_tree.deleted_subtree_roots
-        )
-        self.db.soft_delete(*deleted_ids)
-        saved_cache = self.cache_tree.save_cache_and_export_changes(deleted_ids)
-        self.db.update_table(saved_cache.updates)
-        self.db_tree.update_view(saved_cache.updates)
-        if saved_cache.stillborns:
+        self._set_apply_locked(True)
+        start = time.perf_counter()
+        task = self.worker.submit(
+            'Applying',
+            partial(
+                self._apply,
+                set(self.cache_tree.deleted_subtree_roots),
+                self.cache_tree.unsaved_count,
+            ),
+            self._applied,
+            self._task_failed,
+        )
+        task.signals.finished.connect(lambda: self._apply_finished(start))
+
+    def _apply_finished(self, start: float) -> None:
+        self._set_apply_locked(False)
+        # Whole apply as seen by the user, including time in the queue
+        if METRICS.enabled:
+            METRICS.record('app.apply', time.perf_counter() - start)
+
+    def _apply(
+        self,
+        deleted_roots: t.Set[int],
+        unsaved_count: int,
+        task: DBTask,
+    ) -> t.Tuple[t.Set[int], ExportedCache, UpsertResult]:
+        """Runs the apply transaction on the worker thread
+
+        The cache is exported on the GUI thread as is, its changes are
+        marked saved by `_applied` once the transaction is committed.
+        """
+        with self.db.apply_transaction() as tx:
+            deleted_ids = set(tx.soft_delete_subtree(deleted_roots))
+            task.report_progress(1, APPLY_STEPS)
+            # Stillborns may need less ids than reserved
+            new_ids = tx.reserve_ids(unsaved_count)
+            task.report_progress(2, APPLY_STEPS)
+            task.check_cancelled()
+            saved_cache = task.call_in_gui(
+                self.cache_tree.export_changes,
+                deleted_ids, lambda count: new_ids[:count]
+            )
+            task.report_progress(3, APPLY_STEPS)
+            upserted = tx.upsert(saved_cache.updates)
+        task.report_progress(APPLY_STEPS, APPLY_STEPS)
+        return deleted_ids, saved_cache, upserted
+
+    @timed('app.applied')
+    def _applied(
+        self,
+        result: t.Tuple[t.Set[int], ExportedCache, UpsertResult]
+    ) -> None:
+        deleted_ids, saved_cache, upserted = result
+        stillborns = self.cache_tree.commit_export(saved_cache, deleted_ids)
+        rejected = self.cache_tree.reconcile(*upserted)
+        deleted_ids.update(
+            conflict.id for conflict in upserted.conflicts
+            if conflict.reason == CONFLICT_DELETED
+        )
+        self.db_tree.mark_deleted(deleted_ids)
+        self.db_tree.update_view([
+            node for node in saved_cache.updates
+            if node['id'] in upserted.versions
+        ] + [
+            NodeUpdates(
+                id=conflict.id,
+                parent_id=None,
+                value=conflict.value,
+                version=conflict.version,
+            )
+            for conflict in upserted.conflicts
+            if conflict.reason == CONFLICT_MODIFIED
+        ])
+        self._show_cache_footprint()
+        if stillborns:
             self._stillborns_message(
                 'Following unsaved nodes were deleted\n'
                 "as it's orphaned descendants turned out\n"
                 'to be deleted',
-                saved_cache.stillborns
+                stillborns
             )
+        if upserted.conflicts:
+            self._conflicts_message(upserted.conflicts, rejected)
+
+    def _conflicts_message(
+        self,
+        conflicts: t.List[NodeConflict],
+        rejected: t.List[str],
+    ) -> None:
+        lines = [
+            f'Node {conflict.id}: {CONFLICT_MESSAGES[conflict.reason]}'
+            for conflict in conflicts
+            if conflict.reason in CONFLICT_MESSAGES
+        ]
+        lines.extend(
+            f'{value}: parent deleted by someone else' for value in rejected
+        )
+        text = '\n'.join(lines)
+        QMessageBox.warning(
+            self,
+            'Conflicting changes',
+            f'Following changes were not saved:\n\n{text}'
+        )
 
     def reset_all(self) -> None:
         if self.reset_mbox.enabled():
             if self.reset_mbox.exec() != QMessageBox.Yes:
                 return
-        self.cache_tree.reset_view()
-        self.db_tree.reset_view()
-        self.db_tree.load_data(DEFAULT_TREE)
+        self._submit_reset()
+
+    def _submit_reset(self) -> None:
+        self.worker.submit(
+            'Resetting',
+            self._reset,
+            self._reset_views,
+            self._task_failed,
+        )
+
+    def _reset(self, task: DBTask) -> int:
         self.db.reset_table()
+        # Taken before the view loads, so no change slips in between
+        return self.db.changes_watermark()
+
+    @timed('app.reset_views')
+    def _reset_views(self, watermark: int) -> None:
+        self.cache_tree.reset_view()
+        self._load_db_view(watermark)
+
+    def _submit_resume(self) -> None:
+        self.worker.submit(
+            'Connecting',
+            lambda task: self.db.changes_watermark(),
+            self._load_db_view,
+            self._task_failed,
+        )
+
+    def _load_db_view(self, watermark: int) -> None:
+        self._watermark = watermark
+        self.db_tree.set_source(self.db.get_children, self.worker)
+        self._db_search = None
+        self.search_edit.blockSignals(True)
+        self.search_edit.clear()
+        self.search_edit.blockSignals(False)
+        self._show_cache_footprint()
+
+    def _search_changed(self, text: str) -> None:
+        # Cache is filtered at once, the database once typing pauses
+        self.cache_tree.filter_nodes(text)
+        self._search_timer.start()
+
+    def _search_db(self) -> None:
+        if self._watermark is None:
+            return
+        text = self.search_edit.text()
+        if not text:
+            if self._db_search is not None:
+                self._db_search = None
+                self.db_tree.reset_view()
+            return
+        self.worker.submit(
+            'Searching',
+            lambda task: self.db.search(text),
+            partial(self._show_matches, text),
+            self._task_failed,
+        )
+
+    @timed('app.show_matches')
+    def _show_matches(self, text: str, rows: t.List[DBLineageRow]) -> None:
+        # Results of an outdated query are dropped
+        if text != self.search_edit.text():
+            return
+        self._db_search = text
+        self.db_tree.show_matches(rows)
+
+    def _poll_changes(self) -> None:
+        # Polls queue up behind nothing, so other tasks are never delayed
+        if self._watermark is None or not self.worker.idle:
+            return
+        self.worker.submit(
+            'Watching',
+            partial(self._read_changes, self._watermark),
+            self._changes_arrived,
+            self._poll_failed,
+            background=True,
+        )
+
+    def _read_changes(self, watermark: int, task: DBTask) -> ChangeFeed:
+        feed = self.db.get_changes(watermark)
+        self.db.prune_changes()
+        return feed
+
+    @timed('app.changes_arrived')
+    def _changes_arrived(self, feed: ChangeFeed) -> None:
+        self._watermark = feed.watermark
+        # Search results are static, the whole tree is fetched anew later
+        if feed.changes and self._db_search is None:
+            self.db_tree.apply_changes(feed.changes)
+            self._show_cache_footprint()
+
+    def _poll_failed(self, exc: Exception) -> None:
+        self._poll_timer.stop()
+        self._task_failed(exc)
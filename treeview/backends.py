@@ -0,0 +1,24 @@
+import typing as t
+
+from sqlalchemy.engine import make_url
+
+from .db import DBConfig
+from .db import TreeDBClient
+from .sqlite import SQLiteTreeDBClient
+
+BACKENDS: t.Dict[str, t.Type[TreeDBClient]] = {
+    'postgresql': TreeDBClient,
+    'sqlite': SQLiteTreeDBClient,
+}
+
+
+def connect(conf: DBConfig) -> TreeDBClient:
+    """Makes a client for the backend of the configured database URL"""
+    backend = conf.backend
+    if conf.url is not None:
+        backend = make_url(conf.url).get_backend_name()
+    try:
+        client_class = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'Unsupported database backend {backend!r}')
+    return client_class(conf)
@@ -0,0 +1,971 @@
+import sys
+import typing as t
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .hierarchy import group_by_parent
+from .medium import CacheConfig
+from .medium import CONFLICT_DELETED
+from .medium import CONFLICT_MODIFIED
+from .medium import CONFLICT_PARENT_DELETED
+from .medium import ExportedCache
+from .medium import NodeConflict
+from .medium import NodeUpdates
+from .metrics import METRICS
+from .metrics import timed
+
+DEFAULT_CACHE_CONFIG = CacheConfig()
+NULL_TEXT = '(no value)'
+# Rough size of a slotted node with its children list
+NODE_OVERHEAD_BYTES = 160
+
+
+class StoredNode(t.Protocol):
+    """Node row read from the database, a model or a named tuple"""
+
+    @property
+    def id(self) -> int:  # NOQA: A003
+        ...
+
+    @property
+    def parent_id(self) -> t.Optional[int]:
+        ...
+
+    @property
+    def value(self) -> t.Optional[str]:
+        ...
+
+    @property
+    def deleted(self) -> bool:
+        ...
+
+    @property
+    def version(self) -> int:
+        ...
+
+
+class CacheNode:
+    """Node of the local cache
+
+    `children` are ordered by id with unsaved nodes (`id` is None) in the
+    end in creation order. `backup_value` keeps the value to restore when
+    a modified node gets marked for deletion. Context nodes are ancestors
+    fetched along with requested nodes, they are read-only until fetched
+    on their own. `version` is the database version the value is based
+    on, None for unsaved nodes.
+    """
+
+    __slots__ = (
+        'id', 'parent_id', 'value', 'deleted', 'modified', 'context',
+        'backup_value', 'parent', 'children', 'accounted_bytes', 'version',
+    )
+
+    def __init__(
+        self,
+        node_id: t.Optional[int] = None,
+        parent_id: t.Optional[int] = None,
+        value: t.Optional[str] = None,
+        deleted: bool = False,
+        context: bool = False,
+        version: t.Optional[int] = None,
+    ):
+        self.id = node_id
+        self.parent_id = parent_id
+        self.value = value
+        self.deleted = deleted
+        self.modified = False
+        self.context = context
+        self.backup_value: t.Optional[str] = None
+        self.parent: t.Optional['CacheNode'] = None
+        self.children: t.List['CacheNode'] = []
+        self.accounted_bytes = 0
+        self.version = version
+
+    def __repr__(self) -> str:
+        return f'Node(id: {self.id}, data: {self.value})'
+
+    def in_database(self) -> bool:
+        return self.id is not None
+
+    def text(self) -> str:
+        return self.value or NULL_TEXT
+
+    def footprint(self) -> int:
+        return NODE_OVERHEAD_BYTES + sys.getsizeof(self.value)
+
+    def saved_id(self) -> int:
+        """Returns the id of a node known to be in the database"""
+        if self.id is None:
+            raise ValueError(f'{self} is not saved')
+        return self.id
+
+    def attached_parent(self) -> 'CacheNode':
+        """Returns the parent of a node known to be in the cache"""
+        if self.parent is None:
+            raise ValueError(f'{self} is detached')
+        return self.parent
+
+    def to_dict(self) -> NodeUpdates:
+        # Only top-level nodes, children of the id-less root, lack a parent
+        if self.id is None or self.parent_id is None and (
+            self.parent is not None and self.parent.in_database()
+        ):
+            raise ValueError('Node has wrong id values')
+        return NodeUpdates(
+            id=self.id,
+            parent_id=self.parent_id,
+            value=self.value,
+            version=self.version,
+        )
+
+    @classmethod
+    def from_db_model(
+        cls,
+        node: StoredNode,
+        context: bool = False
+    ) -> 'CacheNode':
+        return cls(
+            node.id,
+            node.parent_id,
+            node.value,
+            node.deleted,
+            context,
+            node.version,
+        )
+
+
+class CacheListener:
+    """Observer of structural and state changes of a TreeCache
+
+    Each structural change is reported by a `begin_*` call made before
+    the children lists are touched and an `end_*` call made after, so Qt
+    models can forward them as is. Bulk operations are wrapped into
+    `begin_batch`/`end_batch`, so state changes within them can be
+    reported at once. Does nothing by default.
+    """
+
+    def begin_batch(self) -> None:
+        pass
+
+    def end_batch(self) -> None:
+        pass
+
+    def begin_insert(self, parent: CacheNode, row: int) -> None:
+        pass
+
+    def end_insert(self) -> None:
+        pass
+
+    def begin_remove(self, parent: CacheNode, row: int) -> None:
+        pass
+
+    def end_remove(self) -> None:
+        pass
+
+    def begin_move(
+        self,
+        source: CacheNode,
+        source_row: int,
+        target: CacheNode,
+        target_row: int,
+    ) -> None:
+        pass
+
+    def end_move(self) -> None:
+        pass
+
+    def node_changed(self, node: CacheNode) -> None:
+        pass
+
+
+class ListenerGroup(CacheListener):
+    """Forwards notifications to several listeners in order"""
+
+    def __init__(self, listeners: t.Iterable[CacheListener]):
+        self.listeners = list(listeners)
+
+    def begin_batch(self) -> None:
+        for listener in self.listeners:
+            listener.begin_batch()
+
+    def end_batch(self) -> None:
+        for listener in self.listeners:
+            listener.end_batch()
+
+    def begin_insert(self, parent: CacheNode, row: int) -> None:
+        for listener in self.listeners:
+            listener.begin_insert(parent, row)
+
+    def end_insert(self) -> None:
+        for listener in self.listeners:
+            listener.end_insert()
+
+    def begin_remove(self, parent: CacheNode, row: int) -> None:
+        for listener in self.listeners:
+            listener.begin_remove(parent, row)
+
+    def end_remove(self) -> None:
+        for listener in self.listeners:
+            listener.end_remove()
+
+    def begin_move(
+        self,
+        source: CacheNode,
+        source_row: int,
+        target: CacheNode,
+        target_row: int,
+    ) -> None:
+        for listener in self.listeners:
+            listener.begin_move(source, source_row, target, target_row)
+
+    def end_move(self) -> None:
+        for listener in self.listeners:
+            listener.end_move()
+
+    def node_changed(self, node: CacheNode) -> None:
+        for listener in self.listeners:
+            listener.node_changed(node)
+
+
+class EditOperation(t.NamedTuple):
+    node: CacheNode
+    value: t.Optional[str]
+    modified: bool
+    backup_value: t.Optional[str]
+    new_value: str
+
+
+class AddOperation(t.NamedTuple):
+    parent: CacheNode
+    node: CacheNode
+
+
+class DeleteOperation(t.NamedTuple):
+    node: CacheNode
+    # Nodes marked for deletion with their previous value and modified flag
+    marked: t.List[t.Tuple[CacheNode, t.Optional[str], bool]]
+    # Unsaved subtrees dropped with their parent and the number of
+    # siblings after them, in removal order
+    dropped: t.List[t.Tuple[CacheNode, int, CacheNode]]
+    # Deleted subtree roots absorbed by the deleted subtree
+    absorbed_roots: t.List[int]
+
+
+Operation = t.Union[EditOperation, AddOperation, DeleteOperation]
+
+
+class TreeCache:
+    """Local cache of database nodes free of any GUI dependency
+
+    Top-level nodes are children of the invisible `root`. Nodes imported
+    without their parent stay on top level until the parent shows up.
+
+    User edits are journaled until the next export, so they can be
+    undone and redone. The journal is not replayed on export: the cache
+    state already is its coalesced form, a node keeps one value however
+    many times it was edited, deleted nodes drop their edits and unsaved
+    nodes removed again are gone.
+    """
+
+    def __init__(
+        self,
+        config: CacheConfig = DEFAULT_CACHE_CONFIG,
+        listener: t.Optional[CacheListener] = None,
+    ):
+        self._config = config
+        self._listener = (
+            CacheListener() if listener is None else listener
+        )
+        self.root = CacheNode()
+        self.footprint_bytes = 0
+        self.deleted_subtree_roots: t.Set[int] = set()
+        self._nodes: t.Dict[int, CacheNode] = {}
+        self._lru: t.OrderedDict[int, CacheNode] = OrderedDict()
+        self._pending_deleted: t.Set[int] = set()
+        self._orphans: t.Dict[int, t.List[CacheNode]] = {}
+        self._top_level: t.Dict[int, CacheNode] = {}
+        self._modified: t.Dict[int, CacheNode] = {}
+        # Unsaved nodes keyed by id() in creation order
+        self._unsaved: t.Dict[int, CacheNode] = {}
+        self._journal: t.List[Operation] = []
+        self._undone: t.List[Operation] = []
+
+    def add_listener(self, listener: CacheListener) -> None:
+        if not isinstance(self._listener, ListenerGroup):
+            self._listener = ListenerGroup([self._listener])
+        self._listener.listeners.append(listener)
+
+    @property
+    def node_count(self) -> int:
+        return len(self._nodes) + len(self._unsaved)
+
+    @property
+    def pending_deleted(self) -> t.FrozenSet[int]:
+        """Ids of nodes marked for deletion since the last export"""
+        return frozenset(self._pending_deleted)
+
+    @property
+    def unsaved_count(self) -> int:
+        return len(self._unsaved)
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._journal)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._undone)
+
+    def in_cache(self, node_id: int) -> bool:
+        """Tells whether a node was fetched, context nodes were not"""
+        node = self._nodes.get(node_id)
+        return node is not None and not node.context
+
+    def get_node(self, node_id: int) -> t.Optional[CacheNode]:
+        return self._nodes.get(node_id)
+
+    @classmethod
+    def row_of(cls, node: CacheNode) -> int:
+        parent = node.attached_parent()
+        children = parent.children
+        if node.id is not None:
+            row = cls._imported_row(parent, node.id) - 1
+            if 0 <= row < len(children) and children[row] is node:
+                return row
+        return children.index(node)
+
+    @staticmethod
+    def iter_subtree(subtree_root: CacheNode) -> t.Iterator[CacheNode]:
+        """Yields subtree nodes in pre-order without recursion"""
+        stack = [subtree_root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    @contextmanager
+    def _batch(self) -> t.Iterator[None]:
+        self._listener.begin_batch()
+        try:
+            yield
+        finally:
+            self._listener.end_batch()
+
+    def _insert_child(
+        self,
+        parent: CacheNode,
+        row: int,
+        node: CacheNode
+    ) -> None:
+        self._listener.begin_insert(parent, row)
+        parent.children.insert(row, node)
+        node.parent = parent
+        self._listener.end_insert()
+
+    def _remove_child(self, node: CacheNode) -> None:
+        parent = node.attached_parent()
+        row = self.row_of(node)
+        self._listener.begin_remove(parent, row)
+        del parent.children[row]
+        node.parent = None
+        self._listener.end_remove()
+
+    def _move_child(
+        self,
+        node: CacheNode,
+        target: CacheNode,
+        target_row: int
+    ) -> None:
+        source = node.attached_parent()
+        source_row = self.row_of(node)
+        self._listener.begin_move(source, source_row, target, target_row)
+        del source.children[source_row]
+        target.children.insert(target_row, node)
+        node.parent = target
+        self._listener.end_move()
+
+    @staticmethod
+    def _imported_row(parent: CacheNode, node_id: int) -> int:
+        # Children are ordered by id with unsaved ones in the end
+        children = parent.children
+        low, high = 0, len(children)
+        while low < high:
+            middle = (low + high) // 2
+            child_id = children[middle].id
+            if child_id is None or child_id > node_id:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _set_deleted(self, node: CacheNode) -> None:
+        if node.deleted:
+            return
+        if node.modified:
+            node.value = node.backup_value
+            node.modified = False
+        node.deleted = True
+        self._listener.node_changed(node)
+
+    def _account(self, node: CacheNode) -> None:
+        footprint = node.footprint()
+        self.footprint_bytes += footprint - node.accounted_bytes
+        node.accounted_bytes = footprint
+
+    def _forget(self, node: CacheNode) -> None:
+        self.footprint_bytes -= node.accounted_bytes
+        self._unsaved.pop(id(node), None)
+        if node.id is not None:
+            self._nodes.pop(node.id, None)
+            self._lru.pop(node.id, None)
+
+    def _remember_unsaved(self, subtree_root: CacheNode) -> None:
+        for node in self.iter_subtree(subtree_root):
+            self.footprint_bytes += node.accounted_bytes
+            self._unsaved[id(node)] = node
+
+    def touch(self, node: CacheNode) -> None:
+        """Marks a node as the most recently used one"""
+        if node.id is not None:
+            self._lru[node.id] = node
+            self._lru.move_to_end(node.id)
+
+    def _over_capacity(self) -> bool:
+        max_nodes = self._config.max_nodes
+        max_bytes = self._config.max_bytes
+        if max_nodes is not None and self.node_count > max_nodes:
+            return True
+        return max_bytes is not None and self.footprint_bytes > max_bytes
+
+    def _is_clean_subtree(self, subtree_root: CacheNode) -> bool:
+        for node in self.iter_subtree(subtree_root):
+            if not node.in_database() or node.modified:
+                return False
+            if node.id in self._pending_deleted:
+                return False
+        return True
+
+    def _evict_subtree(self, subtree_root: CacheNode) -> None:
+        if subtree_root.parent is self.root:
+            del self._top_level[subtree_root.saved_id()]
+            parent_id = subtree_root.parent_id
+            if parent_id is not None and parent_id in self._orphans:
+                waiting = self._orphans[parent_id]
+                waiting.remove(subtree_root)
+                if not waiting:
+                    del self._orphans[parent_id]
+        for node in self.iter_subtree(subtree_root):
+            self._forget(node)
+        self._remove_child(subtree_root)
+
+    @timed('cache.evict')
+    def _evict(self) -> None:
+        """Drops least recently used clean subtrees to fit the capacity
+
+        Modified, unsaved and pending deletion nodes are never evicted,
+        evicted nodes can be fetched from the database again.
+        """
+        attempts = len(self._lru)
+        while attempts and self._over_capacity():
+            attempts -= 1
+            node_id, node = self._lru.popitem(last=False)
+            if self._is_clean_subtree(node):
+                self._evict_subtree(node)
+            else:
+                self._lru[node_id] = node
+
+    @timed('cache.reparent')
+    def _reparent_orphaned(
+        self,
+        nodes: t.Dict[int, CacheNode]
+    ) -> t.List[str]:
+        stillborns = []
+        for node_id, node in nodes.items():
+            for orphan in self._orphans.pop(node_id, ()):
+                orphan_id = orphan.saved_id()
+                if node.deleted:
+                    # Deletions merged by the import can not be undone
+                    self.clear_journal()
+                    if orphan.deleted:
+                        self.deleted_subtree_roots.discard(orphan_id)
+                    else:
+                        stillborns.extend(
+                            self._mark_subtree_for_delete(orphan)
+                        )
+                del self._top_level[orphan_id]
+                self._move_child(
+                    orphan, node, self._imported_row(node, orphan_id)
+                )
+
+        return stillborns
+
+    def _mark_subtree_for_delete(
+        self,
+        subtree_root: CacheNode,
+        operation: t.Optional[DeleteOperation] = None,
+    ) -> t.List[str]:
+        stillborns = []
+        stack = [subtree_root]
+        while stack:
+            node = stack.pop()
+            if operation is not None:
+                operation.marked.append((node, node.value, node.modified))
+            self._set_deleted(node)
+            self._pending_deleted.add(node.saved_id())
+            self._account(node)
+            for child in reversed(node.children):
+                if child.deleted:
+                    child_id = child.saved_id()
+                    absorbed = child_id in self.deleted_subtree_roots
+                    if operation is not None and absorbed:
+                        operation.absorbed_roots.append(child_id)
+                    self.deleted_subtree_roots.discard(child_id)
+                elif not child.in_database():
+                    for stillborn in self.iter_subtree(child):
+                        stillborns.append(stillborn.text())
+                        self._forget(stillborn)
+                    if operation is not None:
+                        operation.dropped.append(
+                            (node, self._siblings_after(child), child)
+                        )
+                    self._remove_child(child)
+                else:
+                    stack.append(child)
+
+        return stillborns
+
+    def _place_imported(self, node: CacheNode) -> None:
+        node_id = node.saved_id()
+        parent = self.root
+        if node.parent_id in self._nodes:
+            parent = self._nodes[node.parent_id]
+            if parent.deleted and not node.deleted:
+                node.deleted = True
+                self._pending_deleted.add(node_id)
+        elif node.parent_id is not None:
+            self._orphans.setdefault(node.parent_id, []).append(node)
+        if parent is self.root:
+            self._top_level[node_id] = node
+        self._insert_child(parent, self._imported_row(parent, node_id), node)
+        self._account(node)
+        self.touch(node)
+
+    def import_node(self, node: StoredNode) -> t.Optional[t.List[str]]:
+        if self.in_cache(node.id):
+            return None
+        return self.import_nodes([node])
+
+    def _promote(self, node: CacheNode, stored: StoredNode) -> None:
+        node.context = False
+        node.value = stored.value
+        node.version = stored.version
+        self._listener.node_changed(node)
+        self._account(node)
+        self.touch(node)
+
+    @timed('cache.import')
+    def import_nodes(
+        self,
+        nodes: t.Iterable[StoredNode],
+        context: t.Iterable[StoredNode] = (),
+    ) -> t.List[str]:
+        """Merges a batch of database nodes into the cache hierarchy
+
+        Nodes of the batch are placed parents first, so the deletion
+        state propagates through the batch, and top-level orphans are
+        scanned once for the whole batch. `context` nodes are placed as
+        read-only ones, requested nodes already cached as context become
+        regular ones.
+        """
+        imported: t.Dict[int, CacheNode] = {}
+        with self._batch():
+            for node in nodes:
+                cached = self._nodes.get(node.id)
+                if cached is None:
+                    imported[node.id] = CacheNode.from_db_model(node)
+                elif cached.context:
+                    self._promote(cached, node)
+        for node in context:
+            if node.id not in self._nodes and node.id not in imported:
+                imported[node.id] = CacheNode.from_db_model(node, True)
+        if not imported:
+            return []
+        self._nodes.update(imported)
+        children = group_by_parent(imported.values())
+        queue = [
+            node
+            for parent_id, batch in children.items()
+            if parent_id not in imported
+            for node in batch
+        ]
+        with self._batch():
+            for placed in queue:
+                self._place_imported(placed)
+                queue.extend(children.get(placed.id, ()))
+            stillborns = self._reparent_orphaned(imported)
+            self._evict()
+
+        return stillborns
+
+    def add_child_node(self, parent: CacheNode, data: str) -> CacheNode:
+        node = CacheNode(value=data or None)
+        self._insert_child(parent, len(parent.children), node)
+        self._unsaved[id(node)] = node
+        self._account(node)
+        self.touch(parent)
+        self._record(AddOperation(parent, node))
+        self._evict()
+        return node
+
+    def edit_node(self, node: CacheNode, data: str) -> None:
+        self._record(EditOperation(
+            node, node.value, node.modified, node.backup_value, data
+        ))
+        self._edit(node, data)
+        self._evict()
+
+    def _edit(self, node: CacheNode, data: str) -> None:
+        if node.in_database():
+            if not node.modified:
+                # Keeps the stored value however many edits follow
+                node.backup_value = node.value
+                node.modified = True
+                self._modified[node.saved_id()] = node
+            elif data == node.backup_value:
+                # Edited back to the stored value, nothing to apply
+                node.modified = False
+                node.backup_value = None
+        node.value = data
+        self._listener.node_changed(node)
+        self._account(node)
+        self.touch(node)
+
+    def delete_node(self, node: CacheNode) -> t.Optional[t.List[str]]:
+        operation = DeleteOperation(node, [], [], [])
+        stillborns = self._delete(operation)
+        self._record(operation)
+        return stillborns
+
+    def _delete(self, operation: DeleteOperation) -> t.Optional[t.List[str]]:
+        node = operation.node
+        if node.id is not None:
+            with self._batch():
+                stillborns = self._mark_subtree_for_delete(node, operation)
+            self.deleted_subtree_roots.add(node.id)
+
+            return stillborns
+        else:
+            for unsaved in self.iter_subtree(node):
+                self._forget(unsaved)
+            operation.dropped.append(
+                (node.attached_parent(), self._siblings_after(node), node)
+            )
+            self._remove_child(node)
+            return None
+
+    @classmethod
+    def _siblings_after(cls, node: CacheNode) -> int:
+        # Unsaved nodes are the last children, imports only go before them
+        return len(node.attached_parent().children) - cls.row_of(node) - 1
+
+    def _record(self, operation: Operation) -> None:
+        self._journal.append(operation)
+        self._undone = []
+
+    def clear_journal(self) -> None:
+        self._journal = []
+        self._undone = []
+
+    def _attached(self, operation: Operation) -> bool:
+        """Tells whether the node an operation works on is still cached"""
+        if isinstance(operation, AddOperation):
+            node = operation.parent
+        elif isinstance(operation, EditOperation) or (
+            operation.node.in_database()
+        ):
+            node = operation.node
+        else:
+            # Deleted unsaved node is detached, its parent is not
+            node = operation.dropped[0][0]
+        while node is not self.root:
+            if node.parent is None:
+                return False
+            node = node.parent
+        return True
+
+    @timed('cache.undo')
+    def undo(self) -> bool:
+        """Reverts the last journaled edit
+
+        Returns False if there is nothing to undo, or the journal was
+        dropped as its nodes have left the cache.
+        """
+        if not self._journal:
+            return False
+        operation = self._journal.pop()
+        if not self._attached(operation):
+            self.clear_journal()
+            return False
+        with self._batch():
+            if isinstance(operation, EditOperation):
+                self._undo_edit(operation)
+            elif isinstance(operation, AddOperation):
+                self._undo_add(operation)
+            else:
+                self._undo_delete(operation)
+        self._undone.append(operation)
+        return True
+
+    @timed('cache.redo')
+    def redo(self) -> bool:
+        """Repeats the last undone edit
+
+        Returns False if there is nothing to redo, or the undone edits
+        were dropped as their nodes have left the cache.
+        """
+        if not self._undone:
+            return False
+        operation = self._undone.pop()
+        if not self._attached(operation):
+            self._undone = []
+            return False
+        if isinstance(operation, EditOperation):
+            self._edit(operation.node, operation.new_value)
+        elif isinstance(operation, AddOperation):
+            parent = operation.parent
+            self._insert_child(parent, len(parent.children), operation.node)
+            self._remember_unsaved(operation.node)
+        else:
+            operation = DeleteOperation(operation.node, [], [], [])
+            self._delete(operation)
+        self._journal.append(operation)
+        self._evict()
+        return True
+
+    def _undo_edit(self, operation: EditOperation) -> None:
+        node = operation.node
+        node.value = operation.value
+        node.modified = operation.modified
+        node.backup_value = operation.backup_value
+        self._listener.node_changed(node)
+        self._account(node)
+
+    def _undo_add(self, operation: AddOperation) -> None:
+        for unsaved in self.iter_subtree(operation.node):
+            self._forget(unsaved)
+        self._remove_child(operation.node)
+
+    def _undo_delete(self, operation: DeleteOperation) -> None:
+        for parent, siblings_after, node in reversed(operation.dropped):
+            self._insert_child(
+                parent, len(parent.children) - siblings_after, node
+            )
+            self._remember_unsaved(node)
+        if not operation.node.in_database():
+            return
+        marked = {
+            id(node): (value, modified)
+            for node, value, modified in operation.marked
+        }
+        absorbed = set(operation.absorbed_roots)
+        # Nodes imported under the deleted subtree since are restored too
+        stack = [operation.node]
+        while stack:
+            node = stack.pop()
+            if id(node) in marked:
+                node.value, node.modified = marked[id(node)]
+            node.deleted = False
+            self._pending_deleted.discard(node.saved_id())
+            self._listener.node_changed(node)
+            self._account(node)
+            stack.extend(
+                child for child in node.children
+                if child.deleted and child.id not in absorbed and (
+                    child.id in self._pending_deleted
+                )
+            )
+        self.deleted_subtree_roots.discard(operation.node.saved_id())
+        self.deleted_subtree_roots.update(absorbed)
+
+    def _deleted_orphans(self, deleted_ids: t.Set[int]) -> t.List[CacheNode]:
+        if len(deleted_ids) < len(self._top_level):
+            orphaned_ids = deleted_ids.intersection(self._top_level)
+        else:
+            orphaned_ids = set(self._top_level).intersection(deleted_ids)
+        return [
+            self._top_level[node_id]
+            for node_id in sorted(orphaned_ids, reverse=True)
+            if not self._top_level[node_id].deleted
+        ]
+
+    def _update_deleted_orphans(self, deleted_ids: t.Set[int]) -> t.List[str]:
+        stillborns = []
+
+        for top_node in self._deleted_orphans(deleted_ids):
+            stillborns.extend(self._mark_subtree_for_delete(top_node))
+
+        return stillborns
+
+    @timed('cache.export')
+    def export_changes(
+        self,
+        deleted_ids: t.Set[int],
+        reserve_ids: t.Callable[[int], t.List[int]],
+    ) -> ExportedCache:
+        """Exports only the changes recorded since the previous export
+
+        Modified nodes go first, then unsaved ones in creation order, so
+        every new node gets its id after its parent. Ids for all new nodes
+        are requested with a single `reserve_ids` call. Nodes of orphaned
+        subtrees in `deleted_ids` are left out.
+
+        The cache is left as is, so a failed apply loses nothing. Changes
+        are marked saved by `commit_export` once they are committed.
+        """
+        dropped = {
+            id(node)
+            for top_node in self._deleted_orphans(deleted_ids)
+            for node in self.iter_subtree(top_node)
+        }
+        updates = [
+            node.to_dict()
+            for node in self._modified.values()
+            if node.modified and not node.deleted and id(node) not in dropped
+        ]
+        # Unsaved nodes are keyed by id() as the dropped ones
+        unsaved = [key for key in self._unsaved if key not in dropped]
+        new_ids = reserve_ids(len(unsaved))
+        assigned = dict(zip(unsaved, new_ids))
+        for key, new_id in zip(unsaved, new_ids):
+            node = self._unsaved[key]
+            parent_id = node.attached_parent().id
+            if parent_id is None:
+                parent_id = assigned[id(node.parent)]
+            updates.append(NodeUpdates(
+                id=new_id,
+                parent_id=parent_id,
+                value=node.value,
+                version=None,
+            ))
+        if METRICS.enabled:
+            METRICS.count('cache.exported_rows', len(updates))
+
+        return ExportedCache(
+            updates=updates,
+            new_ids=list(new_ids[:len(unsaved)]),
+        )
+
+    def commit_export(
+        self,
+        exported: ExportedCache,
+        deleted_ids: t.Set[int],
+    ) -> t.List[str]:
+        """Marks changes of a committed export saved
+
+        New nodes take the ids they were exported with, orphaned subtrees
+        in `deleted_ids` are marked for deletion. Returns values of the
+        unsaved nodes dropped with them.
+        """
+        with self._batch():
+            stillborns = self._update_deleted_orphans(deleted_ids)
+
+            for node in self._modified.values():
+                if node.modified and not node.deleted:
+                    node.modified = False
+                    self._listener.node_changed(node)
+            for node, new_id in zip(self._unsaved.values(), exported.new_ids):
+                node.id = new_id
+                node.parent_id = node.attached_parent().id
+                self._nodes[new_id] = node
+                self.touch(node)
+                self._listener.node_changed(node)
+        self._modified = {}
+        self._unsaved = {}
+        self._pending_deleted = set()
+        self.deleted_subtree_roots = set()
+        self.clear_journal()
+
+        return stillborns
+
+    @timed('cache.reconcile')
+    def reconcile(
+        self,
+        versions: t.Dict[int, int],
+        conflicts: t.List[NodeConflict],
+    ) -> t.List[str]:
+        """Brings exported nodes in line with what the database accepted
+
+        Saved nodes get their new versions. Nodes changed by someone else
+        take the database value, deleted ones are marked for deletion, and
+        new nodes rejected with their deleted parent are dropped.
+        """
+        stillborns = []
+        with self._batch():
+            for node_id, version in versions.items():
+                node = self._nodes.get(node_id)
+                if node is not None:
+                    node.version = version
+            rejected = {
+                conflict.id for conflict in conflicts
+                if conflict.reason == CONFLICT_PARENT_DELETED
+            }
+            deleted_parents = []
+            for node_id in sorted(rejected):
+                node = self._nodes.get(node_id)
+                if node is None or node.parent_id in rejected:
+                    continue
+                for stillborn in self.iter_subtree(node):
+                    stillborns.append(stillborn.text())
+                    self._forget(stillborn)
+                deleted_parents.append(node.attached_parent())
+                self._remove_child(node)
+            for conflict in conflicts:
+                node = self._nodes.get(conflict.id)
+                if node is None or conflict.reason not in (
+                    CONFLICT_MODIFIED, CONFLICT_DELETED
+                ):
+                    continue
+                node.value = conflict.value
+                node.version = conflict.version
+                self._listener.node_changed(node)
+                self._account(node)
+                if conflict.reason == CONFLICT_DELETED:
+                    deleted_parents.append(node)
+            for node in deleted_parents:
+                if node is not self.root and not node.deleted:
+                    stillborns.extend(self._mark_subtree_for_delete(node))
+        # Deletions came from the database, there is nothing left to apply
+        self._pending_deleted = set()
+
+        return stillborns
+
+    @timed('cache.restore')
+    def restore(
+        self,
+        nodes: t.Iterable[CacheNode],
+        deleted_subtree_roots: t.Iterable[int],
+        pending_deleted: t.Iterable[int],
+    ) -> None:
+        """Takes over a saved working set in place of the empty cache
+
+        Nodes come linked to their parents in the cache order, top-level
+        ones without a parent. The listener is not notified, views are
+        to be reset instead.
+        """
+        for node in nodes:
+            if node.parent is None:
+                node.parent = self.root
+                self.root.children.append(node)
+                self._top_level[node.saved_id()] = node
+                if node.parent_id is not None:
+                    self._orphans.setdefault(node.parent_id, []).append(node)
+            if node.id is not None:
+                self._nodes[node.id] = node
+                self._lru[node.id] = node
+                if node.modified:
+                    self._modified[node.id] = node
+            else:
+                self._unsaved[id(node)] = node
+            self._account(node)
+        self.deleted_subtree_roots = set(deleted_subtree_roots)
+        self._pending_deleted = set(pending_deleted)
@@ -1,13 +1,31 @@
 import sys
+import typing as t
 
 import click
 from PyQt5.QtWidgets import QApplication
 
 from .app import TreeDBViewApp
+from .backends import BACKENDS
 from .db import DBConfig
+from .db import DEFAULT_APPLY_CHUNK_SIZE
+from .db import DEFAULT_CHANGE_RETENTION
+from .db import DEFAULT_CONNECT_TIMEOUT
+from .db import DEFAULT_POLL_INTERVAL
+from .db import DEFAULT_POOL_SIZE
+from .db import DEFAULT_POOL_TIMEOUT
+from .db import DEFAULT_SEED_DEPTH
+from .db import SEED_FORMATS
+from .medium import CacheConfig
+from .metrics import METRIC_FORMATS
+from .metrics import METRICS
 
 
 @click.command()
+@click.option('--backend', type=click.Choice(list(BACKENDS)),
+              default='postgresql', help='Database backend')
+@click.option('--url', type=click.STRING, default=None,
+              help='Database URL overriding the connection options, '
+                   'its scheme selects the backend')
 @click.option('--host', type=click.STRING,
               default='127.0.0.1', help='Postgres server host')
 @click.option('--port', type=click.INT,
@@ -17,24 +35,132 @@ from .db import DBConfig
 @click.option('--password', type=click.STRING,
               default='sql', help='Postgres password')
 @click.option('--database', type=click.STRING,
-              default='treedb', help='Postgres DB name')
+              default='treedb',
+              help='Postgres DB name or SQLite database file')
+@click.option('--apply-chunk-size', type=click.IntRange(min=1),
+              default=DEFAULT_APPLY_CHUNK_SIZE,
+              help='Number of rows streamed to the DB per COPY on apply')
+@click.option('--pool-size', type=click.IntRange(min=1),
+              default=DEFAULT_POOL_SIZE, help='Connections kept in the pool')
+@click.option('--pool-timeout', type=click.FloatRange(min=0),
+              default=DEFAULT_POOL_TIMEOUT,
+              help='Seconds to wait for a free pooled connection')
+@click.option('--pool-pre-ping/--no-pool-pre-ping', default=True,
+              help='Test pooled connections before using them')
+@click.option('--connect-timeout', type=click.IntRange(min=1),
+              default=DEFAULT_CONNECT_TIMEOUT,
+              help='Seconds to wait for a new connection')
+@click.option('--statement-timeout', type=click.IntRange(min=0),
+              default=0, help='Statement timeout in ms, 0 disables it')
+@click.option('--prepared-statements/--no-prepared-statements',
+              default=True,
+              help='Look nodes up with a server-side prepared statement')
+@click.option('--materialized-paths/--no-materialized-paths', default=True,
+              help='Maintain node paths for indexed subtree lookups')
+@click.option('--change-feed/--no-change-feed', default=True,
+              help='Log node changes and show changes of other clients')
+@click.option('--poll-interval', type=click.FloatRange(min=0),
+              default=DEFAULT_POLL_INTERVAL,
+              help='Seconds between change feed polls, 0 disables them')
+@click.option('--change-retention', type=click.FloatRange(min=0),
+              default=DEFAULT_CHANGE_RETENTION,
+              help='Seconds logged changes are kept, 0 keeps them all')
+@click.option('--seed-fan-out', type=click.IntRange(min=0), default=0,
+              help='Seed a synthetic tree with this many children per node')
+@click.option('--seed-depth', type=click.IntRange(min=1),
+              default=DEFAULT_SEED_DEPTH,
+              help='Number of levels of the synthetic tree')
+@click.option('--seed-file', type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='Seed (id, parent_id, value) rows from a file')
+@click.option('--seed-format', type=click.Choice(SEED_FORMATS),
+              default=SEED_FORMATS[0], help='Format of the seed file')
+@click.option('--cache-max-nodes', type=click.IntRange(min=1),
+              default=None, help='Local cache capacity in nodes')
+@click.option('--cache-max-bytes', type=click.IntRange(min=1),
+              default=None, help='Local cache capacity in bytes')
+@click.option('--fetch-ancestors/--no-fetch-ancestors', default=False,
+              help='Fetch ancestors of nodes as read-only cache context')
+@click.option('--cache-snapshot', type=click.Path(dir_okay=False),
+              default=None,
+              help='Keep the cached tree in this file between runs')
+@click.option('--stats/--no-stats', default=False,
+              help='Record timings and counters, shown in a stats panel')
+@click.option('--stats-dump', type=click.Path(dir_okay=False),
+              default=None,
+              help='Write recorded stats to this file on exit, '
+                   'implies --stats')
+@click.option('--stats-format', type=click.Choice(METRIC_FORMATS),
+              default=METRIC_FORMATS[0], help='Format of the stats dump')
 @click.pass_context
 def cli(
     ctx: click.Context,
+    backend: str,
+    url: t.Optional[str],
     host: str,
     port: int,
     username: str,
     password: str,
     database: str,
+    apply_chunk_size: int,
+    pool_size: int,
+    pool_timeout: float,
+    pool_pre_ping: bool,
+    connect_timeout: int,
+    statement_timeout: int,
+    prepared_statements: bool,
+    materialized_paths: bool,
+    change_feed: bool,
+    poll_interval: float,
+    change_retention: float,
+    seed_fan_out: int,
+    seed_depth: int,
+    seed_file: t.Optional[str],
+    seed_format: str,
+    cache_max_nodes: t.Optional[int],
+    cache_max_bytes: t.Optional[int],
+    fetch_ancestors: bool,
+    cache_snapshot: t.Optional[str],
+    stats: bool,
+    stats_dump: t.Optional[str],
+    stats_format: str,
 ):
     conf = DBConfig(
         username=username,
         password=password,
         host=host,
         port=port,
-        db_name=database
+        db_name=database,
+        apply_chunk_size=apply_chunk_size,
+        pool_size=pool_size,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=pool_pre_ping,
+        connect_timeout=connect_timeout,
+        statement_timeout=statement_timeout,
+        prepared_statements=prepared_statements,
+        materialized_paths=materialized_paths,
+        change_feed=change_feed,
+        poll_interval=poll_interval,
+        change_retention=change_retention,
+        seed_fan_out=seed_fan_out,
+        seed_depth=seed_depth,
+        seed_file=seed_file,
+        seed_format=seed_format,
+        backend=backend,
+        url=url,
     )
+    cache_conf = CacheConfig(
+        max_nodes=cache_max_nodes,
+        max_bytes=cache_max_bytes,
+        fetch_ancestors=fetch_ancestors,
+        snapshot_path=cache_snapshot,
+    )
+    if stats or stats_dump is not None:
+        METRICS.enable()
     app = QApplication(sys.argv)
-    main_window = TreeDBViewApp(conf)
+    main_window = TreeDBViewApp(conf, cache_conf)
     main_window.show()
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+    if stats_dump is not None:
+        METRICS.dump(stats_dump, stats_format)
+    sys.exit(exit_code)
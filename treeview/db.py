@@ -1,17 +1,59 @@
+import io
+import threading
+import time
 import typing as t
+from collections import deque
+from contextlib import contextmanager
 from string import Template
 
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine import Connection
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from .hierarchy import synthetic_tree
+from .medium import ApplyPhase
+from .medium import ChangeFeed
+from .medium import CONFLICT_DELETED
+from .medium import CONFLICT_MODIFIED
+from .medium import CONFLICT_PARENT_DELETED
+from .medium import DBLineageRow
+from .medium import DBNodeChange
+from .medium import DBNodeRow
+from .medium import DBSubtreeRow
+from .medium import NodeConflict
 from .medium import NodeUpdates
+from .medium import PoolStats
+from .medium import SeedRow
+from .medium import UpsertResult
+from .metrics import METRICS
+from .metrics import timed
 
 TEMPLATE_DB_URL = Template(
     'postgresql://$user:$password@$host:$port/$db'
 )
 DBModelBase = declarative_base()
+DEFAULT_APPLY_CHUNK_SIZE = 10000
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 30.0
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_STREAM_BATCH_SIZE = 10000
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_CHANGE_RETENTION = 600.0
+DEFAULT_SEED_DEPTH = 3
+COPY_READ_SIZE = 1 << 16
+SEED_FORMATS = ('csv', 'binary')
+DEFAULT_SEARCH_LIMIT = 100
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
 
 
 class DBConfig(t.NamedTuple):
@@ -20,6 +62,29 @@ class DBConfig(t.NamedTuple):
     host: str
     port: int
     db_name: str
+    apply_chunk_size: int = DEFAULT_APPLY_CHUNK_SIZE
+    pool_size: int = DEFAULT_POOL_SIZE
+    pool_timeout: float = DEFAULT_POOL_TIMEOUT
+    pool_pre_ping: bool = True
+    connect_timeout: int = DEFAULT_CONNECT_TIMEOUT
+    # Milliseconds, 0 disables the timeout
+    statement_timeout: int = 0
+    prepared_statements: bool = True
+    materialized_paths: bool = True
+    change_feed: bool = True
+    # Seconds between polls of the change feed
+    poll_interval: float = DEFAULT_POLL_INTERVAL
+    # Seconds logged changes are kept for readers, 0 keeps them all
+    change_retention: float = DEFAULT_CHANGE_RETENTION
+    # Reset seeds a synthetic tree when fan-out is set, a file when
+    # given, the default tree otherwise
+    seed_fan_out: int = 0
+    seed_depth: int = DEFAULT_SEED_DEPTH
+    seed_file: t.Optional[str] = None
+    seed_format: str = SEED_FORMATS[0]
+    backend: str = 'postgresql'
+    # Full database URL overriding the one made of the fields above
+    url: t.Optional[str] = None
 
 
 class DBNodeModel(DBModelBase):
@@ -28,86 +93,1109 @@ class DBNodeModel(DBModelBase):
     id = sa.Column(sa.Integer, primary_key=True)  # NOQA: A003
     parent_id = sa.Column(sa.Integer, nullable=True)
     value = sa.Column(sa.String, nullable=True)
-    deleted = sa.Column(sa.Boolean, default=False, nullable=False)
+    deleted = sa.Column(
+        sa.Boolean, default=False, server_default=sa.false(), nullable=False
+    )
+    # Bumped on every change for optimistic concurrency control
+    version = sa.Column(
+        sa.Integer, default=0, server_default='0', nullable=False
+    )
+    # Ids from the top-level ancestor down to the node itself
+    path = sa.Column(
+        ARRAY(sa.Integer).with_variant(sa.JSON(), 'sqlite'), nullable=True
+    )
+
+    __table_args__ = (
+        sa.Index('ix_nodes_parent_id', 'parent_id', 'id'),
+        sa.Index(
+            'ix_nodes_live_parent_id', 'parent_id',
+            postgresql_where=sa.text('NOT deleted'),
+            sqlite_where=sa.text('NOT deleted'),
+        ),
+    )
+
+
+class DBNodeChangeModel(DBModelBase):
+    """Changelog of nodes filled by triggers for the change feed
+
+    `txid` is the writing transaction, readers take changes of the
+    transactions finished for sure, so late commits are never skipped.
+    """
+    __tablename__ = 'node_changes'
+
+    seq = sa.Column(sa.BigInteger, primary_key=True)
+    txid = sa.Column(
+        sa.BigInteger, server_default=sa.text('txid_current()'),
+        nullable=False, index=True,
+    )
+    node_id = sa.Column(sa.Integer, nullable=False)
+    parent_id = sa.Column(sa.Integer, nullable=True)
+    value = sa.Column(sa.String, nullable=True)
+    deleted = sa.Column(sa.Boolean, nullable=False)
 
 
 DEFAULT_TREE = [
-    DBNodeModel(id=1, parent_id=None, value='Node1'),
-    DBNodeModel(id=2, parent_id=1, value='Node2'),
-    DBNodeModel(id=3, parent_id=1, value='Node3'),
-    DBNodeModel(id=4, parent_id=3, value='Node4'),
-    DBNodeModel(id=5, parent_id=1, value='Node5'),
-    DBNodeModel(id=6, parent_id=5, value='Node6'),
-    DBNodeModel(id=7, parent_id=4, value='Node7'),
-    DBNodeModel(id=8, parent_id=4, value='Node8'),
-    DBNodeModel(id=9, parent_id=7, value='Node9'),
-    DBNodeModel(id=10, parent_id=6, value='Node10'),
-    DBNodeModel(id=11, parent_id=10, value='Node11'),
+    SeedRow(1, None, 'Node1'),
+    SeedRow(2, 1, 'Node2'),
+    SeedRow(3, 1, 'Node3'),
+    SeedRow(4, 3, 'Node4'),
+    SeedRow(5, 1, 'Node5'),
+    SeedRow(6, 5, 'Node6'),
+    SeedRow(7, 4, 'Node7'),
+    SeedRow(8, 4, 'Node8'),
+    SeedRow(9, 7, 'Node9'),
+    SeedRow(10, 6, 'Node10'),
+    SeedRow(11, 10, 'Node11'),
 ]
 
 
+class MeteredQueuePool(QueuePool):
+    """Queue pool counting checkouts and time spent waiting for them"""
+
+    def __init__(self, *args: t.Any, **kwargs: t.Any):  # NOQA: ANN401
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self) -> t.Any:  # NOQA: ANN401
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def recreate(self) -> 'MeteredQueuePool':
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.wait_seconds = self.wait_seconds
+        pool.max_wait_seconds = self.max_wait_seconds
+        return pool
+
+
+def create_engine(url: str, conf: DBConfig) -> sa.engine.Engine:
+    options = f'-c statement_timeout={conf.statement_timeout}'
+    return sa.create_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=conf.pool_size,
+        pool_timeout=conf.pool_timeout,
+        pool_pre_ping=conf.pool_pre_ping,
+        connect_args={
+            'connect_timeout': conf.connect_timeout,
+            'options': options,
+        },
+    )
+
+
+def _before_cursor_execute(
+    connection: Connection,
+    *args: object,
+) -> None:
+    if METRICS.enabled:
+        connection.info['statement_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(
+    connection: Connection,
+    cursor: t.Any,  # NOQA: ANN401
+    statement: str,
+    parameters: t.Any,  # NOQA: ANN401
+    *args: object,
+) -> None:
+    start = connection.info.pop('statement_start', None)
+    if start is None:
+        return
+    METRICS.record(
+        'db.statement', time.perf_counter() - start, max(cursor.rowcount, 0)
+    )
+    METRICS.count('db.round_trips')
+    # Estimated by the text sent, drivers encode it in their own way
+    METRICS.count('db.bytes_sent', len(statement) + len(repr(parameters)))
+
+
+def instrument_engine(engine: sa.engine.Engine) -> None:
+    """Records each statement run by the engine as a round trip"""
+    sa.event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    sa.event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+class PreparedNodesQuery:
+    """Node lookup by ids over a long-lived connection
+
+    The query is prepared on the server once per connection, so repeated
+    lookups skip parsing and planning. A broken connection is replaced
+    and the statement prepared again on the next call.
+    """
+
+    _name = 'tree_get_nodes'
+
+    def __init__(self, engine: sa.engine.Engine):
+        self._engine = engine
+        self._connection: t.Optional[Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> Connection:
+        if self._connection is None or self._connection.invalidated:
+            self.close()
+            # Autocommit keeps the connection from idling in a transaction
+            connection = self._engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT'
+            )
+            table = DBNodeModel.__tablename__
+            connection.exec_driver_sql(
+                f'PREPARE {self._name} (int[]) AS '
+                f'SELECT id, parent_id, value, deleted, version FROM {table} '
+                'WHERE id = ANY($1) ORDER BY id'
+            )
+            self._connection = connection
+        return self._connection
+
+    def _execute(self, node_ids: t.List[int]) -> t.List[DBNodeModel]:
+        result = self._connect().exec_driver_sql(
+            f'EXECUTE {self._name} (%(ids)s)', {'ids': node_ids}
+        )
+        return [
+            DBNodeModel(id=id_, parent_id=parent_id, value=value,
+                        deleted=deleted, version=version)
+            for id_, parent_id, value, deleted, version in result
+        ]
+
+    def __call__(self, node_ids: t.List[int]) -> t.List[DBNodeModel]:
+        with self._lock:
+            try:
+                return self._execute(node_ids)
+            except sa.exc.DBAPIError as exc:
+                if not exc.connection_invalidated:
+                    raise
+                return self._execute(node_ids)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+NODES_TABLE = DBNodeModel.__tablename__
+PATH_INDEX_NAMES = ('ix_nodes_path', 'ix_nodes_pathless')
+PATH_INDEXES = (
+    f'CREATE INDEX IF NOT EXISTS ix_nodes_path ON {NODES_TABLE} '
+    'USING gin (path)',
+    f'CREATE INDEX IF NOT EXISTS ix_nodes_pathless ON {NODES_TABLE} (id) '
+    'WHERE path IS NULL',
+)
+# Paths are filled top-down starting at nodes whose parent has a path
+FILL_PATHS_SQL = f'''
+WITH RECURSIVE fill AS (
+    SELECT n.id, COALESCE(p.path, ARRAY[]::int[]) || n.id AS path
+    FROM {NODES_TABLE} n LEFT JOIN {NODES_TABLE} p ON p.id = n.parent_id
+    WHERE n.path IS NULL
+        AND (n.parent_id IS NULL OR p.path IS NOT NULL)
+    UNION ALL
+    SELECT n.id, fill.path || n.id
+    FROM {NODES_TABLE} n JOIN fill ON n.parent_id = fill.id
+    WHERE n.path IS NULL
+)
+UPDATE {NODES_TABLE} SET path = fill.path
+FROM fill WHERE {NODES_TABLE}.id = fill.id
+'''
+# Trigram index serving substring search of live values, pg_trgm is
+# installed by init.sql as creating extensions takes superuser rights
+SEARCH_INDEX_NAME = 'ix_nodes_value_trgm'
+SEARCH_INDEX = (
+    f'CREATE INDEX IF NOT EXISTS {SEARCH_INDEX_NAME} ON {NODES_TABLE} '
+    'USING gin (value gin_trgm_ops) WHERE NOT deleted'
+)
+HAS_TRIGRAMS_SQL = (
+    "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+)
+
+
+def like_pattern(text: str) -> str:
+    """LIKE pattern matching values containing `text` as is"""
+    escaped = (
+        text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    )
+    return f'%{escaped}%'
+
+
+CHANGES_TABLE = DBNodeChangeModel.__tablename__
+# Row level triggers run on PostgreSQL 9.6, the WHEN clause leaves path
+# updates out without calling the function as they change nothing visible
+CHANGE_TRIGGERS = (
+    f'''
+CREATE OR REPLACE FUNCTION log_node_change() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO {CHANGES_TABLE} (node_id, parent_id, value, deleted)
+    VALUES (NEW.id, NEW.parent_id, NEW.value, NEW.deleted);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+''',
+    f'DROP TRIGGER IF EXISTS log_inserts ON {NODES_TABLE}',
+    f'CREATE TRIGGER log_inserts AFTER INSERT ON {NODES_TABLE} '
+    'FOR EACH ROW EXECUTE PROCEDURE log_node_change()',
+    f'DROP TRIGGER IF EXISTS log_updates ON {NODES_TABLE}',
+    f'''
+CREATE TRIGGER log_updates AFTER UPDATE ON {NODES_TABLE} FOR EACH ROW
+WHEN (NEW.value IS DISTINCT FROM OLD.value
+    OR NEW.parent_id IS DISTINCT FROM OLD.parent_id
+    OR NEW.deleted IS DISTINCT FROM OLD.deleted)
+EXECUTE PROCEDURE log_node_change()
+''',
+)
+DROP_CHANGE_TRIGGERS = (
+    f'DROP TRIGGER IF EXISTS log_inserts ON {NODES_TABLE}',
+    f'DROP TRIGGER IF EXISTS log_updates ON {NODES_TABLE}',
+)
+# Transactions below the snapshot xmin are finished and visible
+WATERMARK_SQL = 'SELECT txid_snapshot_xmin(txid_current_snapshot())'
+
+
+def fill_paths(session: Session) -> int:
+    """Sets paths of the nodes lacking them, returns their number"""
+    return session.execute(sa.text(FILL_PATHS_SQL)).rowcount
+
+
+def create_search_index(bind: t.Union[Session, Connection]) -> None:
+    """Builds the trigram index if pg_trgm is installed
+
+    Without the extension search scans the live values with plain ILIKE.
+    """
+    if bind.execute(sa.text(HAS_TRIGRAMS_SQL)).scalar():
+        bind.execute(sa.text(SEARCH_INDEX))
+
+
+def live_subtree_cte(root_ids: t.List[int]) -> sa.sql.selectable.CTE:
+    """Ids of given live nodes and their live descendants"""
+    nodes = DBNodeModel.__table__
+    subtree = sa.select(nodes.c.id).where(
+        nodes.c.id.in_(root_ids),
+        sa.not_(nodes.c.deleted),
+    ).cte('subtree', recursive=True)
+    child = nodes.alias('child')
+    return subtree.union_all(
+        sa.select(child.c.id).join_from(
+            child, subtree, child.c.parent_id == subtree.c.id
+        ).where(
+            sa.not_(child.c.deleted)
+        )
+    )
+
+
+def soft_delete_subtree_stmt(root_ids: t.List[int]) -> sa.sql.Update:
+    nodes = DBNodeModel.__table__
+    subtree = live_subtree_cte(root_ids)
+    return nodes.update().where(
+        nodes.c.id == subtree.c.id
+    ).values(
+        deleted=True,
+        version=nodes.c.version + 1,
+    ).returning(nodes.c.id)
+
+
+def reserve_ids(session: Session, count: int) -> t.List[int]:
+    if count <= 0:
+        return []
+    return session.execute(
+        sa.text(
+            'SELECT nextval(pg_get_serial_sequence(:table, :column)) '
+            'FROM generate_series(1, :count)'
+        ),
+        {
+            'table': DBNodeModel.__tablename__,
+            'column': DBNodeModel.id.name,
+            'count': count,
+        }
+    ).scalars().all()
+
+
+def _copy_field(value: t.Union[int, str, None]) -> str:
+    if value is None:
+        return '\\N'
+    return str(value).translate(COPY_ESCAPES)
+
+
+class CopyReader(io.TextIOBase):
+    """Read-only file streaming rows in COPY text format
+
+    Lets COPY FROM STDIN consume a generator without materializing it.
+    """
+
+    def __init__(self, rows: t.Iterable[t.Sequence[t.Any]]):
+        self._lines = (
+            '\t'.join(map(_copy_field, row)) + '\n' for row in rows
+        )
+        self._rest = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: t.Optional[int] = -1) -> str:
+        parts = [self._rest]
+        length = len(self._rest)
+        while size is None or size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+        data = ''.join(parts)
+        if size is None or size < 0:
+            size = len(data)
+        self._rest = data[size:]
+        return data[:size]
+
+
+class ApplyTransaction:
+    """Applies cache changes to the database within one transaction
+
+    Updates are streamed in chunks through COPY into a temporary staging
+    table and merged into `nodes` with a single upsert. Every step adds
+    its row count and duration to `phases`.
+    """
+
+    _staging_table = 'nodes_staging'
+    # Updates pass only when based on the current version of a live node,
+    # new nodes are rejected together with staged descendants when their
+    # parent is deleted. Returns new versions and conflicts in one go.
+    _merge_sql = f'''
+WITH RECURSIVE rejected AS (
+    SELECT s.id FROM {_staging_table} s
+    JOIN {NODES_TABLE} p ON p.id = s.parent_id
+    WHERE s.version IS NULL AND p.deleted
+    UNION ALL
+    SELECT s.id FROM {_staging_table} s
+    JOIN rejected r ON s.parent_id = r.id
+), updated AS (
+    UPDATE {NODES_TABLE} n SET value = s.value, version = n.version + 1
+    FROM {_staging_table} s
+    WHERE n.id = s.id AND s.version IS NOT NULL
+        AND n.version = s.version AND NOT n.deleted
+    RETURNING n.id, n.version
+), inserted AS (
+    INSERT INTO {NODES_TABLE} (id, parent_id, value, deleted, version)
+    SELECT s.id, s.parent_id, s.value, FALSE, 0 FROM {_staging_table} s
+    WHERE s.version IS NULL AND s.id NOT IN (SELECT id FROM rejected)
+    RETURNING id, version
+)
+SELECT id, NULL::text, NULL::text, version FROM updated
+UNION ALL
+SELECT id, NULL::text, NULL::text, version FROM inserted
+UNION ALL
+SELECT s.id,
+    CASE WHEN n.deleted THEN '{CONFLICT_DELETED}'
+    ELSE '{CONFLICT_MODIFIED}' END,
+    n.value, n.version
+FROM {_staging_table} s JOIN {NODES_TABLE} n ON n.id = s.id
+WHERE s.version IS NOT NULL AND s.id NOT IN (SELECT id FROM updated)
+UNION ALL
+SELECT id, '{CONFLICT_PARENT_DELETED}', NULL::text, NULL::int FROM rejected
+'''
+
+    def __init__(
+        self,
+        session: Session,
+        chunk_size: int,
+        materialized_paths: bool = False,
+    ):
+        self._session = session
+        self._chunk_size = chunk_size
+        self._materialized_paths = materialized_paths
+        self.deleted_ids: t.List[int] = []
+        self.phases: t.Dict[str, ApplyPhase] = {}
+
+    def _record(self, phase: str, rows: int, start: float) -> None:
+        self.phases[phase] = ApplyPhase(rows, time.perf_counter() - start)
+        if METRICS.enabled:
+            METRICS.record(f'apply.{phase}', self.phases[phase].seconds, rows)
+
+    def reserve_ids(self, count: int) -> t.List[int]:
+        """Takes `count` ids from the `nodes.id` sequence at once"""
+        start = time.perf_counter()
+        ids = reserve_ids(self._session, count)
+        self._record('reserve', count, start)
+        return ids
+
+    def soft_delete_subtree(self, root_ids: t.Iterable[int]) -> t.List[int]:
+        start = time.perf_counter()
+        root_ids = list(root_ids)
+        if root_ids:
+            self.deleted_ids = self._session.execute(
+                soft_delete_subtree_stmt(root_ids)
+            ).scalars().all()
+        self._record('delete', len(self.deleted_ids), start)
+        return self.deleted_ids
+
+    def _stage(self, updates: t.List[NodeUpdates]) -> None:
+        cursor = self._session.connection().connection.cursor()
+        # Staged rows of a previous upsert in the transaction are merged
+        cursor.execute(
+            f'CREATE TEMP TABLE IF NOT EXISTS {self._staging_table} '
+            '(id INT, parent_id INT, value TEXT, version INT) ON COMMIT DROP'
+        )
+        cursor.execute(f'TRUNCATE {self._staging_table}')
+        copy_stmt = (
+            f'COPY {self._staging_table} (id, parent_id, value, version) '
+            'FROM STDIN'
+        )
+        for offset in range(0, len(updates), self._chunk_size):
+            chunk = io.StringIO()
+            for node in updates[offset:offset + self._chunk_size]:
+                chunk.write(
+                    f"{node['id']}\t{_copy_field(node['parent_id'])}"
+                    f"\t{_copy_field(node['value'])}"
+                    f"\t{_copy_field(node['version'])}\n"
+                )
+            if METRICS.enabled:
+                METRICS.count('db.round_trips')
+                METRICS.count('db.bytes_sent', chunk.tell())
+            chunk.seek(0)
+            cursor.copy_expert(copy_stmt, chunk)
+        cursor.close()
+
+    def upsert(self, updates: t.List[NodeUpdates]) -> UpsertResult:
+        """Inserts new nodes and updates values of existing ones
+
+        Returns versions of the written nodes and conflicts for the
+        rejected ones.
+        """
+        if not updates:
+            return UpsertResult({}, [])
+        start = time.perf_counter()
+        self._stage(updates)
+        self._record('stage', len(updates), start)
+
+        start = time.perf_counter()
+        versions = {}
+        conflicts = []
+        for node_id, reason, value, version in self._session.execute(
+            sa.text(self._merge_sql)
+        ):
+            if reason is None:
+                versions[node_id] = version
+            else:
+                conflicts.append(
+                    NodeConflict(node_id, reason, value, version)
+                )
+        self._record('merge', len(versions), start)
+
+        if self._materialized_paths:
+            start = time.perf_counter()
+            self._record('paths', fill_paths(self._session), start)
+        return UpsertResult(versions, conflicts)
+
+
 class TreeDBClient:
+    """Tree storage on a PostgreSQL server
+
+    Backends for other databases subclass it and override the hooks
+    wrapping dialect specific SQL.
+    """
+
+    transaction_class = ApplyTransaction
 
     def __init__(self, conf: DBConfig):
-        self.url = TEMPLATE_DB_URL.substitute(
+        self.url = conf.url or self._default_url(conf)
+        self.apply_chunk_size = conf.apply_chunk_size
+        self.materialized_paths = conf.materialized_paths
+        self.change_feed = conf.change_feed
+        self.change_retention = conf.change_retention
+        self.seed_fan_out = conf.seed_fan_out
+        self.seed_depth = conf.seed_depth
+        self.seed_file = conf.seed_file
+        self.seed_format = conf.seed_format
+        self.engine = self._create_engine(conf)
+        instrument_engine(self.engine)
+        self.session = sessionmaker(bind=self.engine)
+        self._prepared_get_nodes = (
+            PreparedNodesQuery(self.engine)
+            if conf.prepared_statements else None
+        )
+        # Watermarks passed to get_changes with the time of the read
+        self._read_watermarks: t.Deque[t.Tuple[float, int]] = deque()
+        self._pruned_watermark: t.Optional[int] = None
+
+    def _default_url(self, conf: DBConfig) -> str:
+        return TEMPLATE_DB_URL.substitute(
             user=conf.username,
             password=conf.password,
             host=conf.host,
             port=conf.port,
             db=conf.db_name
         )
-        self.engine = sa.create_engine(self.url)
-        self.session = sessionmaker(bind=self.engine)
+
+    def _create_engine(self, conf: DBConfig) -> sa.engine.Engine:
+        return create_engine(self.url, conf)
+
+    def _write_session(self) -> Session:
+        """Session for transactions writing to the database"""
+        return self.session()
+
+    def _read_before(self, watermark: int) -> sa.sql.ColumnElement:
+        """Condition on changes a reader at `watermark` has seen"""
+        return DBNodeChangeModel.txid < watermark
+
+    def _ids_in(
+        self,
+        column: sa.Column,
+        node_ids: t.List[int]
+    ) -> sa.sql.ColumnElement:
+        """Condition matching a list of ids bound as a single parameter"""
+        ids = sa.bindparam('ids', node_ids, type_=ARRAY(sa.Integer))
+        return column == sa.any_(ids)
+
+    def _any_of(self, column: sa.Column) -> sa.sql.ColumnElement:
+        """Aggregate telling whether any of the flags is set"""
+        return sa.func.bool_or(column)
+
+    def _value_matches(self, text: str) -> sa.sql.ColumnElement:
+        """Condition matching values containing `text` in any case
+
+        Served by the trigram index for at least three characters, if
+        pg_trgm is installed.
+        """
+        return DBNodeModel.__table__.c.value.ilike(
+            like_pattern(text), escape='\\'
+        )
+
+    def pool_stats(self) -> PoolStats:
+        pool = self.engine.pool
+        return PoolStats(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checkouts=pool.checkouts,
+            wait_seconds=pool.wait_seconds,
+            max_wait_seconds=pool.max_wait_seconds,
+        )
+
+    def close(self) -> None:
+        if self._prepared_get_nodes is not None:
+            self._prepared_get_nodes.close()
+        self.engine.dispose()
 
     def _ensure_table(self) -> None:
         DBModelBase.metadata.create_all(self.engine)
+        table = DBNodeModel.__tablename__
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                f'ALTER TABLE {table} '
+                'ADD COLUMN IF NOT EXISTS path integer[], '
+                'ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0, '
+                'ALTER COLUMN deleted SET DEFAULT false'
+            )
+            if self.materialized_paths:
+                for ddl in PATH_INDEXES:
+                    connection.exec_driver_sql(ddl)
+                # Backfills rows written with paths turned off
+                connection.execute(sa.text(FILL_PATHS_SQL))
+            triggers = (
+                CHANGE_TRIGGERS if self.change_feed else DROP_CHANGE_TRIGGERS
+            )
+            for ddl in triggers:
+                connection.exec_driver_sql(ddl)
+            create_search_index(connection)
+        for index in DBNodeModel.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
 
+    @timed('db.reset_table')
     def reset_table(self) -> None:
+        """Replaces all nodes with the seed set up in the config"""
+        if self.seed_file is not None:
+            mode = 'rb' if self.seed_format == 'binary' else 'r'
+            with open(self.seed_file, mode) as f:
+                self.seed_from_file(f, self.seed_format)
+        elif self.seed_fan_out:
+            self.seed(synthetic_tree(self.seed_fan_out, self.seed_depth))
+        else:
+            self.seed(DEFAULT_TREE)
+
+    def seed(self, rows: t.Iterable[SeedRow]) -> None:
+        """Replaces all nodes with rows streamed through COPY"""
+        self._load(CopyReader(rows), 'text')
+
+    def seed_from_file(self, f: t.IO, seed_format: str = 'csv') -> None:
+        """Replaces all nodes with (id, parent_id, value) rows of a file
+
+        `seed_format` is either 'csv' without a header or PostgreSQL
+        'binary' COPY format.
+        """
+        if seed_format not in SEED_FORMATS:
+            raise ValueError(f'Unknown seed format {seed_format!r}')
+        self._load(f, seed_format)
+
+    def _load(
+        self,
+        f: t.Union[t.IO, io.TextIOBase],
+        copy_format: str,
+    ) -> None:
+        """Loads nodes into the emptied table, then builds indexes once
+
+        Indexes and change logging are off during the load, the id
+        sequence restarts after the largest loaded id.
+        """
         self._ensure_table()
-        stmt = sa.text(f'TRUNCATE TABLE {DBNodeModel.__tablename__}')
-        with self.session() as s:
-            s.execute(stmt)
-            s.commit()
-            s.bulk_save_objects(DEFAULT_TREE)
+        table = DBNodeModel.__tablename__
+        indexes = DBNodeModel.__table__.indexes
+        with self._write_session() as s:
+            s.execute(sa.text(f'TRUNCATE TABLE {table}, {CHANGES_TABLE}'))
+            for index in indexes:
+                s.execute(sa.text(f'DROP INDEX IF EXISTS {index.name}'))
+            for index_name in (*PATH_INDEX_NAMES, SEARCH_INDEX_NAME):
+                s.execute(sa.text(f'DROP INDEX IF EXISTS {index_name}'))
+            s.execute(sa.text(f'ALTER TABLE {table} DISABLE TRIGGER USER'))
+            cursor = s.connection().connection.cursor()
+            cursor.copy_expert(
+                f'COPY {table} (id, parent_id, value) FROM STDIN '
+                f'WITH (FORMAT {copy_format})',
+                f,
+                COPY_READ_SIZE,
+            )
+            cursor.close()
+            s.execute(sa.text(f'ALTER TABLE {table} ENABLE TRIGGER USER'))
+            for index in indexes:
+                index.create(s.connection())
+            if self.materialized_paths:
+                fill_paths(s)
+                for ddl in PATH_INDEXES:
+                    s.execute(sa.text(ddl))
+            create_search_index(s)
+            s.execute(
+                sa.text(
+                    'SELECT setval(pg_get_serial_sequence(:table, :column), '
+                    f'(SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false)'
+                ),
+                {'table': table, 'column': DBNodeModel.id.name}
+            )
+            s.execute(sa.text(f'ANALYZE {table}'))
             s.commit()
 
-    def export_nodes(self) -> t.List[DBNodeModel]:
+    @timed('db.changes_watermark')
+    def changes_watermark(self) -> int:
+        """Position of the change feed to read changes made from now on"""
         with self.session() as s:
-            nodes = s.query(DBNodeModel).filter(
-                DBNodeModel.deleted.is_not(True)
-            ).all()
-        return nodes
+            return s.execute(sa.text(WATERMARK_SQL)).scalar()
+
+    @timed('db.get_changes')
+    def get_changes(self, watermark: int) -> ChangeFeed:
+        """Reads changes committed since `watermark` in logging order
+
+        Changes of transactions still running are left for the next read,
+        the returned watermark tells where it starts. Writers of a row wait
+        for each other, so its changes are logged in commit order.
+        """
+        self._read_watermarks.append((time.monotonic(), watermark))
+        with self.session() as s:
+            upper = s.execute(sa.text(WATERMARK_SQL)).scalar()
+            if upper <= watermark:
+                return ChangeFeed([], watermark)
+            query = s.query(
+                DBNodeChangeModel.node_id,
+                DBNodeChangeModel.parent_id,
+                DBNodeChangeModel.value,
+                DBNodeChangeModel.deleted,
+            ).filter(
+                DBNodeChangeModel.txid >= watermark,
+                DBNodeChangeModel.txid < upper,
+            ).order_by(DBNodeChangeModel.seq)
+            changes = [DBNodeChange(*row) for row in query]
+        return ChangeFeed(changes, upper)
+
+    @timed('db.prune_changes')
+    def prune_changes(self) -> int:
+        """Drops changes read more than `change_retention` seconds ago
+
+        Changes before a watermark this client read that long ago are
+        seen by every reader polling more often, readers lagging behind
+        more have to load the tree anew. Returns the number of dropped
+        changes.
+        """
+        if not self.change_retention:
+            return 0
+        cutoff = time.monotonic() - self.change_retention
+        watermark = self._pruned_watermark
+        while self._read_watermarks and self._read_watermarks[0][0] < cutoff:
+            watermark = self._read_watermarks.popleft()[1]
+        if watermark is None or watermark == self._pruned_watermark:
+            return 0
+        with self._write_session() as s:
+            pruned = s.execute(
+                sa.delete(DBNodeChangeModel).where(
+                    self._read_before(watermark)
+                )
+            ).rowcount
+            s.commit()
+        self._pruned_watermark = watermark
+        return pruned
+
+    def iter_nodes(
+        self,
+        root_ids: t.Optional[t.Iterable[int]] = None,
+        batch_size: int = DEFAULT_STREAM_BATCH_SIZE,
+    ) -> t.Generator[DBSubtreeRow, None, None]:
+        """Streams live nodes reachable from given or top-level ones
+
+        Rows come through a server-side cursor `batch_size` at a time,
+        ordered by depth, then parent and id, so siblings are adjacent
+        and every parent precedes its children. Given roots are streamed
+        even when deleted, deleted nodes below them are left out along
+        with their descendants.
+        """
+        nodes = DBNodeModel.__table__
+        if root_ids is None:
+            roots = sa.and_(
+                nodes.c.parent_id.is_(None), sa.not_(nodes.c.deleted)
+            )
+        else:
+            roots = self._ids_in(nodes.c.id, list(root_ids))
+        tree = sa.select(
+            nodes.c.id,
+            nodes.c.parent_id,
+            nodes.c.value,
+            nodes.c.deleted,
+            sa.literal(0).label('depth'),
+            nodes.c.version,
+        ).where(
+            roots
+        ).cte('tree', recursive=True)
+        child = nodes.alias('child')
+        tree = tree.union_all(
+            sa.select(
+                child.c.id,
+                child.c.parent_id,
+                child.c.value,
+                child.c.deleted,
+                tree.c.depth + 1,
+                child.c.version,
+            ).join_from(
+                child, tree, child.c.parent_id == tree.c.id
+            ).where(
+                sa.not_(child.c.deleted)
+            )
+        )
+        stmt = sa.select(tree).order_by(
+            tree.c.depth, tree.c.parent_id, tree.c.id
+        )
+        with self.engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, max_row_buffer=batch_size
+            ).execute(stmt)
+            for partition in result.partitions(batch_size):
+                if METRICS.enabled:
+                    METRICS.count('db.streamed_rows', len(partition))
+                for row in partition:
+                    yield DBSubtreeRow(*row)
 
+    @timed('db.get_node')
     def get_node(self, node_id: int) -> t.Optional[DBNodeModel]:
+        if self._prepared_get_nodes is not None:
+            return next(iter(self._prepared_get_nodes([node_id])), None)
         with self.session() as s:
             node = s.query(DBNodeModel).get(node_id)
         return node
 
-    def update_table(self, updates: t.List[NodeUpdates]):
-        """Performs bulk upsert of new and updated nodes to database
+    @timed('db.get_nodes')
+    def get_nodes(self, node_ids: t.Iterable[int]) -> t.List[DBNodeModel]:
+        """Fetches several nodes in a single round trip ordered by id"""
+        node_ids = list(node_ids)
+        if not node_ids:
+            return []
+        if self._prepared_get_nodes is not None:
+            return self._prepared_get_nodes(node_ids)
+        with self.session() as s:
+            nodes = s.query(DBNodeModel).filter(
+                self._ids_in(DBNodeModel.id, node_ids)
+            ).order_by(DBNodeModel.id).all()
+        return nodes
+
+    @timed('db.get_lineage')
+    def get_lineage(self, node_ids: t.Iterable[int]) -> t.List[DBLineageRow]:
+        """Fetches nodes together with all their ancestors in one query
+
+        Ancestors are collected by a recursive query climbing parent
+        links, rows are ordered by id and tell which nodes were requested.
         """
-        if not updates:
-            return
-        insert_stmt = insert(DBNodeModel).values(updates)
-        update_stmt = insert_stmt.on_conflict_do_update(
-            index_elements=[DBNodeModel.id],
-            set_={
-                'value': insert_stmt.excluded.value,
-            }
+        node_ids = list(node_ids)
+        if not node_ids:
+            return []
+        nodes = DBNodeModel.__table__
+        return self._lineage(self._ids_in(nodes.c.id, node_ids))
+
+    @timed('db.search')
+    def search(
+        self,
+        text: str,
+        limit: int = DEFAULT_SEARCH_LIMIT,
+    ) -> t.List[DBLineageRow]:
+        """Finds live nodes whose value contains `text` in any case
+
+        Matches come with all their ancestors in the same query, as rows
+        of `get_lineage` telling the matches by the `requested` flag.
+        At most `limit` matches with the lowest ids are returned.
+        """
+        if not text:
+            return []
+        nodes = DBNodeModel.__table__
+        matches = sa.select(nodes.c.id).where(
+            sa.not_(nodes.c.deleted),
+            self._value_matches(text),
+        ).order_by(nodes.c.id).limit(limit)
+        return self._lineage(nodes.c.id.in_(matches))
+
+    def _lineage(
+        self,
+        requested: sa.sql.ColumnElement,
+    ) -> t.List[DBLineageRow]:
+        if self.materialized_paths:
+            stmt = self._path_lineage_stmt(requested)
+        else:
+            stmt = self._chain_lineage_stmt(requested)
+        with self.session() as s:
+            rows = [DBLineageRow(*row) for row in s.execute(stmt)]
+        return rows
+
+    def _path_lineage_stmt(
+        self,
+        requested: sa.sql.ColumnElement,
+    ) -> sa.sql.Select:
+        """Reads ancestors off the materialized paths
+
+        Paths are filled top-down, so the parent chain is climbed only
+        through nodes written with paths turned off, up to the first node
+        whose path lists all ancestors above it.
+        """
+        nodes = DBNodeModel.__table__
+        chain = sa.select(
+            nodes.c.id,
+            nodes.c.parent_id,
+            nodes.c.path,
+            sa.literal(True).label('requested'),
+        ).where(
+            requested
+        ).cte('chain', recursive=True)
+        parent = nodes.alias('parent')
+        chain = chain.union(
+            sa.select(
+                parent.c.id,
+                parent.c.parent_id,
+                parent.c.path,
+                sa.literal(False),
+            ).join_from(
+                parent, chain, parent.c.id == chain.c.parent_id
+            ).where(
+                chain.c.path.is_(None)
+            )
         )
+        lineage = sa.union_all(
+            sa.select(chain.c.id, chain.c.requested),
+            sa.select(
+                sa.func.unnest(chain.c.path), sa.literal(False)
+            ).where(
+                chain.c.path.is_not(None)
+            ),
+        ).subquery('lineage')
+        return sa.select(
+            nodes.c.id,
+            nodes.c.parent_id,
+            nodes.c.value,
+            nodes.c.deleted,
+            self._any_of(lineage.c.requested),
+            nodes.c.version,
+        ).join_from(
+            nodes, lineage, nodes.c.id == lineage.c.id
+        ).group_by(
+            nodes.c.id, nodes.c.parent_id, nodes.c.value, nodes.c.deleted,
+            nodes.c.version,
+        ).order_by(nodes.c.id)
+
+    def _chain_lineage_stmt(
+        self,
+        requested: sa.sql.ColumnElement,
+    ) -> sa.sql.Select:
+        """Collects ancestors climbing parent links one level at a time"""
+        nodes = DBNodeModel.__table__
+        chain = sa.select(
+            nodes.c.id,
+            nodes.c.parent_id,
+            nodes.c.value,
+            nodes.c.deleted,
+            sa.literal(True).label('requested'),
+            nodes.c.version,
+        ).where(
+            requested
+        ).cte('chain', recursive=True)
+        parent = nodes.alias('parent')
+        chain = chain.union(
+            sa.select(
+                parent.c.id,
+                parent.c.parent_id,
+                parent.c.value,
+                parent.c.deleted,
+                sa.literal(False),
+                parent.c.version,
+            ).join_from(
+                parent, chain, parent.c.id == chain.c.parent_id
+            )
+        )
+        return sa.select(
+            chain.c.id,
+            chain.c.parent_id,
+            chain.c.value,
+            chain.c.deleted,
+            self._any_of(chain.c.requested),
+            chain.c.version,
+        ).group_by(
+            chain.c.id, chain.c.parent_id, chain.c.value, chain.c.deleted,
+            chain.c.version,
+        ).order_by(chain.c.id)
+
+    @timed('db.get_children')
+    def get_children(
+        self,
+        parent_id: t.Optional[int],
+        after_id: t.Optional[int] = None,
+        limit: t.Optional[int] = None,
+    ) -> t.List[DBNodeRow]:
+        """Returns children of a node ordered by id (keyset paginated)
+
+        Top-level nodes are returned for `parent_id=None`. Each row tells
+        whether the node has children of its own, so views can decide on
+        expanding it without fetching the next level.
+        """
+        child = aliased(DBNodeModel)
+        has_children = sa.exists().where(
+            child.parent_id == DBNodeModel.id
+        ).label('has_children')
         with self.session() as s:
-            s.execute(update_stmt)
-            s.commit()
+            query = s.query(
+                DBNodeModel.id,
+                DBNodeModel.parent_id,
+                DBNodeModel.value,
+                DBNodeModel.deleted,
+                has_children,
+                DBNodeModel.version,
+            )
+            if parent_id is None:
+                query = query.filter(DBNodeModel.parent_id.is_(None))
+            else:
+                query = query.filter(DBNodeModel.parent_id == parent_id)
+            if after_id is not None:
+                query = query.filter(DBNodeModel.id > after_id)
+            query = query.order_by(DBNodeModel.id)
+            if limit is not None:
+                query = query.limit(limit)
+            rows = [DBNodeRow(*row) for row in query]
+        return rows
 
-    def soft_delete(self, *node_ids: int) -> int:
-        if not node_ids:
-            return 0
+    @contextmanager
+    def apply_transaction(
+        self,
+        chunk_size: t.Optional[int] = None,
+    ) -> t.Iterator[ApplyTransaction]:
+        """Opens a transaction committed when the block exits cleanly"""
+        with self._write_session() as s:
+            tx = self.transaction_class(
+                s,
+                chunk_size or self.apply_chunk_size,
+                self.materialized_paths,
+            )
+            try:
+                yield tx
+                start = time.perf_counter()
+                s.commit()
+                tx._record('commit', 0, start)
+            except BaseException:
+                s.rollback()
+                raise
+
+    def soft_delete_subtree(self, root_ids: t.Iterable[int]) -> t.List[int]:
+        """Marks given nodes and all their live descendants as deleted
+
+        Descendants are resolved by the server in the same statement.
+        Returns ids of the nodes that were actually marked.
+        """
+        with self.apply_transaction() as tx:
+            deleted_ids = tx.soft_delete_subtree(root_ids)
+        return deleted_ids
+
+    def _ancestors_cte(self, node_id: int) -> sa.sql.selectable.CTE:
+        nodes = DBNodeModel.__table__
+        chain = sa.select(
+            nodes.c.id,
+            nodes.c.parent_id,
+        ).where(
+            nodes.c.id == node_id
+        ).cte('chain', recursive=True)
+        parent = nodes.alias('parent')
+        return chain.union_all(
+            sa.select(
+                parent.c.id,
+                parent.c.parent_id,
+            ).join_from(
+                parent, chain, parent.c.id == chain.c.parent_id
+            )
+        )
+
+    @timed('db.in_subtree')
+    def in_subtree(self, node_id: int, root_id: int) -> bool:
+        """Tells whether a node is `root_id` itself or its descendant
+
+        Checks the materialized path of the node when it has one, climbs
+        the parent chain with a recursive query otherwise.
+        """
+        if node_id == root_id:
+            return True
         with self.session() as s:
-            deleted_count = s.query(DBNodeModel).filter(
-                DBNodeModel.id.in_(node_ids)
-            ).update(
-                {'deleted': True},
-                synchronize_session=False
+            if self.materialized_paths:
+                # NULL for nodes written with paths turned off
+                found = s.execute(
+                    sa.select(
+                        DBNodeModel.path.contains([root_id])
+                    ).where(
+                        DBNodeModel.id == node_id
+                    )
+                ).scalar()
+                if found is not None:
+                    return found
+            chain = self._ancestors_cte(node_id)
+            found = s.execute(
+                sa.select(sa.exists().where(chain.c.id == root_id))
+            ).scalar()
+        return found
+
+    @timed('db.subtree_size')
+    def subtree_size(self, node_id: int, live_only: bool = False) -> int:
+        """Counts a node with all its descendants
+
+        With paths enabled it is a single lookup over the GIN index of
+        paths, otherwise the subtree is walked by a recursive query that
+        leaves deleted branches out for `live_only`.
+        """
+        nodes = DBNodeModel.__table__
+        if self.materialized_paths:
+            query = sa.select(sa.func.count()).where(
+                nodes.c.path.contains([node_id])
             )
-            s.commit()
-        return deleted_count
+            if live_only:
+                query = query.where(sa.not_(nodes.c.deleted))
+        else:
+            roots = [nodes.c.id == node_id]
+            if live_only:
+                roots.append(sa.not_(nodes.c.deleted))
+            subtree = sa.select(nodes.c.id).where(
+                *roots
+            ).cte('subtree', recursive=True)
+            child = nodes.alias('child')
+            step = sa.select(child.c.id).join_from(
+                child, subtree, child.c.parent_id == subtree.c.id
+            )
+            if live_only:
+                step = step.where(sa.not_(child.c.deleted))
+            subtree = subtree.union_all(step)
+            query = sa.select(sa.func.count()).select_from(subtree)
+        with self.session() as s:
+            size = s.execute(query).scalar()
+        return size
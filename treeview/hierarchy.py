@@ -0,0 +1,74 @@
+import typing as t
+from collections import defaultdict
+
+from .medium import SeedRow
+
+
+class NodeLike(t.Protocol):
+    @property
+    def id(self) -> t.Optional[int]:  # NOQA: A003
+        ...
+
+    @property
+    def parent_id(self) -> t.Optional[int]:
+        ...
+
+
+Node = t.TypeVar('Node', bound=NodeLike)
+
+
+class Hierarchy(t.Generic[Node]):
+    __slots__ = ('batches', 'orphans')
+
+    def __init__(
+        self,
+        batches: t.List[t.Tuple[t.Optional[int], t.List[Node]]],
+        orphans: t.List[Node],
+    ):
+        self.batches = batches
+        self.orphans = orphans
+
+
+def group_by_parent(
+    nodes: t.Iterable[Node]
+) -> t.Dict[t.Optional[int], t.List[Node]]:
+    children = defaultdict(list)
+    for node in nodes:
+        children[node.parent_id].append(node)
+    return children
+
+
+def build_hierarchy(nodes: t.Iterable[Node]) -> Hierarchy[Node]:
+    """Arranges nodes top-down in O(n) regardless of their input order
+
+    Returns sibling batches in parent-before-child order, so each batch
+    can be attached to an already placed parent at once. Nodes that can
+    not be reached from a top-level node (dangling `parent_id` or cycles)
+    are returned as orphans.
+    """
+    children = group_by_parent(nodes)
+    batches = []
+    queue: t.List[t.Optional[int]] = [None]
+    for parent_id in queue:
+        batch = children.pop(parent_id, None)
+        if batch:
+            batches.append((parent_id, batch))
+            queue.extend(node.id for node in batch)
+    orphans = [node for batch in children.values() for node in batch]
+    return Hierarchy(batches, orphans)
+
+
+def synthetic_tree(fan_out: int, depth: int) -> t.Iterator[SeedRow]:
+    """Generates a single-rooted tree level by level for load tests
+
+    Every node above `depth` levels gets `fan_out` children, ids follow
+    the generation order, so parents always precede their children.
+    """
+    yield SeedRow(1, None, 'Node1')
+    level_start, level_end, next_id = 1, 1, 2
+    for _ in range(depth - 1):
+        for parent_id in range(level_start, level_end + 1):
+            for node_id in range(next_id, next_id + fan_out):
+                yield SeedRow(node_id, parent_id, f'Node{node_id}')
+            next_id += fan_out
+        level_start, level_end = level_end + 1, next_id - 1
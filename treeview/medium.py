@@ -1,12 +1,113 @@
 import typing as t
 
 
+CONFLICT_MODIFIED = 'modified'
+CONFLICT_DELETED = 'deleted'
+CONFLICT_PARENT_DELETED = 'parent_deleted'
+
+
 class NodeUpdates(t.TypedDict):
     id: int  # NOQA: A003
     parent_id: t.Optional[int]
     value: t.Optional[str]
+    # Version the value was based on, None for new nodes
+    version: t.Optional[int]
 
 
 class ExportedCache(t.NamedTuple):
     updates: t.List[NodeUpdates]
-    stillborns: t.List[str]
+    # Ids given to unsaved nodes in their creation order
+    new_ids: t.List[int]
+
+
+class DBNodeRow(t.NamedTuple):
+    id: int  # NOQA: A003
+    parent_id: t.Optional[int]
+    value: t.Optional[str]
+    deleted: bool
+    has_children: bool
+    version: int = 0
+
+
+class DBSubtreeRow(t.NamedTuple):
+    id: int  # NOQA: A003
+    parent_id: t.Optional[int]
+    value: t.Optional[str]
+    deleted: bool
+    depth: int
+    version: int = 0
+
+
+class DBNodeChange(t.NamedTuple):
+    """State of a node after a committed change"""
+    id: int  # NOQA: A003
+    parent_id: t.Optional[int]
+    value: t.Optional[str]
+    deleted: bool
+
+
+class ChangeFeed(t.NamedTuple):
+    changes: t.List[DBNodeChange]
+    # Position to read the following changes from
+    watermark: int
+
+
+class SeedRow(t.NamedTuple):
+    id: int  # NOQA: A003
+    parent_id: t.Optional[int]
+    value: t.Optional[str]
+
+
+class ApplyPhase(t.NamedTuple):
+    rows: int
+    seconds: float
+
+
+class NodeConflict(t.NamedTuple):
+    """Update rejected by the database
+
+    `value` and `version` are the ones found in the database, they are
+    None for new nodes rejected with their deleted parent.
+    """
+    id: int  # NOQA: A003
+    reason: str
+    value: t.Optional[str]
+    version: t.Optional[int]
+
+
+class UpsertResult(t.NamedTuple):
+    versions: t.Dict[int, int]
+    conflicts: t.List[NodeConflict]
+
+
+class DBLineageRow(t.NamedTuple):
+    id: int  # NOQA: A003
+    parent_id: t.Optional[int]
+    value: t.Optional[str]
+    deleted: bool
+    requested: bool
+    version: int = 0
+
+
+class CacheConfig(t.NamedTuple):
+    max_nodes: t.Optional[int] = None
+    max_bytes: t.Optional[int] = None
+    # Fetch ancestors of requested nodes as read-only context
+    fetch_ancestors: bool = False
+    # Local file keeping the working set between runs
+    snapshot_path: t.Optional[str] = None
+
+
+class SpanStats(t.NamedTuple):
+    calls: int
+    seconds: float
+    max_seconds: float
+    rows: int
+
+
+class PoolStats(t.NamedTuple):
+    size: int
+    checked_out: int
+    checkouts: int
+    wait_seconds: float
+    max_wait_seconds: float
@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+import typing as t
+from functools import wraps
+
+from .medium import SpanStats
+
+F = t.TypeVar('F', bound=t.Callable[..., t.Any])
+
+METRIC_FORMATS = ('json', 'prometheus')
+PROMETHEUS_PREFIX = 'treeview'
+
+
+class Metrics:
+    """Spans and counters recorded by the instrumented code
+
+    A span sums the calls, duration and rows of a named operation, a
+    counter sums arbitrary amounts. Recording is off until `enable`, the
+    instrumented code then only checks the `enabled` flag. Both the GUI
+    and the worker thread record, so updates are serialized by a lock.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._spans: t.Dict[str, SpanStats] = {}
+        self._counters: t.Dict[str, int] = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans = {}
+            self._counters = {}
+
+    def record(self, name: str, seconds: float, rows: int = 0) -> None:
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                self._spans[name] = SpanStats(1, seconds, seconds, rows)
+            else:
+                self._spans[name] = SpanStats(
+                    span.calls + 1,
+                    span.seconds + seconds,
+                    max(span.max_seconds, seconds),
+                    span.rows + rows,
+                )
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    @property
+    def spans(self) -> t.Dict[str, SpanStats]:
+        with self._lock:
+            return dict(self._spans)
+
+    @property
+    def counters(self) -> t.Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'spans': {
+                name: span._asdict()
+                for name, span in sorted(self.spans.items())
+            },
+            'counters': dict(sorted(self.counters.items())),
+        }, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Renders the metrics in Prometheus text exposition format"""
+        spans = sorted(self.spans.items())
+        lines = []
+        for field, kind, help_text in (
+            ('calls', 'counter', 'Calls of the operation'),
+            ('seconds', 'counter', 'Time spent in the operation'),
+            ('max_seconds', 'gauge', 'Longest call of the operation'),
+            ('rows', 'counter', 'Rows handled by the operation'),
+        ):
+            suffix = '' if kind == 'gauge' else '_total'
+            metric = f'{PROMETHEUS_PREFIX}_span_{field}{suffix}'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            lines.extend(
+                f'{metric}{{span="{name}"}} {getattr(span, field)}'
+                for name, span in spans
+            )
+        metric = f'{PROMETHEUS_PREFIX}_count_total'
+        lines.append(f'# HELP {metric} Amounts counted by name')
+        lines.append(f'# TYPE {metric} counter')
+        lines.extend(
+            f'{metric}{{name="{name}"}} {amount}'
+            for name, amount in sorted(self.counters.items())
+        )
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str, metric_format: str = 'json') -> None:
+        if metric_format not in METRIC_FORMATS:
+            raise ValueError(f'Unknown metrics format {metric_format!r}')
+        text = self.to_json() if metric_format == 'json' else (
+            self.to_prometheus()
+        )
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+METRICS = Metrics()
+
+
+def timed(name: str) -> t.Callable[[F], F]:
+    """Records each call of the decorated function as span `name`
+
+    Rows of list results are counted as rows of the span.
+    """
+    def decorate(func: F) -> F:
+        @wraps(func)
+        def wrapper(*args: object, **kwargs: object) -> t.Any:  # NOQA: ANN401
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            METRICS.record(
+                name,
+                time.perf_counter() - start,
+                len(result) if isinstance(result, list) else 0,
+            )
+            return result
+        return t.cast(F, wrapper)
+    return decorate
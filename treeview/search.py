@@ -0,0 +1,87 @@
+import typing as t
+
+from .cache import CacheListener
+from .cache import CacheNode
+from .cache import TreeCache
+
+TRIGRAM = 3
+
+
+def trigrams(text: str) -> t.Set[str]:
+    return {text[i:i + TRIGRAM] for i in range(len(text) - TRIGRAM + 1)}
+
+
+class ValueIndex(CacheListener):
+    """Inverted index of cached node values by their trigrams
+
+    Listens to the cache to index inserted and edited nodes and to drop
+    removed ones. A search takes the smallest posting list among the
+    trigrams of the query and checks just those nodes, queries shorter
+    than a trigram check all of them.
+    """
+
+    def __init__(self):
+        self._postings: t.Dict[str, t.Set[CacheNode]] = {}
+        # Case folded values the nodes are indexed by
+        self._values: t.Dict[CacheNode, str] = {}
+        self._inserted: t.Optional[t.Tuple[CacheNode, int]] = None
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _add(self, node: CacheNode) -> None:
+        value = (node.value or '').casefold()
+        self._values[node] = value
+        for gram in trigrams(value):
+            self._postings.setdefault(gram, set()).add(node)
+
+    def _discard(self, node: CacheNode) -> None:
+        value = self._values.pop(node, None)
+        if value is None:
+            return
+        for gram in trigrams(value):
+            nodes = self._postings[gram]
+            nodes.discard(node)
+            if not nodes:
+                del self._postings[gram]
+
+    def rebuild(self, cache: TreeCache) -> None:
+        """Indexes all nodes of a cache filled without notifications"""
+        self._postings = {}
+        self._values = {}
+        for top in cache.root.children:
+            for node in cache.iter_subtree(top):
+                self._add(node)
+
+    def begin_insert(self, parent: CacheNode, row: int) -> None:
+        self._inserted = (parent, row)
+
+    def end_insert(self) -> None:
+        if self._inserted is None:
+            return
+        parent, row = self._inserted
+        for node in TreeCache.iter_subtree(parent.children[row]):
+            self._add(node)
+        self._inserted = None
+
+    def begin_remove(self, parent: CacheNode, row: int) -> None:
+        for node in TreeCache.iter_subtree(parent.children[row]):
+            self._discard(node)
+
+    def node_changed(self, node: CacheNode) -> None:
+        if self._values.get(node) != (node.value or '').casefold():
+            self._discard(node)
+            self._add(node)
+
+    def search(self, text: str) -> t.Set[CacheNode]:
+        """Returns nodes whose value contains `text` in any case"""
+        needle = text.casefold()
+        candidates: t.AbstractSet[CacheNode] = self._values.keys()
+        grams = trigrams(needle)
+        if grams:
+            if not all(gram in self._postings for gram in grams):
+                return set()
+            postings = [self._postings[gram] for gram in grams]
+            candidates = min(postings, key=len)
+        values = self._values
+        return {node for node in candidates if needle in values[node]}
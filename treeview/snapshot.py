@@ -0,0 +1,209 @@
+import json
+import sqlite3
+import typing as t
+from contextlib import contextmanager
+
+from .cache import CacheListener
+from .cache import CacheNode
+from .cache import TreeCache
+from .metrics import timed
+
+SNAPSHOT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    key INTEGER PRIMARY KEY,
+    id INTEGER,
+    parent_key INTEGER,
+    parent_id INTEGER,
+    value TEXT,
+    deleted BOOLEAN NOT NULL,
+    modified BOOLEAN NOT NULL,
+    context BOOLEAN NOT NULL,
+    backup_value TEXT,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+# Saved nodes in id order, then unsaved ones in creation order
+SELECT_NODES_SQL = '''
+SELECT key, id, parent_key, parent_id, value, deleted, modified, context,
+    backup_value, version
+FROM nodes ORDER BY key < 0, abs(key)
+'''
+UPSERT_NODE_SQL = '''
+INSERT OR REPLACE INTO nodes (
+    key, id, parent_key, parent_id, value, deleted, modified, context,
+    backup_value, version
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class CacheSnapshot(CacheListener):
+    """Working set of a TreeCache kept in a local SQLite file
+
+    Listens to the cache to collect changed and removed nodes, `flush`
+    writes just them in one transaction, so pending changes survive a
+    crash. Saved nodes are keyed by id, unsaved ones by negative keys
+    given in creation order.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SNAPSHOT_SCHEMA)
+        # Keys of the written nodes by id() of the nodes
+        self._keys: t.Dict[int, int] = {}
+        self._dirty: t.Dict[int, CacheNode] = {}
+        self._removed: t.Set[int] = set()
+        self._next_key = self._first_free_key()
+        self._inserted: t.Optional[t.Tuple[CacheNode, int]] = None
+
+    def _first_free_key(self) -> int:
+        lowest = self._db.execute('SELECT min(key) FROM nodes').fetchone()[0]
+        return min(lowest or 0, 0) - 1
+
+    def _mark(self, node: CacheNode) -> None:
+        self._dirty[id(node)] = node
+
+    def begin_insert(self, parent: CacheNode, row: int) -> None:
+        self._inserted = (parent, row)
+
+    def end_insert(self) -> None:
+        # Undone deletions insert whole subtrees back
+        if self._inserted is None:
+            return
+        parent, row = self._inserted
+        for node in TreeCache.iter_subtree(parent.children[row]):
+            self._mark(node)
+        self._inserted = None
+
+    def begin_remove(self, parent: CacheNode, row: int) -> None:
+        # Removed nodes leave the cache with all their descendants
+        for node in TreeCache.iter_subtree(parent.children[row]):
+            self._dirty.pop(id(node), None)
+            key = self._keys.pop(id(node), None)
+            if key is not None:
+                self._removed.add(key)
+
+    def begin_move(
+        self,
+        source: CacheNode,
+        source_row: int,
+        target: CacheNode,
+        target_row: int,
+    ) -> None:
+        self._mark(source.children[source_row])
+
+    def node_changed(self, node: CacheNode) -> None:
+        self._mark(node)
+
+    def _key(self, node: CacheNode) -> t.Optional[int]:
+        if node.parent is None:
+            return None
+        old_key = self._keys.get(id(node))
+        if node.id is not None:
+            key = node.id
+        elif old_key is not None:
+            key = old_key
+        else:
+            key = self._next_key
+            self._next_key -= 1
+        if old_key is not None and old_key != key:
+            # Saved node is written under its new id
+            self._removed.add(old_key)
+        self._keys[id(node)] = key
+        return key
+
+    @timed('snapshot.flush')
+    def flush(self, cache: TreeCache) -> None:
+        """Writes nodes changed since the previous flush and cache state"""
+        rows = []
+        for node in self._dirty.values():
+            parent = node.parent
+            parent_key = (
+                None if parent is None or parent is cache.root
+                else self._key(parent)
+            )
+            rows.append((
+                self._key(node), node.id, parent_key, node.parent_id,
+                node.value, node.deleted, node.modified, node.context,
+                node.backup_value, node.version,
+            ))
+        state = (
+            ('deleted_subtree_roots',
+             json.dumps(sorted(cache.deleted_subtree_roots))),
+            ('pending_deleted', json.dumps(sorted(cache.pending_deleted))),
+        )
+        with self._transaction():
+            self._db.executemany(
+                'DELETE FROM nodes WHERE key = ?',
+                ((key,) for key in self._removed)
+            )
+            self._db.executemany(UPSERT_NODE_SQL, rows)
+            self._db.executemany(
+                'INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)',
+                state
+            )
+        self._dirty = {}
+        self._removed = set()
+
+    @contextmanager
+    def _transaction(self) -> t.Iterator[None]:
+        self._db.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    @timed('snapshot.restore')
+    def restore(self, cache: TreeCache) -> int:
+        """Loads the saved working set into an empty cache
+
+        Returns the number of restored nodes.
+        """
+        nodes: t.Dict[int, CacheNode] = {}
+        parents = []
+        for (
+            key, node_id, parent_key, parent_id, value, deleted, modified,
+            context, backup_value, version,
+        ) in self._db.execute(SELECT_NODES_SQL):
+            node = CacheNode(
+                node_id, parent_id, value, bool(deleted), bool(context),
+                version,
+            )
+            node.modified = bool(modified)
+            node.backup_value = backup_value
+            nodes[key] = node
+            parents.append(parent_key)
+            self._keys[id(node)] = key
+        # Parents are linked once all nodes exist, whatever the key order
+        for node, parent_key in zip(nodes.values(), parents):
+            if parent_key is not None:
+                parent = nodes[parent_key]
+                node.parent = parent
+                parent.children.append(node)
+        state = dict(self._db.execute('SELECT name, value FROM state'))
+        cache.restore(
+            nodes.values(),
+            json.loads(state.get('deleted_subtree_roots', '[]')),
+            json.loads(state.get('pending_deleted', '[]')),
+        )
+        self._next_key = self._first_free_key()
+        return len(nodes)
+
+    def clear(self) -> None:
+        with self._transaction():
+            self._db.execute('DELETE FROM nodes')
+            self._db.execute('DELETE FROM state')
+        self._keys = {}
+        self._dirty = {}
+        self._removed = set()
+        self._next_key = -1
+
+    def close(self) -> None:
+        self._db.close()
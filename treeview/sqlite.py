@@ -0,0 +1,427 @@
+import csv
+import json
+import time
+import typing as t
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from .db import ApplyTransaction
+from .db import CHANGES_TABLE
+from .db import DBConfig
+from .db import DBNodeChangeModel
+from .db import DBNodeModel
+from .db import live_subtree_cte
+from .db import MeteredQueuePool
+from .db import NODES_TABLE
+from .db import TreeDBClient
+from .medium import ChangeFeed
+from .medium import CONFLICT_DELETED
+from .medium import CONFLICT_MODIFIED
+from .medium import CONFLICT_PARENT_DELETED
+from .medium import DBNodeChange
+from .medium import NodeConflict
+from .medium import NodeUpdates
+from .medium import SeedRow
+from .medium import UpsertResult
+from .metrics import timed
+
+# Execution option making a transaction take the write lock at once
+IMMEDIATE = 'sqlite_immediate'
+CHANGES_DDL = f'''
+CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    txid INTEGER NOT NULL DEFAULT 0,
+    node_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    value TEXT,
+    deleted BOOLEAN NOT NULL
+)
+'''
+CHANGE_TRIGGERS = (
+    f'''
+CREATE TRIGGER IF NOT EXISTS log_inserts AFTER INSERT ON {NODES_TABLE}
+BEGIN
+    INSERT INTO {CHANGES_TABLE} (node_id, parent_id, value, deleted)
+    VALUES (NEW.id, NEW.parent_id, NEW.value, NEW.deleted);
+END
+''',
+    f'''
+CREATE TRIGGER IF NOT EXISTS log_updates AFTER UPDATE ON {NODES_TABLE}
+WHEN NEW.value IS NOT OLD.value
+    OR NEW.parent_id IS NOT OLD.parent_id
+    OR NEW.deleted <> OLD.deleted
+BEGIN
+    INSERT INTO {CHANGES_TABLE} (node_id, parent_id, value, deleted)
+    VALUES (NEW.id, NEW.parent_id, NEW.value, NEW.deleted);
+END
+''',
+)
+DROP_CHANGE_TRIGGERS = (
+    'DROP TRIGGER IF EXISTS log_inserts',
+    'DROP TRIGGER IF EXISTS log_updates',
+)
+# External content FTS5 table indexing values by trigrams, the trigram
+# tokenizer answers substring queries of three characters or more
+SEARCH_TABLE = 'nodes_search'
+TRIGRAM = 3
+SEARCH_DDL = f'''
+CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+    value, content='{NODES_TABLE}', content_rowid='id', tokenize='trigram'
+)
+'''
+SEARCH_TRIGGERS = (
+    f'''
+CREATE TRIGGER IF NOT EXISTS index_inserts AFTER INSERT ON {NODES_TABLE}
+BEGIN
+    INSERT INTO {SEARCH_TABLE} (rowid, value) VALUES (NEW.id, NEW.value);
+END
+''',
+    f'''
+CREATE TRIGGER IF NOT EXISTS index_updates
+AFTER UPDATE OF value ON {NODES_TABLE}
+BEGIN
+    INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, value)
+    VALUES ('delete', OLD.id, OLD.value);
+    INSERT INTO {SEARCH_TABLE} (rowid, value) VALUES (NEW.id, NEW.value);
+END
+''',
+    f'''
+CREATE TRIGGER IF NOT EXISTS index_deletes AFTER DELETE ON {NODES_TABLE}
+BEGIN
+    INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, value)
+    VALUES ('delete', OLD.id, OLD.value);
+END
+''',
+)
+REBUILD_SEARCH_SQL = f'''
+INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')
+'''
+DROP_SEARCH_TRIGGERS = (
+    'DROP TRIGGER IF EXISTS index_inserts',
+    'DROP TRIGGER IF EXISTS index_updates',
+    'DROP TRIGGER IF EXISTS index_deletes',
+)
+
+
+def json_ids(node_ids: t.Iterable[int]) -> sa.sql.Select:
+    """Subquery over ids bound as a single JSON parameter
+
+    Keeps large id lists clear of the SQLite bound parameters limit.
+    """
+    ids = sa.func.json_each(
+        sa.bindparam('ids', json.dumps(list(node_ids)))
+    ).table_valued('value')
+    return sa.select(ids.c.value)
+
+
+def _on_connect(
+    dbapi_connection: t.Any,  # NOQA: ANN401
+    record: t.Any,  # NOQA: ANN401
+) -> None:
+    # Transactions are begun by the engine events below
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _on_begin(connection: Connection) -> None:
+    if connection.get_execution_options().get(IMMEDIATE):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    else:
+        connection.exec_driver_sql('BEGIN')
+
+
+def create_engine(url: str, conf: DBConfig) -> sa.engine.Engine:
+    engine = sa.create_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=conf.pool_size,
+        pool_timeout=conf.pool_timeout,
+        pool_pre_ping=conf.pool_pre_ping,
+        connect_args={
+            # Seconds to wait for a lock held by another writer
+            'timeout': conf.connect_timeout,
+            # Pooled connections move between the GUI and worker threads
+            'check_same_thread': False,
+        },
+    )
+    sa.event.listen(engine, 'connect', _on_connect)
+    sa.event.listen(engine, 'begin', _on_begin)
+    return engine
+
+
+class SQLiteApplyTransaction(ApplyTransaction):
+    """Applies cache changes to an SQLite database
+
+    The transaction holds the write lock from its start, so ids are
+    reserved past the largest one and the merge runs as several plain
+    statements with nobody writing in between.
+    """
+
+    _rejected_sql = f'''
+WITH RECURSIVE rejected(id) AS (
+    SELECT s.id FROM {ApplyTransaction._staging_table} s
+    JOIN {NODES_TABLE} p ON p.id = s.parent_id
+    WHERE s.version IS NULL AND p.deleted
+    UNION ALL
+    SELECT s.id FROM {ApplyTransaction._staging_table} s
+    JOIN rejected r ON s.parent_id = r.id
+)
+SELECT id FROM rejected
+'''
+    _conflicts_sql = f'''
+SELECT s.id,
+    CASE WHEN n.deleted THEN '{CONFLICT_DELETED}'
+    ELSE '{CONFLICT_MODIFIED}' END,
+    n.value, n.version
+FROM {ApplyTransaction._staging_table} s
+JOIN {NODES_TABLE} n ON n.id = s.id
+WHERE s.version IS NOT NULL AND (n.deleted OR n.version <> s.version)
+'''
+    _update_sql = f'''
+UPDATE {NODES_TABLE} SET value = s.value, version = s.version + 1
+FROM {ApplyTransaction._staging_table} s
+WHERE {NODES_TABLE}.id = s.id AND s.version IS NOT NULL
+    AND {NODES_TABLE}.version = s.version AND NOT {NODES_TABLE}.deleted
+'''
+    _insert_sql = f'''
+INSERT INTO {NODES_TABLE} (id, parent_id, value, deleted, version)
+SELECT id, parent_id, value, FALSE, 0
+FROM {ApplyTransaction._staging_table}
+WHERE version IS NULL AND id NOT IN (SELECT value FROM json_each(:rejected))
+'''
+    _versions_sql = f'''
+SELECT s.id, n.version FROM {ApplyTransaction._staging_table} s
+JOIN {NODES_TABLE} n ON n.id = s.id
+'''
+
+    def reserve_ids(self, count: int) -> t.List[int]:
+        """Takes `count` ids following the largest one in use"""
+        start = time.perf_counter()
+        last_id = self._session.execute(
+            sa.select(sa.func.coalesce(sa.func.max(DBNodeModel.id), 0))
+        ).scalar()
+        self._record('reserve', count, start)
+        return list(range(last_id + 1, last_id + count + 1))
+
+    def soft_delete_subtree(self, root_ids: t.Iterable[int]) -> t.List[int]:
+        start = time.perf_counter()
+        root_ids = list(root_ids)
+        if root_ids:
+            subtree = live_subtree_cte(root_ids)
+            self.deleted_ids = self._session.execute(
+                sa.select(subtree.c.id)
+            ).scalars().all()
+            nodes = DBNodeModel.__table__
+            self._session.execute(
+                nodes.update().where(
+                    nodes.c.id.in_(json_ids(self.deleted_ids))
+                ).values(
+                    deleted=True,
+                    version=nodes.c.version + 1,
+                )
+            )
+        self._record('delete', len(self.deleted_ids), start)
+        return self.deleted_ids
+
+    def _stage(self, updates: t.List[NodeUpdates]) -> None:
+        self._session.execute(
+            sa.text(f'DROP TABLE IF EXISTS temp.{self._staging_table}')
+        )
+        self._session.execute(sa.text(
+            f'CREATE TEMP TABLE {self._staging_table} '
+            '(id INTEGER PRIMARY KEY, parent_id INTEGER, value TEXT, '
+            'version INTEGER)'
+        ))
+        cursor = self._session.connection().connection.cursor()
+        cursor.executemany(
+            f'INSERT INTO {self._staging_table} VALUES (?, ?, ?, ?)',
+            (
+                (node['id'], node['parent_id'], node['value'],
+                 node['version'])
+                for node in updates
+            )
+        )
+        cursor.close()
+
+    def upsert(self, updates: t.List[NodeUpdates]) -> UpsertResult:
+        if not updates:
+            return UpsertResult({}, [])
+        start = time.perf_counter()
+        self._stage(updates)
+        self._record('stage', len(updates), start)
+
+        start = time.perf_counter()
+        execute = self._session.execute
+        conflicts = [
+            NodeConflict(node_id, reason, value, version)
+            for node_id, reason, value, version in execute(
+                sa.text(self._conflicts_sql)
+            )
+        ]
+        rejected = execute(sa.text(self._rejected_sql)).scalars().all()
+        conflicts.extend(
+            NodeConflict(node_id, CONFLICT_PARENT_DELETED, None, None)
+            for node_id in rejected
+        )
+        execute(sa.text(self._update_sql))
+        execute(
+            sa.text(self._insert_sql), {'rejected': json.dumps(rejected)}
+        )
+        conflicting = {conflict.id for conflict in conflicts}
+        versions = {
+            node_id: version
+            for node_id, version in execute(sa.text(self._versions_sql))
+            if node_id not in conflicting
+        }
+        self._record('merge', len(versions), start)
+        return UpsertResult(versions, conflicts)
+
+
+class SQLiteTreeDBClient(TreeDBClient):
+    """Tree storage in a local SQLite file in WAL mode
+
+    Needs no server, readers never wait for the writer. Server-side
+    prepared statements and materialized paths rely on PostgreSQL, so
+    they are always off; sqlite3 caches compiled statements on its own.
+    """
+
+    transaction_class = SQLiteApplyTransaction
+
+    def __init__(self, conf: DBConfig):
+        super().__init__(conf._replace(
+            prepared_statements=False,
+            materialized_paths=False,
+        ))
+
+    def _default_url(self, conf: DBConfig) -> str:
+        return f'sqlite:///{conf.db_name}'
+
+    def _create_engine(self, conf: DBConfig) -> sa.engine.Engine:
+        return create_engine(self.url, conf)
+
+    def _write_session(self) -> Session:
+        session = self.session()
+        session.connection(execution_options={IMMEDIATE: True})
+        return session
+
+    def _read_before(self, watermark: int) -> sa.sql.ColumnElement:
+        return DBNodeChangeModel.seq <= watermark
+
+    def _ids_in(
+        self,
+        column: sa.Column,
+        node_ids: t.List[int]
+    ) -> sa.sql.ColumnElement:
+        return column.in_(json_ids(node_ids))
+
+    def _any_of(self, column: sa.Column) -> sa.sql.ColumnElement:
+        return sa.func.max(column, type_=sa.Boolean)
+
+    def _value_matches(self, text: str) -> sa.sql.ColumnElement:
+        if len(text) < TRIGRAM:
+            return super()._value_matches(text)
+        phrase = '"' + text.replace('"', '""') + '"'
+        matches = sa.text(
+            f'SELECT rowid FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH :phrase'
+        ).bindparams(phrase=phrase).columns(rowid=sa.Integer)
+        return DBNodeModel.__table__.c.id.in_(matches)
+
+    def _ensure_table(self) -> None:
+        DBNodeModel.__table__.create(self.engine, checkfirst=True)
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(CHANGES_DDL)
+            triggers = (
+                CHANGE_TRIGGERS if self.change_feed else DROP_CHANGE_TRIGGERS
+            )
+            for ddl in triggers:
+                connection.exec_driver_sql(ddl)
+            connection.exec_driver_sql(SEARCH_DDL)
+            for ddl in SEARCH_TRIGGERS:
+                connection.exec_driver_sql(ddl)
+
+    def seed(self, rows: t.Iterable[SeedRow]) -> None:
+        """Replaces all nodes with the given rows, then builds indexes
+
+        Change logging and indexes are off during the load, a DELETE
+        without triggers empties the table as fast as a TRUNCATE. The
+        search index is rebuilt from the loaded values at once.
+        """
+        self._ensure_table()
+        indexes = DBNodeModel.__table__.indexes
+        with self._write_session() as s:
+            for ddl in (*DROP_CHANGE_TRIGGERS, *DROP_SEARCH_TRIGGERS):
+                s.execute(sa.text(ddl))
+            for index in indexes:
+                s.execute(sa.text(f'DROP INDEX IF EXISTS {index.name}'))
+            s.execute(sa.text(f'DELETE FROM {NODES_TABLE}'))
+            s.execute(sa.text(f'DELETE FROM {CHANGES_TABLE}'))
+            cursor = s.connection().connection.cursor()
+            cursor.executemany(
+                f'INSERT INTO {NODES_TABLE} '
+                '(id, parent_id, value, deleted, version) '
+                'VALUES (?, ?, ?, FALSE, 0)',
+                rows
+            )
+            cursor.close()
+            for index in indexes:
+                index.create(s.connection())
+            if self.change_feed:
+                for ddl in CHANGE_TRIGGERS:
+                    s.execute(sa.text(ddl))
+            s.execute(sa.text(REBUILD_SEARCH_SQL))
+            for ddl in SEARCH_TRIGGERS:
+                s.execute(sa.text(ddl))
+            s.execute(sa.text('ANALYZE'))
+            s.commit()
+
+    def seed_from_file(self, f: t.IO, seed_format: str = 'csv') -> None:
+        """Replaces all nodes with (id, parent_id, value) rows of a CSV
+
+        Empty fields are read as NULL.
+        """
+        if seed_format != 'csv':
+            raise ValueError('SQLite backend seeds from CSV files only')
+        self.seed(
+            SeedRow(int(node_id), int(parent_id) if parent_id else None,
+                    value or None)
+            for node_id, parent_id, value in csv.reader(f)
+        )
+
+    @timed('db.changes_watermark')
+    def changes_watermark(self) -> int:
+        """Position of the change feed to read changes made from now on
+
+        Writers commit one at a time, so the largest committed sequence
+        number is never followed by a smaller one.
+        """
+        with self.session() as s:
+            return s.execute(
+                sa.select(
+                    sa.func.coalesce(sa.func.max(DBNodeChangeModel.seq), 0)
+                )
+            ).scalar()
+
+    @timed('db.get_changes')
+    def get_changes(self, watermark: int) -> ChangeFeed:
+        self._read_watermarks.append((time.monotonic(), watermark))
+        with self.session() as s:
+            rows = s.query(
+                DBNodeChangeModel.seq,
+                DBNodeChangeModel.node_id,
+                DBNodeChangeModel.parent_id,
+                DBNodeChangeModel.value,
+                DBNodeChangeModel.deleted,
+            ).filter(
+                DBNodeChangeModel.seq > watermark,
+            ).order_by(DBNodeChangeModel.seq).all()
+        if not rows:
+            return ChangeFeed([], watermark)
+        return ChangeFeed(
+            [DBNodeChange(*row[1:]) for row in rows], rows[-1].seq
+        )
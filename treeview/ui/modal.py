@@ -18,7 +18,8 @@ class BaseQuestionMBox(QMessageBox):
         self.setCheckBox(cb)
 
     def enabled(self) -> bool:
-        return not self.checkBox().isChecked()
+        checkbox = self.checkBox()
+        return checkbox is None or not checkbox.isChecked()
 
 
 class DBNodeDeletionMBox(BaseQuestionMBox):
@@ -0,0 +1,34 @@
+import typing as t
+
+from PyQt5.QtWidgets import QHBoxLayout
+from PyQt5.QtWidgets import QLabel
+from PyQt5.QtWidgets import QProgressBar
+from PyQt5.QtWidgets import QWidget
+
+from .buttons import NarrowButton
+
+
+class TaskProgress(QWidget):
+    """Status bar widget showing the running database task"""
+
+    def __init__(self, on_cancel: t.Callable):
+        super().__init__()
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self._label = QLabel()
+        self._bar = QProgressBar()
+        self._bar.setMaximumWidth(100)
+        self._bar.setTextVisible(False)
+        layout.addWidget(self._label)
+        layout.addWidget(self._bar)
+        layout.addWidget(NarrowButton('x', on_cancel))
+        self.hide()
+
+    def show_progress(self, name: str, done: int, total: int) -> None:
+        self._label.setText(name)
+        self._bar.setRange(0, total)
+        self._bar.setValue(done)
+
+    def show_queue(self, pending: int) -> None:
+        self.setToolTip(f'{pending} database task(s) queued')
+        self.setVisible(bool(pending))
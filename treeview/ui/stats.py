@@ -0,0 +1,54 @@
+import typing as t
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QAbstractItemView
+from PyQt5.QtWidgets import QDockWidget
+from PyQt5.QtWidgets import QTableWidget
+from PyQt5.QtWidgets import QTableWidgetItem
+from PyQt5.QtWidgets import QWidget
+
+from treeview.metrics import Metrics
+
+REFRESH_INTERVAL_MS = 1000
+COLUMNS = ('Name', 'Calls', 'Total, ms', 'Max, ms', 'Rows')
+
+
+class StatsDock(QDockWidget):
+    """Dockable table of recorded spans and counters
+
+    Refreshed every second while visible, counters show their amount
+    in the calls column.
+    """
+
+    def __init__(self, metrics: Metrics, parent: QWidget):
+        super().__init__('Stats', parent)
+        self.setObjectName('stats_dock')
+        self._metrics = metrics
+        self._table = QTableWidget(0, len(COLUMNS))
+        self._table.setHorizontalHeaderLabels(COLUMNS)
+        self._table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        header = self._table.verticalHeader()
+        if header is not None:
+            header.hide()
+        self.setWidget(self._table)
+        self._timer = QTimer(self)
+        self._timer.setInterval(REFRESH_INTERVAL_MS)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start()
+
+    def refresh(self) -> None:
+        if not self.isVisible():
+            return
+        rows: t.List[t.Sequence[object]] = [
+            (name, span.calls, f'{span.seconds * 1000:.1f}',
+             f'{span.max_seconds * 1000:.1f}', span.rows)
+            for name, span in sorted(self._metrics.spans.items())
+        ]
+        rows.extend(
+            (name, amount, '', '', '')
+            for name, amount in sorted(self._metrics.counters.items())
+        )
+        self._table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                self._table.setItem(row, column, QTableWidgetItem(str(value)))
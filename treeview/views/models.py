@@ -0,0 +1,714 @@
+import typing as t
+from collections import OrderedDict
+from functools import partial
+
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import QAbstractItemModel
+from PyQt5.QtCore import QModelIndex
+from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QColor
+from PyQt5.QtGui import QFont
+
+from treeview.cache import CacheListener
+from treeview.cache import CacheNode
+from treeview.cache import NULL_TEXT
+from treeview.cache import StoredNode
+from treeview.cache import TreeCache
+from treeview.hierarchy import build_hierarchy
+from treeview.medium import CacheConfig
+from treeview.medium import DBNodeChange
+from treeview.medium import DBNodeRow
+from treeview.medium import NodeUpdates
+from treeview.metrics import METRICS
+from treeview.metrics import timed
+from treeview.worker import DBWorker
+from .items import CONTEXT_COLOR
+from .items import DEFAULT_COLOR
+from .items import DEFAULT_FNT
+from .items import EDITED_COLOR
+from .items import STRIKED_FNT
+from .items import UNSAVED_COLOR
+
+ChildrenFetcher = t.Callable[
+    [t.Optional[int], t.Optional[int], t.Optional[int]],
+    t.List[DBNodeRow]
+]
+ShownRecords = t.Callable[[], t.Iterable['DBNodeRecord']]
+
+ROOT_INDEX = QModelIndex()
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MAX_NODES = 10000
+
+Parent = t.TypeVar('Parent')
+
+
+def changed_ranges(
+    rows: t.Iterable[t.Tuple[Parent, int]]
+) -> t.Iterator[t.Tuple[Parent, int, int]]:
+    """Coalesces changed rows into a single range per parent"""
+    ranges: t.Dict[Parent, t.Tuple[int, int]] = {}
+    for parent, row in rows:
+        first, last = ranges.get(parent, (row, row))
+        ranges[parent] = (min(first, row), max(last, row))
+    for parent, (first, last) in ranges.items():
+        yield parent, first, last
+
+
+class RowsTracker(QAbstractItemModel):
+    """Base model counting rows touched by model notifications
+
+    Views take the count after each operation to show how much of the
+    model it affected. Subclasses provide `index_of`.
+    """
+
+    touched_rows = 0
+
+    def index_of(self, item: t.Any) -> QModelIndex:  # NOQA: ANN401
+        raise NotImplementedError
+
+    def count_rows(self, rows: int) -> None:
+        self.touched_rows += rows
+        if METRICS.enabled:
+            METRICS.count('view.rows_touched', rows)
+
+    def take_touched_rows(self) -> int:
+        rows, self.touched_rows = self.touched_rows, 0
+        return rows
+
+    def _emit_changed(self, rows: t.Iterable[t.Tuple[t.Any, int]]) -> None:
+        """Emits one dataChanged per parent for the given (parent, row)"""
+        for parent, first, last in changed_ranges(rows):
+            parent_index = self.index_of(parent)
+            self.dataChanged.emit(
+                self.index(first, 0, parent_index),
+                self.index(last, 0, parent_index),
+            )
+            self.count_rows(last - first + 1)
+
+
+class DBNodeRecord:
+    """Materialized node of the lazy DB tree model
+
+    `children` holds the fetched part of the node's children ordered by id,
+    `complete` tells whether all of them are fetched already, `fetching`
+    whether the next page is being fetched.
+    """
+
+    __slots__ = (
+        'id', 'parent', 'value', 'deleted',
+        'has_children', 'children', 'complete', 'fetching', 'row',
+    )
+
+    def __init__(
+        self,
+        node_id: t.Optional[int],
+        parent: t.Optional['DBNodeRecord'] = None,
+        value: t.Optional[str] = None,
+        deleted: bool = False,
+        has_children: bool = False,
+    ):
+        self.id = node_id
+        self.parent = parent
+        self.value = value
+        self.deleted = deleted
+        self.has_children = has_children
+        self.children: t.List['DBNodeRecord'] = []
+        self.complete = not has_children
+        self.fetching = False
+        self.row = 0
+
+    def __repr__(self) -> str:
+        return f'Node(id: {self.id}, data: {self.value})'
+
+    def in_database(self) -> bool:
+        return self.id is not None
+
+    def saved_id(self) -> int:
+        """Returns the id of any record but the root"""
+        if self.id is None:
+            raise ValueError(f'{self} is the root')
+        return self.id
+
+    def text(self) -> str:
+        return self.value or NULL_TEXT
+
+
+class DBTreeModel(RowsTracker):
+    """Lazy read-only model of the database tree
+
+    Children are requested from `fetcher` page by page when the view asks
+    for them through `canFetchMore`/`fetchMore`. Pages are fetched by
+    `worker` off the GUI thread and inserted once they arrive, one page
+    per parent at a time.
+
+    Once the number of materialized nodes exceeds `max_nodes`, children
+    of collapsed nodes are released in LRU order, then the least recently
+    used expanded nodes are collapsed and released too, so they are
+    fetched again on next expand. Expanded nodes shown by the view, as
+    told by `shown`, being fetched or leading to such nodes stay.
+    """
+
+    fetch_failed = pyqtSignal(object)
+    # Asks the view to collapse a branch before its children are released
+    collapse_requested = pyqtSignal(QModelIndex)
+
+    def __init__(
+        self,
+        header: str,
+        fetcher: t.Optional[ChildrenFetcher] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_nodes: int = DEFAULT_MAX_NODES,
+        worker: t.Optional[DBWorker] = None,
+        shown: t.Optional[ShownRecords] = None,
+    ):
+        super().__init__()
+        self._header = header
+        self._fetcher = fetcher
+        self._worker = worker
+        self._page_size = page_size
+        self._max_nodes = max_nodes
+        self._shown = shown
+        self._root = DBNodeRecord(None, has_children=True)
+        self._root.complete = fetcher is None
+        self._records: t.Dict[int, DBNodeRecord] = {}
+        self._collapsed: t.OrderedDict[int, DBNodeRecord] = OrderedDict()
+        self._expanded: t.OrderedDict[int, DBNodeRecord] = OrderedDict()
+        self._fetching: t.Set[DBNodeRecord] = set()
+        self._eviction_scheduled = False
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def record(self, node_id: int) -> t.Optional[DBNodeRecord]:
+        return self._records.get(node_id)
+
+    def record_from_index(self, index: QModelIndex) -> DBNodeRecord:
+        if not index.isValid():
+            return self._root
+        return index.internalPointer()
+
+    def index_of(self, record: DBNodeRecord) -> QModelIndex:
+        if record is self._root:
+            return QModelIndex()
+        return self.createIndex(record.row, 0, record)
+
+    def index(
+        self,
+        row: int,
+        column: int,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> QModelIndex:
+        parent_record = self.record_from_index(parent)
+        if column != 0 or not 0 <= row < len(parent_record.children):
+            return QModelIndex()
+        return self.createIndex(row, column, parent_record.children[row])
+
+    def parent(  # type: ignore[override]
+        self,
+        index: QModelIndex,
+    ) -> QModelIndex:
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_of(index.internalPointer().parent)
+
+    def rowCount(  # NOQA: N802
+        self,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> int:
+        if parent.column() > 0:
+            return 0
+        return len(self.record_from_index(parent).children)
+
+    def columnCount(  # NOQA: N802
+        self,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> int:
+        return 1
+
+    def hasChildren(  # NOQA: N802
+        self,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> bool:
+        record = self.record_from_index(parent)
+        return record.has_children or bool(record.children)
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlags:
+        if not index.isValid():
+            return Qt.ItemFlags()
+        flags = Qt.ItemFlags(Qt.ItemFlag.ItemIsEnabled)
+        return flags | Qt.ItemFlag.ItemIsSelectable
+
+    def data(
+        self,
+        index: QModelIndex,
+        role: int = Qt.ItemDataRole.DisplayRole
+    ) -> t.Union[str, QFont, QColor, None]:
+        if not index.isValid():
+            return None
+        record = index.internalPointer()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return record.text()
+        if role == Qt.ItemDataRole.FontRole:
+            return STRIKED_FNT if record.deleted else DEFAULT_FNT
+        if role == Qt.ItemDataRole.ForegroundRole:
+            return DEFAULT_COLOR
+        return None
+
+    def headerData(  # NOQA: N802
+        self,
+        section: int,
+        orientation: Qt.Orientation,
+        role: int = Qt.ItemDataRole.DisplayRole
+    ) -> t.Optional[str]:
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self._header
+        return None
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:  # NOQA: N802
+        record = self.record_from_index(parent)
+        return not record.complete and not record.fetching
+
+    def fetchMore(self, parent: QModelIndex) -> None:  # NOQA: N802
+        record = self.record_from_index(parent)
+        fetcher, worker = self._fetcher, self._worker
+        if record.complete or record.fetching:
+            return
+        if fetcher is None or worker is None:
+            return
+        record.fetching = True
+        self._fetching.add(record)
+        after_id = record.children[-1].id if record.children else None
+        fetch_page = partial(fetcher, record.id, after_id, self._page_size)
+        task = worker.submit(
+            'Fetching',
+            lambda task: fetch_page(),
+            partial(self._page_fetched, record, after_id),
+            self.fetch_failed.emit,
+            background=True,
+        )
+        task.signals.finished.connect(partial(self._fetch_finished, record))
+
+    def _fetch_finished(self, record: DBNodeRecord) -> None:
+        record.fetching = False
+        self._fetching.discard(record)
+
+    @timed('view.db.fetch_more')
+    def _page_fetched(
+        self,
+        record: DBNodeRecord,
+        after_id: t.Optional[int],
+        rows: t.List[DBNodeRow],
+    ) -> None:
+        record.fetching = False
+        self._fetching.discard(record)
+        last_id = record.children[-1].id if record.children else None
+        # Parent released or refetched meanwhile, the view asks again
+        if last_id != after_id or not self._attached(record):
+            return
+        if rows:
+            self._append_children(
+                record,
+                [self._make_record(row, record) for row in rows]
+            )
+        if len(rows) < self._page_size:
+            record.complete = True
+        if record.id is not None and record.id in self._expanded:
+            # Scrolled through, so used recently
+            self._expanded.move_to_end(record.id)
+        self._schedule_eviction()
+
+    def _attached(self, record: DBNodeRecord) -> bool:
+        if record.id is None:
+            return record is self._root
+        return self._records.get(record.id) is record
+
+    def _make_record(
+        self,
+        row: DBNodeRow,
+        parent: DBNodeRecord,
+    ) -> DBNodeRecord:
+        return DBNodeRecord(
+            row.id, parent, row.value, row.deleted, row.has_children
+        )
+
+    def _append_children(
+        self,
+        parent: DBNodeRecord,
+        records: t.List[DBNodeRecord],
+    ) -> None:
+        first = len(parent.children)
+        self.beginInsertRows(
+            self.index_of(parent), first, first + len(records) - 1
+        )
+        for row, record in enumerate(records, first):
+            record.row = row
+            parent.children.append(record)
+            self._records[record.saved_id()] = record
+        parent.has_children = True
+        self.endInsertRows()
+        self.count_rows(len(records))
+
+    def node_expanded(self, index: QModelIndex) -> None:
+        record = self.record_from_index(index)
+        if record.id is not None:
+            self._collapsed.pop(record.id, None)
+            self._expanded[record.id] = record
+            self._expanded.move_to_end(record.id)
+
+    def node_collapsed(self, index: QModelIndex) -> None:
+        record = self.record_from_index(index)
+        if record.id is not None:
+            self._expanded.pop(record.id, None)
+        if record.children and record.id is not None:
+            self._collapsed[record.id] = record
+            self._collapsed.move_to_end(record.id)
+            self._schedule_eviction()
+
+    def _schedule_eviction(self) -> None:
+        if self._fetcher is None or self._eviction_scheduled:
+            return
+        if len(self._records) > self._max_nodes:
+            self._eviction_scheduled = True
+            QTimer.singleShot(0, self._evict)
+
+    def _pinned(self) -> t.Set[int]:
+        """Ids of the branches leading to shown rows and fetched nodes"""
+        pinned: t.Set[int] = set()
+        shown = self._shown() if self._shown is not None else ()
+        for record in (*shown, *self._fetching):
+            node: t.Optional[DBNodeRecord] = record
+            while node is not None and node.id not in pinned:
+                if node.id is not None:
+                    pinned.add(node.id)
+                node = node.parent
+        return pinned
+
+    @timed('view.db.evict')
+    def _evict(self) -> None:
+        self._eviction_scheduled = False
+        while self._collapsed and len(self._records) > self._max_nodes:
+            _, record = self._collapsed.popitem(last=False)
+            self._release_children(record)
+        if len(self._records) <= self._max_nodes:
+            return
+        pinned = self._pinned()
+        for node_id, record in list(self._expanded.items()):
+            if len(self._records) <= self._max_nodes:
+                break
+            # Nodes under a released ancestor are gone already
+            if node_id in pinned or node_id not in self._expanded:
+                continue
+            if record.children:
+                self.collapse_requested.emit(self.index_of(record))
+                self._release_children(record)
+
+    def _release_children(self, record: DBNodeRecord) -> None:
+        self._collapsed.pop(record.saved_id(), None)
+        self._expanded.pop(record.saved_id(), None)
+        self.beginRemoveRows(
+            self.index_of(record), 0, len(record.children) - 1
+        )
+        self.count_rows(len(record.children))
+        stack = list(record.children)
+        while stack:
+            child = stack.pop()
+            self._records.pop(child.saved_id(), None)
+            self._collapsed.pop(child.saved_id(), None)
+            self._expanded.pop(child.saved_id(), None)
+            stack.extend(child.children)
+        record.children = []
+        record.complete = False
+        self.endRemoveRows()
+
+    @timed('view.db.load_rows')
+    def load_rows(self, data: t.Iterable[StoredNode]) -> t.List[StoredNode]:
+        """Materializes the whole given tree at once
+
+        Siblings are inserted with a single model notification per parent.
+        Returns the nodes that could not be attached to the tree.
+        """
+        hierarchy = build_hierarchy(data)
+        for parent_id, batch in hierarchy.batches:
+            parent = (
+                self._root if parent_id is None else self._records[parent_id]
+            )
+            self._append_children(parent, [
+                DBNodeRecord(node.id, parent, node.value, bool(node.deleted))
+                for node in batch
+            ])
+        return hierarchy.orphans
+
+    @timed('view.db.mark_deleted')
+    def mark_deleted(self, node_ids: t.Collection[int]) -> None:
+        """Strikes out materialized nodes among the given ones"""
+        records: t.Iterable[DBNodeRecord]
+        if len(node_ids) > len(self._records):
+            node_ids = set(node_ids)
+            records = [r for r in self._records.values() if r.id in node_ids]
+        else:
+            records = filter(None, map(self._records.get, node_ids))
+        changed = []
+        for record in records:
+            if not record.deleted:
+                record.deleted = True
+                changed.append((record.parent, record.row))
+        self._emit_changed(changed)
+
+    @timed('view.db.update_nodes')
+    def update_nodes(self, updates: t.List[NodeUpdates]) -> None:
+        """Applies saved values and appends new nodes per parent at once"""
+        changed = []
+        created: t.Dict[int, DBNodeRecord] = {}
+        appended: t.Dict[DBNodeRecord, t.List[DBNodeRecord]] = {}
+        for node in updates:
+            record = self._records.get(node['id'])
+            if record is not None:
+                record.value = node['value']
+                changed.append((record.parent, record.row))
+                continue
+            parent_id = node['parent_id']
+            if parent_id is None:
+                continue
+            parent = self._records.get(parent_id) or created.get(parent_id)
+            # Nodes under unfetched parents show up with the next page
+            if parent is not None and parent.complete:
+                record = DBNodeRecord(node['id'], parent, node['value'])
+                created[node['id']] = record
+                appended.setdefault(parent, []).append(record)
+        self._emit_changed(changed)
+        for parent, records in appended.items():
+            self._append_children(parent, records)
+
+    @timed('view.db.apply_changes')
+    def apply_changes(self, changes: t.Iterable[DBNodeChange]) -> None:
+        """Applies a batch of the change feed, the last change wins"""
+        latest: t.Dict[int, DBNodeChange] = {}
+        for change in changes:
+            latest[change.id] = change
+        # Keeps the first position of a node, so parents precede children
+        self.update_nodes([
+            NodeUpdates(
+                id=change.id,
+                parent_id=change.parent_id,
+                value=change.value,
+                version=None,
+            )
+            for change in latest.values()
+        ])
+        self.mark_deleted([
+            change.id for change in latest.values() if change.deleted
+        ])
+
+
+class CacheTreeModel(RowsTracker, CacheListener):
+    """Read-only model presenting a TreeCache to Qt views
+
+    Owns the cache and forwards its changes as model notifications, so
+    nodes carry no Qt objects of their own. State changes made within a
+    cache batch are emitted once per parent before the next structural
+    change or at the end of the batch.
+
+    A filter shows only the branches leading to given nodes. Rows of the
+    filtered model differ from the cache ones, so the filter is dropped
+    before any structural change of the cache.
+    """
+
+    filter_dropped = pyqtSignal()
+
+    def __init__(self, header: str, config: CacheConfig):
+        super().__init__()
+        self._header = header
+        self._batch_depth = 0
+        self._changed: t.List[CacheNode] = []
+        # Shown children of shown nodes and their rows, None unfiltered
+        self._shown: t.Optional[t.Dict[CacheNode, t.List[CacheNode]]] = None
+        self._shown_rows: t.Dict[CacheNode, int] = {}
+        self.cache = TreeCache(config, self)
+
+    @property
+    def filtered(self) -> bool:
+        return self._shown is not None
+
+    @timed('view.cache.filter')
+    def set_filter(self, matches: t.Optional[t.Iterable[CacheNode]]) -> None:
+        """Shows only given nodes with their ancestors, all for None"""
+        self.beginResetModel()
+        if matches is None:
+            self._shown = None
+            self._shown_rows = {}
+        else:
+            shown: t.Dict[CacheNode, t.List[CacheNode]] = {}
+            rows: t.Dict[CacheNode, int] = {}
+            for node in matches:
+                while node is not self.cache.root and node not in rows:
+                    rows[node] = 0
+                    parent = node.attached_parent()
+                    shown.setdefault(parent, []).append(node)
+                    node = parent
+            for children in shown.values():
+                children.sort(key=self.cache.row_of)
+                for row, child in enumerate(children):
+                    rows[child] = row
+            self._shown = shown
+            self._shown_rows = rows
+        self.endResetModel()
+        self.count_rows(len(self._shown_rows))
+
+    def _drop_filter(self) -> None:
+        if self._shown is not None:
+            self.set_filter(None)
+            self.filter_dropped.emit()
+
+    def _children(self, node: CacheNode) -> t.List[CacheNode]:
+        if self._shown is None:
+            return node.children
+        return self._shown.get(node, [])
+
+    def node_from_index(self, index: QModelIndex) -> CacheNode:
+        if not index.isValid():
+            return self.cache.root
+        return index.internalPointer()
+
+    def index_of(self, node: CacheNode) -> QModelIndex:
+        if node is self.cache.root:
+            return QModelIndex()
+        if self._shown is None:
+            return self.createIndex(self.cache.row_of(node), 0, node)
+        row = self._shown_rows.get(node)
+        if row is None:
+            return QModelIndex()
+        return self.createIndex(row, 0, node)
+
+    def index(
+        self,
+        row: int,
+        column: int,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> QModelIndex:
+        children = self._children(self.node_from_index(parent))
+        if column != 0 or not 0 <= row < len(children):
+            return QModelIndex()
+        return self.createIndex(row, column, children[row])
+
+    def parent(  # type: ignore[override]
+        self,
+        index: QModelIndex,
+    ) -> QModelIndex:
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_of(index.internalPointer().parent)
+
+    def rowCount(  # NOQA: N802
+        self,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> int:
+        if parent.column() > 0:
+            return 0
+        return len(self._children(self.node_from_index(parent)))
+
+    def columnCount(  # NOQA: N802
+        self,
+        parent: QModelIndex = ROOT_INDEX
+    ) -> int:
+        return 1
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlags:
+        if not index.isValid():
+            return Qt.ItemFlags()
+        flags = Qt.ItemFlags(Qt.ItemFlag.ItemIsEnabled)
+        return flags | Qt.ItemFlag.ItemIsSelectable
+
+    def data(
+        self,
+        index: QModelIndex,
+        role: int = Qt.ItemDataRole.DisplayRole
+    ) -> t.Union[str, QFont, QColor, None]:
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return node.text()
+        if role == Qt.ItemDataRole.FontRole:
+            return STRIKED_FNT if node.deleted else DEFAULT_FNT
+        if role == Qt.ItemDataRole.ForegroundRole:
+            if not node.in_database():
+                return UNSAVED_COLOR
+            if node.context:
+                return CONTEXT_COLOR
+            return EDITED_COLOR if node.modified else DEFAULT_COLOR
+        return None
+
+    def headerData(  # NOQA: N802
+        self,
+        section: int,
+        orientation: Qt.Orientation,
+        role: int = Qt.ItemDataRole.DisplayRole
+    ) -> t.Optional[str]:
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self._header
+        return None
+
+    def _flush_changed(self) -> None:
+        if self._changed:
+            if self._shown is None:
+                rows = [
+                    (node.parent, self.cache.row_of(node))
+                    for node in self._changed
+                ]
+            else:
+                rows = [
+                    (node.parent, self._shown_rows[node])
+                    for node in self._changed if node in self._shown_rows
+                ]
+            self._emit_changed(rows)
+            self._changed = []
+
+    def begin_batch(self) -> None:
+        self._batch_depth += 1
+
+    def end_batch(self) -> None:
+        self._batch_depth -= 1
+        if not self._batch_depth:
+            self._flush_changed()
+
+    def begin_insert(self, parent: CacheNode, row: int) -> None:
+        self._flush_changed()
+        self._drop_filter()
+        self.beginInsertRows(self.index_of(parent), row, row)
+        self.count_rows(1)
+
+    def end_insert(self) -> None:
+        self.endInsertRows()
+
+    def begin_remove(self, parent: CacheNode, row: int) -> None:
+        self._flush_changed()
+        self._drop_filter()
+        self.beginRemoveRows(self.index_of(parent), row, row)
+        self.count_rows(1)
+
+    def end_remove(self) -> None:
+        self.endRemoveRows()
+
+    def begin_move(
+        self,
+        source: CacheNode,
+        source_row: int,
+        target: CacheNode,
+        target_row: int,
+    ) -> None:
+        self._flush_changed()
+        self._drop_filter()
+        self.beginMoveRows(
+            self.index_of(source), source_row, source_row,
+            self.index_of(target), target_row,
+        )
+        self.count_rows(1)
+
+    def end_move(self) -> None:
+        self.endMoveRows()
+
+    def node_changed(self, node: CacheNode) -> None:
+        self._changed.append(node)
+        if not self._batch_depth:
+            self._flush_changed()
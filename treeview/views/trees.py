@@ -1,16 +1,30 @@
 import typing as t
-from collections import deque
 
-from PyQt5.Qt import QStandardItem
-from PyQt5.Qt import QStandardItemModel
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import QModelIndex
+from PyQt5.QtCore import QPoint
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QAbstractItemView
 from PyQt5.QtWidgets import QTreeView
 
-from treeview.db import DBNodeModel
+from treeview.cache import CacheNode
+from treeview.cache import DEFAULT_CACHE_CONFIG
+from treeview.cache import StoredNode
+from treeview.medium import CacheConfig
+from treeview.medium import DBLineageRow
+from treeview.medium import DBNodeChange
 from treeview.medium import ExportedCache
+from treeview.medium import NodeConflict
 from treeview.medium import NodeUpdates
-from .items import BaseNodeItem
-from .items import CacheViewNodeItem
-from .items import DBViewNodeItem
+from treeview.search import ValueIndex
+from treeview.snapshot import CacheSnapshot
+from treeview.worker import DBWorker
+from .models import CacheTreeModel
+from .models import ChildrenFetcher
+from .models import DBNodeRecord
+from .models import DBTreeModel
+from .models import DEFAULT_MAX_NODES
+from .models import DEFAULT_PAGE_SIZE
 
 
 class BaseTreeView(QTreeView):
@@ -19,31 +33,28 @@ class BaseTreeView(QTreeView):
 
     def __init__(self):
         super().__init__()
-        self._nodes_map = {}
         self._init_model()
 
-    def _init_model(self):
-        self._model = QStandardItemModel()
-        self._root = self._model.invisibleRootItem()
-        self.setModel(self._model)
-        self._model.setHorizontalHeaderItem(
-            0, QStandardItem(self._header)
-        )
-
-    def _remove_item_row(self, item: BaseNodeItem):
-        parent = item.parent()
-        if parent is None:
-            self._root.removeRow(item.row())
-        else:
-            parent.removeRow(item.row())
-
-    def get_selected_node(self) -> t.Optional[BaseNodeItem]:
-        index = next(iter(self.selectedIndexes()), None)
-        if index is not None:
-            return self._model.itemFromIndex(index)
+    def expand_nodes(self, nodes: t.Iterable[t.Any]) -> None:
+        """Expands given nodes of the model together with their ancestors
+
+        Only the affected branches are laid out again, unlike expandAll().
+        """
+        expanded = set()
+        for node in nodes:
+            while node not in expanded:
+                index = self._model.index_of(node)
+                if not index.isValid():
+                    break
+                expanded.add(node)
+                self.expand(index)
+                node = node.parent
+
+    def take_touched_rows(self) -> int:
+        """Returns the number of rows touched since the previous call"""
+        return self._model.take_touched_rows()
 
     def reset_view(self):
-        self._nodes_map = {}
         self._init_model()
 
 
@@ -51,235 +62,295 @@ class DBTreeView(BaseTreeView):
 
     _header = 'DB Tree'
 
-    def load_data(self, data: t.List[DBNodeModel]) -> None:
-        nodes = deque(data)
-        while nodes:
-            node = nodes.popleft()
-            if node.parent_id is None:
-                parent = self._root
-            else:
-                parent = self._nodes_map.get(node.parent_id)
-                if parent is None:
-                    nodes.append(node)
-                    continue
-            item = DBViewNodeItem.from_db_model(node)
-            parent.appendRow(item)
-            self._nodes_map[item.id] = item
-        self.expandAll()
-
-    def get_node(self, node_id: int) -> DBViewNodeItem:
-        node = self._nodes_map.get(node_id)
-        if node is None:
-            raise IndexError(
-                f'Node with id {node_id} not found in db'
-            )
-        else:
-            return node
-
-    def _import_node(self, node: NodeUpdates) -> None:
-        node_id = node['id']
-        if node_id in self._nodes_map:
-            raise IndexError(
-                f'Node with id {node_id} is already in view'
-            )
-        item = DBViewNodeItem.from_dict(node)
-        parent = self.get_node(node['parent_id'])
-        parent.appendRow(item)
-        self._nodes_map[item.id] = item
-
-    def delete_subtrees(self, subtree_roots: t.Set[int]) -> t.Set[int]:
-
-        deleted_ids = set()
-
-        def _delete_subtree(item: DBViewNodeItem):
-            if item.deleted:
-                return
-            item.set_deleted()
-            deleted_ids.add(item.id)
-            if item.hasChildren():
-                for row in range(item.rowCount()):
-                    child = item.child(row, 0)
-                    _delete_subtree(child)
-
-        for node_id in subtree_roots:
-            subtree_root = self.get_node(node_id)
-            _delete_subtree(subtree_root)
-
-        return deleted_ids
+    fetch_failed = pyqtSignal(object)
+
+    def __init__(
+        self,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_nodes: int = DEFAULT_MAX_NODES,
+    ):
+        self._fetcher: t.Optional[ChildrenFetcher] = None
+        self._worker: t.Optional[DBWorker] = None
+        self._page_size = page_size
+        self._max_nodes = max_nodes
+        super().__init__()
+        self.setUniformRowHeights(True)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.expanded.connect(self._on_expanded)
+        self.collapsed.connect(self._on_collapsed)
+
+    def _init_model(self):
+        self._model = DBTreeModel(
+            self._header,
+            self._fetcher,
+            self._page_size,
+            self._max_nodes,
+            self._worker,
+            self._shown_records,
+        )
+        self._model.fetch_failed.connect(self.fetch_failed)
+        self._model.collapse_requested.connect(self.collapse)
+        self.setModel(self._model)
+
+    def _shown_records(self) -> t.Iterator[DBNodeRecord]:
+        """Yields records of the current row and the rows on screen"""
+        current = self.currentIndex()
+        if current.isValid():
+            yield self._model.record_from_index(current)
+        viewport = self.viewport()
+        bottom = viewport.height() if viewport is not None else 0
+        index = self.indexAt(QPoint(0, 0))
+        while index.isValid() and self.visualRect(index).top() < bottom:
+            yield self._model.record_from_index(index)
+            index = self.indexBelow(index)
+
+    def _on_expanded(self, index: QModelIndex) -> None:
+        self._model.node_expanded(index)
+
+    def _on_collapsed(self, index: QModelIndex) -> None:
+        self._model.node_collapsed(index)
+
+    def set_source(self, fetcher: ChildrenFetcher, worker: DBWorker) -> None:
+        """Makes the view fetch children lazily page by page on `worker`"""
+        self._fetcher = fetcher
+        self._worker = worker
+        self.reset_view()
+
+    def load_data(self, data: t.Iterable[StoredNode]) -> t.List[StoredNode]:
+        data = list(data)
+        orphans = self._model.load_rows(data)
+        parent_ids = {node.parent_id for node in data}
+        self.expand_nodes(
+            filter(None, map(self._model.record, parent_ids))
+        )
+        return orphans
+
+    def get_selected_node(self) -> t.Optional[DBNodeRecord]:
+        index = next(iter(self.selectedIndexes()), None)
+        if index is not None:
+            return self._model.record_from_index(index)
+        return None
+
+    def get_selected_nodes(self) -> t.List[DBNodeRecord]:
+        return [
+            self._model.record_from_index(index)
+            for index in self.selectedIndexes()
+        ]
+
+    def mark_deleted(self, node_ids: t.Collection[int]) -> None:
+        self._model.mark_deleted(node_ids)
 
     def update_view(
         self,
         updates: t.List[NodeUpdates],
     ) -> None:
-        for node in updates:
-            item = self._nodes_map.get(node['id'])
-            if item is not None:
-                item.set_data(node['value'])
-            else:
-                self._import_node(node)
-        self.expandAll()
+        self._model.update_nodes(updates)
+
+    def apply_changes(self, changes: t.List[DBNodeChange]) -> None:
+        self._model.apply_changes(changes)
+
+    def show_matches(self, rows: t.List[DBLineageRow]) -> None:
+        """Shows only the branches found by TreeDBClient.search
+
+        The branches are complete, nothing is fetched until the lazy
+        tree is shown again with `reset_view`.
+        """
+        fetcher, self._fetcher = self._fetcher, None
+        self.reset_view()
+        self._fetcher = fetcher
+        self.load_data(rows)
 
 
 class CachedTreeView(BaseTreeView):
+    """View of the local cache delegating all the logic to TreeCache
+
+    With a snapshot path configured the cache is kept in a local file,
+    changes are written to it once control returns to the event loop.
+    Values are indexed for filtering, a filter dropped by a structural
+    change of the cache is applied again once the change is over.
+    """
 
     _header = 'Cached Tree'
 
-    def __init__(self, index: int = 1):
+    def __init__(self, config: CacheConfig = DEFAULT_CACHE_CONFIG):
+        self._config = config
+        self._snapshot: t.Optional[CacheSnapshot] = None
+        if config.snapshot_path is not None:
+            self._snapshot = CacheSnapshot(config.snapshot_path)
+        self._flush_scheduled = False
+        self._filter_text = ''
         super().__init__()
-        self._index = self._init_index = index
-        self.deleted_subtree_roots: t.Set[int] = set()
+        self.setUniformRowHeights(True)
 
-    @staticmethod
-    def _add_imported_child(
-        parent: QStandardItem,
-        item: CacheViewNodeItem
-    ) -> None:
-        if parent.hasChildren():
-            for row in range(parent.rowCount()):
-                child = parent.child(row, 0)
-                if child.id is None or child.id > item.id:
-                    parent.insertRow(row, item)
-                    return
-        parent.appendRow(item)
-
-    def _reparent_orphaned(self, item: CacheViewNodeItem) -> t.List[str]:
-        stillborns = []
-        for row in range(self._root.rowCount() - 1, -1, -1):
-            top_item = self._root.child(row, 0)
-            if top_item.id < item.id:
-                break
-            elif top_item.parent_id == item.id:
-                if item.deleted:
-                    if top_item.deleted:
-                        self.deleted_subtree_roots.discard(top_item.id)
-                    else:
-                        stillborns.extend(
-                            self._mark_subtree_for_delete(top_item)
-                        )
-                self._root.takeRow(row)
-                self._add_imported_child(item, top_item)
+    def _init_model(self):
+        self._model = CacheTreeModel(self._header, self._config)
+        self._cache = self._model.cache
+        self._index = ValueIndex()
+        self._cache.add_listener(self._index)
+        if self._snapshot is not None:
+            self._cache.add_listener(self._snapshot)
+        self._model.filter_dropped.connect(
+            lambda: QTimer.singleShot(0, self._reapply_filter)
+        )
+        self.setModel(self._model)
+        self.selectionModel().currentChanged.connect(self._on_current_changed)
 
-        return stillborns
+    def reset_view(self):
+        if self._snapshot is not None:
+            self._snapshot.clear()
+        self._filter_text = ''
+        super().reset_view()
+
+    def restore_snapshot(self) -> int:
+        """Loads the cache saved by a previous run
+
+        Returns the number of restored nodes, zero without a snapshot.
+        """
+        if self._snapshot is None:
+            return 0
+        self._model.beginResetModel()
+        try:
+            count = self._snapshot.restore(self._cache)
+            self._index.rebuild(self._cache)
+        finally:
+            self._model.endResetModel()
+        return count
+
+    def filter_nodes(self, text: str) -> int:
+        """Shows only the branches leading to values containing `text`
+
+        Empty text shows all nodes. Returns the number of matches.
+        """
+        self._filter_text = text
+        if not text:
+            self._model.set_filter(None)
+            return self._cache.node_count
+        matches = self._index.search(text)
+        self._model.set_filter(matches)
+        self.expand_nodes(node.parent for node in matches)
+        return len(matches)
+
+    def _reapply_filter(self) -> None:
+        if self._filter_text and not self._model.filtered:
+            self.filter_nodes(self._filter_text)
+
+    def _schedule_flush(self) -> None:
+        # Several changes in one event loop pass are written together
+        if self._snapshot is None or self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        QTimer.singleShot(0, self.flush_snapshot)
 
-    def _mark_subtree_for_delete(
+    def flush_snapshot(self) -> None:
+        self._flush_scheduled = False
+        if self._snapshot is not None:
+            self._snapshot.flush(self._cache)
+
+    def close_snapshot(self) -> None:
+        if self._snapshot is not None:
+            self.flush_snapshot()
+            self._snapshot.close()
+            self._snapshot = None
+
+    def _on_current_changed(
         self,
-        subtree_root: CacheViewNodeItem
-    ) -> t.List[str]:
+        current: QModelIndex,
+        previous: QModelIndex
+    ) -> None:
+        if current.isValid():
+            self._cache.touch(self._model.node_from_index(current))
 
-        stillborns = []
-
-        def _collect_stillborns(item: CacheViewNodeItem):
-            stillborns.append(item.text())
-            for row in range(item.rowCount()):
-                child = item.child(row, 0)
-                _collect_stillborns(child)
-
-        def _delete_subtree(item: CacheViewNodeItem):
-            item.mark_for_delete()
-            if item.hasChildren():
-                for row in range(item.rowCount() - 1, -1, -1):
-                    child = item.child(row, 0)
-                    if child.deleted:
-                        self.deleted_subtree_roots.discard(child.id)
-                        continue
-                    if not child.in_database():
-                        _collect_stillborns(child)
-                        item.removeRow(row)
-                        continue
-                    _delete_subtree(child)
-
-        _delete_subtree(subtree_root)
+    @property
+    def node_count(self) -> int:
+        return self._cache.node_count
 
-        return stillborns
+    @property
+    def unsaved_count(self) -> int:
+        return self._cache.unsaved_count
 
-    def import_node(self, node: DBNodeModel) -> t.Optional[t.List[str]]:
-        if node.id in self._nodes_map:
-            return
-        item = CacheViewNodeItem.from_db_model(node)
-        if item.parent_id is None:
-            parent = self._root
-        else:
-            parent = self._nodes_map.get(item.parent_id)
-            if parent is None:
-                parent = self._root
-            elif parent.deleted:
-                item.mark_for_delete()
-        self._add_imported_child(parent, item)
-        self._nodes_map[item.id] = item
-        stillborns = self._reparent_orphaned(item)
-        self.expandAll()
+    @property
+    def footprint_bytes(self) -> int:
+        return self._cache.footprint_bytes
 
-        return stillborns
+    @property
+    def deleted_subtree_roots(self) -> t.Set[int]:
+        return self._cache.deleted_subtree_roots
 
-    def add_child_node(self, parent: CacheViewNodeItem, data: str) -> None:
-        item = CacheViewNodeItem(
-            data=data or None
-        )
-        item.set_unsaved()
-        parent.appendRow(item)
+    def get_selected_node(self) -> t.Optional[CacheNode]:
+        index = next(iter(self.selectedIndexes()), None)
+        if index is not None:
+            return self._model.node_from_index(index)
+        return None
+
+    def in_cache(self, node_id: int) -> bool:
+        return self._cache.in_cache(node_id)
 
-    def delete_node(
+    def import_node(self, node: StoredNode) -> t.Optional[t.List[str]]:
+        if self.in_cache(node.id):
+            return None
+        return self.import_nodes([node])
+
+    def import_nodes(
         self,
-        item: CacheViewNodeItem
-    ) -> t.Optional[t.List[str]]:
-        if item.in_database():
-            stillborns = self._mark_subtree_for_delete(item)
-            self.deleted_subtree_roots.add(item.id)
-
-            return stillborns
-        else:
-            self._remove_item_row(item)
-
-    def _update_deleted_orphans(self, deleted_ids: t.Set[int]) -> t.List[str]:
-        stillborns = []
-
-        for row in range(self._root.rowCount() - 1, -1, -1):
-            top_item = self._root.child(row, 0)
-            if top_item.deleted:
-                continue
-            if top_item.id in deleted_ids:
-                stillborns.extend(
-                    self._mark_subtree_for_delete(top_item)
-                )
+        nodes: t.Iterable[StoredNode],
+        context: t.Iterable[StoredNode] = (),
+        expand: bool = True,
+    ) -> t.List[str]:
+        nodes = list(nodes)
+        stillborns = self._cache.import_nodes(nodes, context)
+        self._schedule_flush()
+        if expand:
+            self.expand_nodes(filter(
+                None, (self._cache.get_node(node.id) for node in nodes)
+            ))
+        return stillborns
+
+    def add_child_node(self, parent: CacheNode, data: str) -> CacheNode:
+        node = self._cache.add_child_node(parent, data)
+        self._schedule_flush()
+        self.expand_nodes([parent])
+        return node
 
+    def edit_node(self, node: CacheNode, data: str) -> None:
+        self._cache.edit_node(node, data)
+        self._schedule_flush()
+
+    def delete_node(self, node: CacheNode) -> t.Optional[t.List[str]]:
+        stillborns = self._cache.delete_node(node)
+        self._schedule_flush()
         return stillborns
 
-    def save_cache_and_export_changes(
+    def undo(self) -> bool:
+        undone = self._cache.undo()
+        self._schedule_flush()
+        return undone
+
+    def redo(self) -> bool:
+        redone = self._cache.redo()
+        self._schedule_flush()
+        return redone
+
+    def export_changes(
         self,
-        deleted_ids: t.Set[int]
+        deleted_ids: t.Set[int],
+        reserve_ids: t.Callable[[int], t.List[int]],
     ) -> ExportedCache:
+        return self._cache.export_changes(deleted_ids, reserve_ids)
 
-        updates = []
-        stillborns = self._update_deleted_orphans(deleted_ids)
-
-        def _export_subtree(item: QStandardItem):
-            if item is not self._root:
-                if item.in_database():
-                    if item.deleted:
-                        return
-                    if item.modified:
-                        updates.append(item.to_dict())
-                        item.set_unmodifed()
-                else:
-                    parent = item.parent()
-                    self._index += 1
-                    item.id = self._index
-                    item.parent_id = parent.id
-                    updates.append(item.to_dict())
-                    self._nodes_map[item.id] = item
-                    item.set_saved()
-            for row in range(item.rowCount()):
-                _export_subtree(item.child(row, 0))
-
-        _export_subtree(self._root)
-        self.deleted_subtree_roots = set()
-
-        return ExportedCache(
-            updates=updates,
-            stillborns=stillborns,
-        )
+    def commit_export(
+        self,
+        exported: ExportedCache,
+        deleted_ids: t.Set[int],
+    ) -> t.List[str]:
+        stillborns = self._cache.commit_export(exported, deleted_ids)
+        self._schedule_flush()
+        return stillborns
 
-    def reset_view(self):
-        super().reset_view()
-        self._index = self._init_index
-        self.deleted_subtree_roots = set()
+    def reconcile(
+        self,
+        versions: t.Dict[int, int],
+        conflicts: t.List[NodeConflict],
+    ) -> t.List[str]:
+        rejected = self._cache.reconcile(versions, conflicts)
+        self._schedule_flush()
+        return rejected
@@ -0,0 +1,152 @@
+import threading
+import typing as t
+from concurrent.futures import Future
+
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtCore import QObject
+from PyQt5.QtCore import QRunnable
+from PyQt5.QtCore import QThreadPool
+
+T = t.TypeVar('T')
+
+
+class TaskCancelledError(Exception):
+    pass
+
+
+class TaskSignals(QObject):
+    progress = pyqtSignal(int, int)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    cancelled = pyqtSignal()
+    finished = pyqtSignal()
+    call_requested = pyqtSignal(object)
+
+
+class DBTask(QRunnable):
+    """Database job run by DBWorker on its thread
+
+    The job gets the task itself to report progress, to check for
+    cancellation between its steps and to run code on the GUI thread.
+    Background tasks are not shown to the user.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        job: t.Callable[['DBTask'], t.Any],
+        background: bool = False,
+    ):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.name = name
+        self.background = background
+        self.signals = TaskSignals()
+        self._job = job
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def check_cancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise TaskCancelledError(self.name)
+
+    def report_progress(self, done: int, total: int) -> None:
+        self.signals.progress.emit(done, total)
+
+    def call_in_gui(self, func: t.Callable[..., T], *args: object) -> T:
+        """Runs `func` on the GUI thread and waits for its result"""
+        future: Future = Future()
+
+        def call() -> None:
+            try:
+                future.set_result(func(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        self.signals.call_requested.emit(call)
+        return future.result()
+
+    def run(self) -> None:
+        try:
+            self.check_cancelled()
+            # Zero total shows a busy indicator until the job reports
+            self.report_progress(0, 0)
+            result = self._job(self)
+        except TaskCancelledError:
+            self.signals.cancelled.emit()
+        except Exception as exc:
+            self.signals.failed.emit(exc)
+        else:
+            self.signals.succeeded.emit(result)
+        finally:
+            self.signals.finished.emit()
+
+
+class DBWorker(QObject):
+    """Runs database jobs one at a time off the GUI thread
+
+    Jobs submitted while another one is running wait in the queue. Task
+    signals are delivered on the GUI thread, so handlers may update views.
+    """
+
+    progress = pyqtSignal(str, int, int)
+    queue_changed = pyqtSignal(int)
+
+    def __init__(self, parent: t.Optional[QObject] = None):
+        super().__init__(parent)
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self._tasks: t.List[DBTask] = []
+
+    @property
+    def pending(self) -> int:
+        return sum(not task.background for task in self._tasks)
+
+    @property
+    def idle(self) -> bool:
+        return not self._tasks
+
+    def submit(
+        self,
+        name: str,
+        job: t.Callable[[DBTask], T],
+        on_success: t.Callable[[T], None],
+        on_failure: t.Callable[[Exception], None],
+        background: bool = False,
+    ) -> DBTask:
+        task = DBTask(name, job, background)
+        task.signals.call_requested.connect(self._call)
+        if not background:
+            task.signals.progress.connect(
+                lambda done, total: self.progress.emit(name, done, total)
+            )
+        task.signals.succeeded.connect(on_success)
+        task.signals.failed.connect(on_failure)
+        task.signals.finished.connect(lambda: self._forget(task))
+        self._tasks.append(task)
+        self._pool.start(task)
+        self.queue_changed.emit(self.pending)
+        return task
+
+    def _call(self, call: t.Callable[[], None]) -> None:
+        call()
+
+    def _forget(self, task: DBTask) -> None:
+        self._tasks.remove(task)
+        self.queue_changed.emit(self.pending)
+
+    def cancel_all(self) -> None:
+        """Drops queued tasks and asks the running one to stop"""
+        for task in list(self._tasks):
+            task.cancel()
+            if self._pool.tryTake(task):
+                task.signals.cancelled.emit()
+                task.signals.finished.emit()
+
+    def wait(self) -> None:
+        # Keeps serving GUI calls the running task may wait for
+        while not self._pool.waitForDone(10):
+            QCoreApplication.processEvents()